@@ -0,0 +1,62 @@
+from argparse import ArgumentParser
+
+import numpy as np
+
+from griffig import Griffig, Gripper, BoxData, CaptureReader
+from griffig.infer.selection import Max
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True, help='Directory of a capture, e.g. recorded by grasp_realsense.py')
+    parser.add_argument('--coarse-step', type=int, default=4, help='Evaluate every n-th rotation in the coarse stage')
+    parser.add_argument('--fine-candidates', type=int, default=1, help='Number of best coarse rotations to refine')
+    parser.add_argument('--pyramid-factor', type=int, default=32, help='Spacing of the rewards evaluated in the coarse stage of the pyramid inference, needs to be larger than window / stride (16) without a pyramid model')
+    args = parser.parse_args()
+
+    box_data = BoxData(
+        center=(0.0, 0.017, 0.0),  # At the center [m]
+        size=(0.18, 0.285, 0.1),  # (x, y, z) [m]
+    )
+
+    gripper = Gripper(  # Some information about the gripper
+        min_stroke=0.01,  # Min. pre-shaped width in [m]
+        max_stroke=0.10,  # Max. pre-shaped width in [m]
+    )
+
+    griffig = Griffig(
+        model='two-finger-planar',  # Use the default model for a two-finger gripper
+        gripper=gripper,
+        box_data=box_data,
+        typical_camera_distance=0.41,  # Typical distance between camera and bin (used for depth image rendering) [m]
+        warmup=True,  # Don't measure the tracing of the model in the first inference
+    )
+
+    # Compare the full inference, the coarse-to-fine rotation search and the pyramid inference on the same rendered images
+    searches = [('full', None, None), ('coarse-to-fine', args.coarse_step, None), ('pyramid', None, args.pyramid_factor)]
+    nn_durations = {name: [] for name, _, _ in searches}
+    rewards = {name: [] for name, _, _ in searches}
+    same_grasp = {name: [] for name, _, _ in searches[1:]}
+
+    for pointcloud, camera_pose in CaptureReader(args.input):
+        image = griffig.render_image(pointcloud, camera_pose).clone()
+
+        grasps = {}
+        for name, coarse_step, pyramid_factor in searches:
+            griffig.inference.coarse_step = coarse_step
+            griffig.inference.fine_candidates = args.fine_candidates
+            griffig.inference.pyramid_factor = pyramid_factor
+
+            grasps[name] = griffig.calculate_grasp_from_image(image, method=Max())
+            nn_durations[name].append(grasps[name].detail_durations['nn'])
+            rewards[name].append(grasps[name].estimated_reward)
+
+        full = grasps['full'].pose
+        for name in same_grasp:
+            pose = grasps[name].pose
+            same_grasp[name].append(np.allclose([full.x, full.y, full.a], [pose.x, pose.y, pose.a]))
+
+    for name in nn_durations:
+        print(f'{name}: nn {1000 * np.mean(nn_durations[name]):0.1f} [ms], mean reward {np.mean(rewards[name]):0.3f}')
+    for name in same_grasp:
+        print(f'{name}: same grasp as full inference in {100 * np.mean(same_grasp[name]):0.1f} [%] of {len(same_grasp[name])} scenes')
@@ -2,7 +2,7 @@ from argparse import ArgumentParser
 
 import pyrealsense2 as rs
 
-from griffig import Griffig, Gripper, BoxData, Pointcloud
+from griffig import Griffig, Gripper, BoxData, CaptureWriter, Pointcloud
 from loader import Loader
 
 
@@ -27,6 +27,7 @@ class RealsenseReader:
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-i', '--input', type=str, default=str(Loader.data_path / '20210318_110437.bag'))
+    parser.add_argument('-r', '--record', type=str, default=None, help='Record the point cloud for replaying without the SDK')
     args = parser.parse_args()
 
     box_data = BoxData(
@@ -44,6 +45,7 @@ if __name__ == '__main__':
         gripper=gripper,
         box_data=box_data,
         typical_camera_distance=0.41,  # Typical distance between camera and bin (used for depth image rendering) [m]
+        warmup=True,  # Run the inference once at construction, so that the first grasp is as fast as the following ones
     )
 
     realsense = RealsenseReader(args.input)
@@ -51,6 +53,10 @@ if __name__ == '__main__':
 
     pointcloud = Pointcloud(realsense_frames=frames)
 
+    if args.record:
+        with CaptureWriter(args.record) as capture:
+            capture.write(pointcloud)
+
     # Return image (depth channel) with grasp for visualization
     grasp, image = griffig.calculate_grasp(pointcloud, return_image=True, channels='D')
     print(grasp)
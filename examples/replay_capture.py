@@ -0,0 +1,36 @@
+from argparse import ArgumentParser
+from time import time
+
+from griffig import Griffig, Gripper, BoxData, CaptureReader
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True, help='Directory of a capture, e.g. recorded by grasp_realsense.py')
+    args = parser.parse_args()
+
+    box_data = BoxData(
+        center=(0.0, 0.017, 0.0),  # At the center [m]
+        size=(0.18, 0.285, 0.1),  # (x, y, z) [m]
+    )
+
+    gripper = Gripper(  # Some information about the gripper
+        min_stroke=0.01,  # Min. pre-shaped width in [m]
+        max_stroke=0.10,  # Max. pre-shaped width in [m]
+    )
+
+    griffig = Griffig(
+        model='two-finger-planar',  # Use the default model for a two-finger gripper
+        gripper=gripper,
+        box_data=box_data,
+        typical_camera_distance=0.41,  # Typical distance between camera and bin (used for depth image rendering) [m]
+        warmup=True,  # Run the inference once at construction, so that the first grasp is as fast as the following ones
+    )
+
+    # The point clouds reference the memory-mapped capture directly
+    start = time()
+    for pointcloud, camera_pose in CaptureReader(args.input):
+        grasp = griffig.calculate_grasp(pointcloud, camera_pose=camera_pose)
+        print(grasp)
+
+    print(f'Replayed capture in {time() - start:0.3f} [s]')
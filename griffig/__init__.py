@@ -1,18 +1,50 @@
-from pyaffx import Affine
-
-from _griffig import (
-    BoxData,
-    Grasp,
-    Gripper,
-    OrthographicImage,
-    PointType,
-    Pointcloud,
-    Renderer,
-    RobotPose,
-)
-
-from .griffig import Griffig
-from .infer.inference import Inference
-from .utility.heatmap import Heatmap
-from .utility.model_data import ModelData, ModelArchitecture
-from .utility.model_library import ModelLibrary
+from importlib import import_module
+
+from .utility.startup_profile import profile, startup_profile
+
+with profile('import griffig'):
+    from pyaffx import Affine
+
+    from _griffig import (
+        BoxData,
+        CameraIntrinsics,
+        Grasp,
+        Gripper,
+        OrthographicImage,
+        PointType,
+        Pointcloud,
+        PointcloudFilter,
+        Renderer,
+        RenderMode,
+        RobotPose,
+        SoftwareRenderer,
+    )
+
+    from .infer.backend import Backend, Precision
+    from .infer.batching import BatchedModel
+    from .utility.capture import CaptureReader, CaptureWriter
+    from .utility.model_data import ModelData, ModelArchitecture
+    from .utility.renderer_pool import RendererPool
+
+
+# Heavy dependencies (TensorFlow, SciPy, OpenCV, PIL, requests) are imported on first use only
+_lazy_attributes = {
+    'Griffig': '.griffig',
+    'Inference': '.infer.inference',
+    'Heatmap': '.utility.heatmap',
+    'ModelLibrary': '.utility.model_library',
+}
+
+
+def __getattr__(name):
+    if name not in _lazy_attributes:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    with profile(f'import {name}'):
+        value = getattr(import_module(_lazy_attributes[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_attributes))
@@ -28,7 +28,7 @@ class Converter:
     def calculate_z(self, image_area, grasp):
         """Model-based calculation of the grasp distance z"""
 
-        mat_area_image = image_area.mat[:, :, 3]
+        mat_area_image = image_area.mat if image_area.mat.ndim == 2 else image_area.mat[:, :, 3]
         mat_area_image = mat_area_image.astype(np.float32) / np.iinfo(image_area.mat.dtype).max
         mat_area_image[mat_area_image < 0.02] = np.NaN  # Make every not found pixel NaN
 
@@ -1,13 +1,15 @@
-from typing import Union
+from typing import List, Union
 from pathlib import Path
 
 import cv2
+from loguru import logger
 import numpy as np
-from PIL import Image
 
-from _griffig import BoxData, Gripper, Pointcloud, Renderer, RobotPose
+from pyaffx import Affine
+from _griffig import BoxData, CameraIntrinsics, Gripper, OrthographicImage, Pointcloud, PointcloudFilter, Renderer, RobotPose, SoftwareRenderer
 from .action.checker import Checker
 from .action.converter import Converter
+from .infer.backend import Backend, Precision
 from .infer.inference import Inference
 from .infer.selection import Method, Max, Top
 from .utility.heatmap import Heatmap
@@ -23,67 +25,149 @@ class Griffig:
         box_data: BoxData = None,
         typical_camera_distance: int = None,
         avoid_collisions=False,
+        filter_pointcloud=False,
+        warmup=False,
         gpu: int = None,
+        backend: Backend = Backend.TensorFlow,
+        precision: Precision = Precision.FP32,
+        calibration_images: List[OrthographicImage] = None,
+        shared_model = None,
         verbose = 0,
     ):
         self.gripper = gripper
         self.box_data = box_data
 
         self.model_data = model if isinstance(model, ModelData) else ModelLibrary.load_model_data(model)
-        self.inference = Inference.create(self.model_data, gpu=gpu, verbose=verbose)
+        self.inference = Inference.create(self.model_data, gpu=gpu, verbose=verbose, backend=backend, precision=precision, calibration_images=calibration_images, calibration_box_data=box_data, shared_model=shared_model)
 
         self.converter = Converter(self.model_data.gripper_widths)
         self.checker = Checker(self.converter, avoid_collisions=avoid_collisions)
 
         self.typical_camera_distance = typical_camera_distance if typical_camera_distance is not None else 0.5
 
-        if box_data:
-            self.renderer = Renderer(box_data, self.typical_camera_distance, self.model_data.pixel_size, self.model_data.depth_diff)
-        else:
-            self.renderer = Renderer((752, 480), self.typical_camera_distance, self.model_data.pixel_size, self.model_data.depth_diff)
+        self.renderer_args = (box_data if box_data else (752, 480), self.typical_camera_distance, self.model_data.pixel_size, self.model_data.depth_diff)
+        self.renderer = self.create_renderer(*self.renderer_args)
+        self._reprojector = self.renderer if isinstance(self.renderer, SoftwareRenderer) else None
+
+        # Depth-only models don't need the color channels to be rendered and read back at all
+        self.depth_only = (self.inference.channels == 'D')
+
+        # Crop to the box and keep only the nearest point per pixel before rendering
+        self.pointcloud_filter = None
+        if filter_pointcloud:
+            self.pointcloud_filter = PointcloudFilter(
+                box_data=box_data,
+                min_depth=self.typical_camera_distance - self.model_data.depth_diff,
+                max_depth=self.typical_camera_distance,
+                pixel_size=self.model_data.pixel_size,
+                size=(self.renderer.width, self.renderer.height),
+                camera_position=self.renderer.camera_position,
+            )
 
         self.last_grasp_successful = True
 
-    def render(self, pointcloud: Pointcloud, pixel_size=None, min_depth=None, max_depth=None, position=[0.0, 0.0, 0.0]):
+        if warmup and box_data:
+            self.warmup()
+
+    def warmup(self, box_data: BoxData = None):
+        """Run the whole inference once on a blank image of the rendered size, so that the first grasp is not slower"""
+        image_shape = (self.renderer.height, self.renderer.width) if self.depth_only else (self.renderer.height, self.renderer.width, 4)
+        image = OrthographicImage(np.zeros(image_shape, dtype=np.uint16), self.model_data.pixel_size, self.typical_camera_distance - self.model_data.depth_diff, self.typical_camera_distance)
+        self.inference.warmup(image, box_data if box_data else self.box_data)
+
+    @staticmethod
+    def create_renderer(*args):
+        """Create the OpenGL renderer, or fall back to the CPU renderer if EGL is not available"""
+        try:
+            return Renderer(*args)
+        except RuntimeError as e:
+            logger.warning(f'{e}, use the software renderer instead.')
+            return SoftwareRenderer(*args)
+
+    @property
+    def reprojector(self) -> SoftwareRenderer:
+        """Depth images are reprojected into the orthographic image on the CPU, without a point cloud in between. Next to
+        an OpenGL renderer, the CPU renderer is only created on its first use."""
+        if self._reprojector is None:
+            self._reprojector = SoftwareRenderer(*self.renderer_args)
+        return self._reprojector
+
+    def render(self, pointcloud: Pointcloud, pixel_size=None, min_depth=None, max_depth=None, position=[0.0, 0.0, 0.0], camera_pose=None, out=None):
         pixel_size = pixel_size if pixel_size is not None else self.model_data.pixel_size
         min_depth = min_depth if min_depth is not None else self.typical_camera_distance - self.model_data.depth_diff
         max_depth = max_depth if max_depth is not None else self.typical_camera_distance
 
-        img = self.renderer.render_pointcloud_mat(pointcloud, pixel_size, min_depth, max_depth, position)
-        return self.convert_to_pillow_image(img)
+        # Render only the channels the model needs
+        render_pointcloud_mat = self.renderer.render_depth_pointcloud_mat if self.depth_only else self.renderer.render_pointcloud_mat
+        img = render_pointcloud_mat(pointcloud, pixel_size, min_depth, max_depth, position, camera_pose=camera_pose, out=out)
+        return self.convert_to_pillow_image(OrthographicImage(img, pixel_size, min_depth, max_depth))
 
-    def calculate_grasp(self, pointcloud: Pointcloud, camera_pose=None, box_data=None, gripper=None, method=None, return_image=False, channels='RGBD'):
-        image = self.renderer.render_pointcloud(pointcloud)
-        grasp = self.calculate_grasp_from_image(image, box_data=box_data, gripper=gripper, method=method)
+    def render_image(self, pointcloud: Union[Pointcloud, List[Pointcloud]], camera_pose=None, out: np.ndarray = None):
+        """Render the (optionally filtered) point cloud, or fuse a list of point clouds with a list of camera poses. The image
+        is newly allocated, unless it is rendered into the given (reused) array."""
+        if isinstance(pointcloud, (list, tuple)):
+            camera_poses = camera_pose if camera_pose is not None else [Affine()] * len(pointcloud)
+            if self.pointcloud_filter:
+                pointcloud = [self.filter_pointcloud(p, pose) for p, pose in zip(pointcloud, camera_poses)]
+
+            render_pointclouds = self.renderer.render_depth_pointclouds if self.depth_only else self.renderer.render_pointclouds
+            return render_pointclouds(pointcloud, camera_poses, out=out)
+
+        if self.pointcloud_filter:
+            pointcloud = self.filter_pointcloud(pointcloud, camera_pose)
+
+        render_pointcloud = self.renderer.render_depth_pointcloud if self.depth_only else self.renderer.render_pointcloud
+        return render_pointcloud(pointcloud, camera_pose=camera_pose, out=out)
+
+    def filter_pointcloud(self, pointcloud: Pointcloud, camera_pose=None):
+        self.pointcloud_filter.camera_pose = camera_pose
+        return self.pointcloud_filter.apply(pointcloud)
+
+    def calculate_grasp(self, pointcloud: Union[Pointcloud, List[Pointcloud]], camera_pose=None, box_data=None, gripper=None, method=None, roi=None, return_image=False, channels='RGBD', out: np.ndarray = None):
+        image = self.render_image(pointcloud, camera_pose, out=out)
+        grasp = self.calculate_grasp_from_image(image, box_data=box_data, gripper=gripper, method=method, roi=roi)
+
+        if return_image:
+            image = image.clone() if out is not None else image  # Don't draw into the caller's array
+            return grasp, self.draw_grasp_on_image(image, grasp, channels=channels)
+        return grasp
+
+    def reproject_image(self, depth: np.ndarray, intrinsics: CameraIntrinsics, extrinsics=None, color: np.ndarray = None, out: np.ndarray = None):
+        """Reproject the depth image (and the optional aligned RGB image) of a pinhole camera into the orthographic image"""
+        if self.depth_only:
+            return self.reprojector.reproject_depth_image(depth, intrinsics, camera_pose=extrinsics, out=out)
+        return self.reprojector.reproject_image(depth, intrinsics, color=color, camera_pose=extrinsics, out=out)
+
+    def calculate_grasp_from_depth(self, depth: np.ndarray, intrinsics: CameraIntrinsics, extrinsics=None, color: np.ndarray = None, box_data=None, gripper=None, method=None, roi=None, return_image=False, channels='RGBD', out: np.ndarray = None):
+        image = self.reproject_image(depth, intrinsics, extrinsics, color, out=out)
+        grasp = self.calculate_grasp_from_image(image, box_data=box_data, gripper=gripper, method=method, roi=roi)
 
         if return_image:
-            image = image.clone()
+            image = image.clone() if out is not None else image  # Don't draw into the caller's array
             return grasp, self.draw_grasp_on_image(image, grasp, channels=channels)
         return grasp
 
-    def calculate_grasp_from_image(self, image, box_data=None, gripper=None, method=None):
+    def calculate_grasp_from_image(self, image, box_data=None, gripper=None, method=None, roi=None):
+        """Calculate the best grasp, optionally only within a region of interest given as a mask of the image or as polygon in [m]"""
         box_data = box_data if box_data else self.box_data
         gripper = gripper if gripper else self.gripper
         selection_method = method if method else (Max() if self.last_grasp_successful else Top(5))
 
-        action_generator = self.inference.infer(image, selection_method, box_data=box_data)
+        action_generator = self.inference.infer(image, selection_method, box_data=box_data, roi=roi)
         grasp = self.checker.find_grasp(action_generator, image, box_data=box_data, gripper=self.gripper)
         self.last_grasp_successful = True
         return grasp
 
-    def calculate_heatmap(self, pointcloud: Pointcloud, box_data: BoxData = None, a_space=None):
-        pixel_size = self.model_data.pixel_size
-        min_depth = self.typical_camera_distance - self.model_data.depth_diff
-        max_depth = self.typical_camera_distance
-        position = [0.0, 0.0, 0.0]
-
-        img = self.renderer.render_pointcloud_mat(pointcloud, pixel_size, min_depth, max_depth, position)
-        return self.calculate_heatmap_from_image(img, box_data, a_space)
+    def calculate_heatmap(self, pointcloud: Union[Pointcloud, List[Pointcloud]], box_data: BoxData = None, a_space=None, camera_pose=None):
+        image = self.render_image(pointcloud, camera_pose)
+        return self.calculate_heatmap_from_image(image, box_data, a_space)
 
     def calculate_heatmap_from_image(self, image, box_data: BoxData = None, a_space=None):
         a_space = a_space if a_space is not None else [0.0]
         heatmapper = Heatmap(self.inference, a_space=a_space)
         heatmap = heatmapper.render(image, box_data=box_data)
+
+        from PIL import Image
         return Image.fromarray((heatmap[:, :, 2::-1]).astype(np.uint8))
 
     def report_grasp_failure(self):
@@ -91,6 +175,14 @@ class Griffig:
 
     @classmethod
     def convert_to_pillow_image(cls, image, channels='RGBD'):
+        from PIL import Image
+
+        if image.mat.ndim == 2:  # Depth-only images
+            return Image.fromarray(cv2.convertScaleAbs(image.mat, alpha=(255.0/65535.0)), 'L')
+
+        if image.mat.shape[2] == 3:
+            return Image.fromarray(cv2.convertScaleAbs(cv2.cvtColor(image.mat, cv2.COLOR_BGR2RGB), alpha=(255.0/65535.0)), 'RGB')
+
         mat = cv2.convertScaleAbs(cv2.cvtColor(image.mat, cv2.COLOR_BGRA2RGBA), alpha=(255.0/65535.0)).astype(np.uint8)
         pillow_image = Image.fromarray(mat, 'RGBA')
         if channels == 'RGB':
@@ -106,8 +198,8 @@ class Griffig:
 
     @classmethod
     def draw_grasp_on_image(cls, image, grasp, channels='RGBD', convert_to_rgb=True):
-        if channels == 'D' and convert_to_rgb:
-            image.mat = cv2.cvtColor(image.mat[:, :, 3], cv2.COLOR_GRAY2RGB)
+        if (channels == 'D' or image.mat.ndim == 2) and convert_to_rgb:
+            image.mat = cv2.cvtColor(image.mat if image.mat.ndim == 2 else image.mat[:, :, 3], cv2.COLOR_GRAY2RGB)
             channels = 'RGB'
 
         draw_pose(image, RobotPose(grasp.pose, d=grasp.stroke))
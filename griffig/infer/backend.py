@@ -0,0 +1,155 @@
+from enum import Enum
+import os
+from pathlib import Path
+from typing import Iterable, Optional
+
+from loguru import logger
+import numpy as np
+
+
+class Backend(str, Enum):
+    TensorFlow = 'tensorflow'  # Keras model as is
+    ONNX = 'onnx'  # Exported to ONNX, run with ONNX Runtime on the CPU
+    TFLite = 'tflite'  # Exported to TensorFlow Lite, run with the (standalone) TFLite interpreter
+
+
+class Precision(str, Enum):
+    FP32 = 'fp32'
+    FP16 = 'fp16'  # Weights quantized to half precision
+    INT8 = 'int8'  # Post-training quantization, calibrated on recorded input images
+
+
+def get_converted_path(path: Path, backend: Backend, precision: Precision, submodel=None) -> Path:
+    """The converted model is cached next to the original one"""
+    suffix = '.onnx' if Backend(backend) == Backend.ONNX else '.tflite'
+    return Path(path) / f'converted-{submodel or "model"}-{Precision(precision).value}{suffix}'
+
+
+def _as_inputs(x):
+    """The model inputs as float32 list, the semantic models take multiple inputs"""
+    return [np.asarray(i, dtype=np.float32) for i in (x if isinstance(x, (list, tuple)) else [x])]
+
+
+def _as_outputs(outputs):
+    return outputs[0] if len(outputs) == 1 else outputs
+
+
+def export_onnx(model, converted_path: Path, precision: Precision, calibration_data: Optional[Iterable] = None):
+    import onnx
+    import tensorflow as tf
+    import tf2onnx
+
+    precision = Precision(precision)
+    if precision == Precision.INT8 and calibration_data is None:
+        raise Exception('Int8 quantization needs calibration images.')
+
+    logger.info(f'Convert to ONNX with {precision.value} precision')
+    input_signature = [tf.TensorSpec(i.shape, tf.float32, name=f'input_{j}') for j, i in enumerate(model.inputs)]
+    onnx_model, _ = tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=13)
+
+    if precision == Precision.FP16:
+        from onnxconverter_common import float16
+
+        onnx_model = float16.convert_float_to_float16(onnx_model, keep_io_types=True)
+
+    if precision != Precision.INT8:
+        onnx.save(onnx_model, str(converted_path))
+        return
+
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, quantize_static
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = iter(calibration_data)
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return dict(zip([i.name for i in input_signature], _as_inputs(batch))) if batch is not None else None
+
+    # Activations and weights are quantized statically, with (de)quantization nodes around the float model
+    float_path = converted_path.with_suffix('.fp32.onnx')
+    onnx.save(onnx_model, str(float_path))
+    try:
+        quantize_static(str(float_path), str(converted_path), Reader(), quant_format=QuantFormat.QDQ)
+    finally:
+        float_path.unlink()
+
+
+def load_onnx(converted_path: Path):
+    """Returns the prediction function and the number of input channels"""
+    import onnxruntime as ort
+
+    session = ort.InferenceSession(str(converted_path), providers=['CPUExecutionProvider'])
+    input_names = [i.name for i in session.get_inputs()]
+
+    def predict(x):
+        return _as_outputs(session.run(None, dict(zip(input_names, _as_inputs(x)))))
+    return predict, session.get_inputs()[0].shape[-1]
+
+
+def export_tflite(model, converted_path: Path, precision: Precision, calibration_data: Optional[Iterable] = None):
+    import tensorflow as tf
+
+    precision = Precision(precision)
+    if precision == Precision.INT8 and calibration_data is None:
+        raise Exception('Int8 quantization needs calibration images.')
+
+    logger.info(f'Convert to TFLite with {precision.value} precision')
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if precision == Precision.FP16:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+
+    elif precision == Precision.INT8:
+        def representative_dataset():
+            for batch in calibration_data:
+                inputs = _as_inputs(batch)
+                for i in range(inputs[0].shape[0]):
+                    yield [x[i:i + 1] for x in inputs]
+
+        # Inputs and outputs are kept as float, so that the model is a drop-in replacement
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+
+    converted_path.write_bytes(converter.convert())
+
+
+def load_tflite(converted_path: Path):
+    """Returns the prediction function and the number of input channels"""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+
+    interpreter = Interpreter(model_path=str(converted_path), num_threads=os.cpu_count())
+    input_details = interpreter.get_input_details()
+    output_indices = [d['index'] for d in sorted(interpreter.get_output_details(), key=lambda d: d['name'])]
+    input_shapes = [None] * len(input_details)
+
+    def predict(x):
+        inputs = _as_inputs(x)
+
+        # The crop size depends on the box, so resize (and reallocate) only if the input shapes change
+        if any(shape != i.shape for shape, i in zip(input_shapes, inputs)):
+            for j, (detail, i) in enumerate(zip(input_details, inputs)):
+                interpreter.resize_tensor_input(detail['index'], i.shape)
+                input_shapes[j] = i.shape
+            interpreter.allocate_tensors()
+
+        for detail, i in zip(input_details, inputs):
+            interpreter.set_tensor(detail['index'], i)
+        interpreter.invoke()
+        return _as_outputs([interpreter.get_tensor(index) for index in output_indices])
+    return predict, input_details[0]['shape_signature'][-1]
+
+
+exporters = {
+    Backend.ONNX: export_onnx,
+    Backend.TFLite: export_tflite,
+}
+
+loaders = {
+    Backend.ONNX: load_onnx,
+    Backend.TFLite: load_tflite,
+}
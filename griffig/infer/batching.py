@@ -0,0 +1,131 @@
+from collections import deque
+from queue import Empty, Queue
+from threading import Event, Thread, local
+from time import perf_counter
+
+import numpy as np
+
+
+class BatchedModel:
+    """Collects concurrent calls of a model (e.g. from multiple Griffig instances in different threads) within a short
+    wait window, and runs their input images in a single forward pass. Calls are grouped by their input shape, as the
+    crop size depends on the box of each call. Can be used as a drop-in replacement for the model of an inference."""
+
+    class Request:
+        def __init__(self, x):
+            self.x = x
+            self.result = None
+            self.error = None
+            self.batch_size = 0
+            self.number_requests = 0
+            self.done = Event()
+
+    def __init__(self, model, channels: str = None, max_wait=0.005, max_batch_size=256, max_metrics=1000, start=True):
+        self.model = model
+        self.channels = channels  # Of the wrapped model, so that shared instances prepare the same input images
+        self.max_wait = max_wait  # [s]
+        self.max_batch_size = max_batch_size  # [images]
+
+        # Latency and batch size of the last requests, and of the last request of the calling thread
+        self.metrics = deque(maxlen=max_metrics)
+        self.local = local()
+
+        self.queue = Queue()
+        self.thread = Thread(target=self._run, daemon=True)
+        if start:
+            self.start()
+
+    def start(self):
+        """Starts running the requests, e.g. only after some were queued"""
+        self.thread.start()
+
+    @classmethod
+    def from_inference(cls, inference, **kwargs):
+        """Wraps the model of the inference, which is then replaced by the batched model"""
+        batched_model = cls(inference.model, channels=inference.channels, **kwargs)
+        inference.model = batched_model
+        return batched_model
+
+    @property
+    def last_metrics(self):
+        return getattr(self.local, 'metrics', None)
+
+    def __call__(self, x):
+        # Models with multiple inputs are not batched
+        if isinstance(x, (list, tuple)):
+            return self.model(x)
+
+        start = perf_counter()
+        request = self.Request(np.asarray(x))
+        self.queue.put(request)
+        request.done.wait()
+
+        metrics = {'latency': perf_counter() - start, 'batch_size': request.batch_size, 'requests': request.number_requests}
+        self.metrics.append(metrics)
+        self.local.metrics = metrics
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+
+        requests = [first]
+        size = len(first.x)
+        deadline = perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - perf_counter()
+
+            # Requests that are already waiting join the batch even after the deadline
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0.0 else self.queue.get_nowait()
+            except Empty:
+                break
+
+            if request is None:
+                self.queue.put(None)  # Finish this batch first
+                break
+
+            requests.append(request)
+            size += len(request.x)
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            if requests is None:
+                return
+
+            groups = {}
+            for request in requests:
+                groups.setdefault((request.x.shape[1:], request.x.dtype), []).append(request)
+
+            for group in groups.values():
+                self._predict(group)
+
+    def _predict(self, requests):
+        sizes = [len(r.x) for r in requests]
+        try:
+            x = np.concatenate([r.x for r in requests]) if len(requests) > 1 else requests[0].x
+            output = self.model(x)
+
+            splits = np.cumsum(sizes)[:-1]
+            outputs = [np.split(y, splits) for y in output] if isinstance(output, (list, tuple)) else [np.split(output, splits)]
+            for i, request in enumerate(requests):
+                request.result = [y[i] for y in outputs] if isinstance(output, (list, tuple)) else outputs[0][i]
+
+        except Exception as e:
+            for request in requests:
+                request.error = e
+
+        for request in requests:
+            request.batch_size = sum(sizes)
+            request.number_requests = len(requests)
+            request.done.set()
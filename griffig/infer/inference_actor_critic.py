@@ -1,7 +1,6 @@
 from time import time
 
 import numpy as np
-from scipy.ndimage import gaussian_filter
 
 from _griffig import BoxData, Grasp, Gripper, OrthographicImage
 from ..infer.inference_base import InferenceBase
@@ -9,10 +8,10 @@ from ..infer.selection import Method, Max
 
 
 class InferenceActorCritic(InferenceBase):
-    def infer(self, image: OrthographicImage, method: Method, box_data: BoxData = None, gripper: Gripper = None):
+    def infer(self, image: OrthographicImage, method: Method, box_data: BoxData = None, gripper: Gripper = None, roi=None):
         start = time()
 
-        input_images = self.get_input_images(image, box_data)
+        input_images = self.get_input_images(image, box_data, roi)
 
         pre_duration = time() - start
         start = time()
@@ -30,13 +29,15 @@ class InferenceActorCritic(InferenceBase):
 
         if gripper:
             possible_indices = gripper.consider_indices(self.model_data.gripper_widths)
-            for i in range(estimated_rewards.shape[0]):
-                self.set_last_dim_to_zero(estimated_rewards[i], np.invert(possible_indices))
+            self.set_last_dim_to_zero(estimated_rewards, np.invert(possible_indices))
 
         if self.gaussian_sigma:
-            for i in range(estimated_rewards.shape[0]):
-                for j in range(estimated_rewards.shape[1]):
-                    estimated_rewards[i][j] = gaussian_filter(estimated_rewards[i][j], self.gaussian_sigma)
+            self.smooth_rewards(estimated_rewards, leading_axes=2)
+
+        center = None
+        if roi is not None:
+            center = self.get_roi_center(image, roi)
+            estimated_rewards[:, np.invert(self.get_roi_reward_mask(estimated_rewards.shape[1:], image, roi))] = 0.0
 
         for _ in range(estimated_rewards.size):
             index_raveled = method(estimated_rewards)
@@ -44,7 +45,7 @@ class InferenceActorCritic(InferenceBase):
 
             action = Grasp()
             action.index = index[4]
-            action.pose = self.pose_from_index(index[1:], estimated_rewards.shape[1:], image)
+            action.pose = self.pose_from_index(index[1:], estimated_rewards.shape[1:], image, center=center)
             action.pose.z, action.pose.b, action.pose.c = action_from_actor[index[0], index[1], index[2], index[3]]
             action.estimated_reward = estimated_rewards[index]
             action.detail_durations = {
@@ -1,20 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import os
+from typing import List
 
 import cv2
 from loguru import logger
 import numpy as np
-import tensorflow.keras as tk
 
 from pyaffx import Affine
 from _griffig import BoxData, RobotPose, OrthographicImage
-from ..utility.image import draw_around_box, draw_around_box2, get_inference_image, get_box_projection
+from ..infer.backend import Backend, Precision, exporters, get_converted_path, loaders
+from ..utility.image import fill_around_box, get_box_geometry, get_inference_maps, get_roi_geometry
+from ..utility.model_data import get_channels
+from ..utility.startup_profile import profile
+
+
+# The images are rotated in parallel by a single thread pool shared by all inference instances
+executor = ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, 8), thread_name_prefix='griffig-rotate')
 
 
 class InferenceBase:
-    def __init__(self, model_data, gaussian_sigma=None, gpu: int = None, seed: int = None, verbose=0):
+    def __init__(
+        self,
+        model_data,
+        gaussian_sigma=None,
+        gpu: int = None,
+        seed: int = None,
+        verbose=0,
+        backend: Backend = Backend.TensorFlow,
+        precision: Precision = Precision.FP32,
+        calibration_images: List[OrthographicImage] = None,
+        calibration_box_data: BoxData = None,
+        shared_model=None,
+    ):
         self.model_data = model_data
-        self.model = self._load_model(model_data.path, 'grasp', gpu=gpu)
+        self.channels = model_data.channels or 'RGBD'  # Read from the input of the model once loaded, unless given explicitly
         self.gaussian_sigma = gaussian_sigma
         self.rs = np.random.default_rng(seed=seed)
         self.verbose = verbose
@@ -22,10 +42,32 @@ class InferenceBase:
         self.size_area_cropped = model_data.size_area_cropped
         self.size_result = model_data.size_result
         self.scale_factors = (self.size_area_cropped[0] / self.size_result[0], self.size_area_cropped[1] / self.size_result[1])
+
+        # The fully convolutional model maps a window of its training image size to a single reward, which moves by the
+        # stride (the resolution factor of the poses) per reward pixel
+        self.window = (self.size_result[0], self.size_result[1])
+        self.stride = 2
         self.a_space = np.linspace(-np.pi/2 + 0.1, np.pi/2 - 0.1, 20)  # [rad] # Don't use a=0.0 -> even number
         self.keep_indixes = None
 
-    def _load_model(self, path: Path, submodel=None, gpu=None):
+        # The rotated images are written into a preallocated buffer (reused by the next call)
+        self.rotated_buffer = None
+
+        # An already loaded model, e.g. a batched model shared by multiple instances
+        if shared_model is not None:
+            self.model = shared_model
+            self.channels = model_data.channels or getattr(shared_model, 'channels', None) or self.channels
+            return
+
+        # Calibration images are only needed (and converted to input images) when quantizing a model to int8
+        calibration_data = (self.get_input_images(image, calibration_box_data) for image in calibration_images) if calibration_images else None
+        with profile('load model'):
+            self.model = self._load_model(model_data.path, 'grasp', gpu=gpu, backend=backend, precision=precision, calibration_data=calibration_data)
+
+    def _load_keras_model(self, path: Path, submodel=None, gpu=None):
+        with profile('import tensorflow'):
+            import tensorflow.keras as tk
+
         if os.getenv('GRIFFIG_HARDWARE') == 'jetson-nano':
             import tensorflow as tf
             
@@ -47,6 +89,34 @@ class InferenceBase:
         if submodel:
             model = model.get_layer(submodel)
 
+        self._set_channels(model.inputs[0].shape[-1])
+        return model
+
+    def _set_channels(self, number_channels: int):
+        """Prepare the input images with the channels of the loaded model, unless they are given explicitly by the model data"""
+        if self.model_data.channels is None:
+            self.channels = get_channels(number_channels)
+        elif get_channels(number_channels) != self.model_data.channels:
+            logger.warning(f'Model has {number_channels} input channels, but use {self.model_data.channels} as given.')
+
+    def _load_model(self, path: Path, submodel=None, gpu=None, backend: Backend = Backend.TensorFlow, precision: Precision = Precision.FP32, calibration_data=None):
+        # Lighter CPU runtimes for a once converted (and optionally quantized) model, cached next to the model
+        backend = Backend(backend)
+        if backend != Backend.TensorFlow and os.getenv('GRIFFIG_HARDWARE') != 'jetson-nano':
+            converted_path = get_converted_path(path, backend, precision, submodel)
+            if not converted_path.exists():
+                model = self._load_keras_model(path, submodel, gpu=gpu)
+                exporters[backend](model, converted_path, precision, calibration_data)
+
+            predict, number_channels = loaders[backend](converted_path)
+            self._set_channels(number_channels)
+            return predict
+
+        if Precision(precision) != Precision.FP32:
+            logger.warning(f'The precision {Precision(precision).value} is only applied by the ONNX and TFLite backends, the TensorFlow backend ignores it.')
+
+        model = self._load_keras_model(path, submodel, gpu=gpu)
+
         # TensorRT
         use_tensorrt = os.getenv('GRIFFIG_HARDWARE') == 'jetson-nano'
         if use_tensorrt:
@@ -65,12 +135,14 @@ class InferenceBase:
                     # max_batch_size=32,
                 )
 
+                number_channels = 1 if self.channels == 'D' else 4
+
                 def my_input_fn():
                     # Let's assume a network with 2 input tensors. We generate 3 sets
                     # of dummy input data:
-                    input_shapes = [[(20, 110, 110, 4)], # min and max range for 1st input list
-                                    [(20, 110, 110, 4)], # min and max range for 2nd list of two tensors
-                                    [(20, 110, 110, 4)]] # 3rd input list
+                    input_shapes = [[(20, 110, 110, number_channels)], # min and max range for 1st input list
+                                    [(20, 110, 110, number_channels)], # min and max range for 2nd list of two tensors
+                                    [(20, 110, 110, number_channels)]] # 3rd input list
                     for shapes in input_shapes:
                         # return a list of input tensors
                         yield [np.zeros(x).astype(np.float32) for x in shapes]
@@ -96,49 +168,134 @@ class InferenceBase:
                 return output
             return predict
 
+        # Compiled once with the batch size and image size left open, so that a new box doesn't trigger a retracing
+        import tensorflow as tf
+
+        input_signature = [tf.TensorSpec((None,) * (len(i.shape) - 1) + (i.shape[-1],), tf.float32) for i in model.inputs]
+
+        @tf.function(input_signature=input_signature)
+        def compiled_model(*inputs):
+            return model(list(inputs) if len(inputs) > 1 else inputs[0], training=False)
+
         def predict(x):
-            return model.predict_on_batch(x)
+            inputs = x if isinstance(x, (list, tuple)) else [x]
+            output = compiled_model(*[tf.convert_to_tensor(np.asarray(i, dtype=np.float32)) for i in inputs])
+
+            if isinstance(output, (list, tuple)):
+                return [y.numpy() for y in output]
+            return output.numpy()
+
+        predict.compiled_model = compiled_model  # E.g. to check that new box sizes don't retrace
         return predict
 
+    def warmup(self, image: OrthographicImage, box_data: BoxData, repeat=2):
+        """Runs the preprocessing and the model on a (blank) image of the expected size, so that the first inference is as fast as the following ones"""
+        input_images = self.get_input_images(image, box_data)
+        for _ in range(repeat):
+            self.model(input_images)
+
     def _get_size_cropped(self, image, box_data: BoxData):
-        box_projection = get_box_projection(image, box_data)
+        box_projection, _ = get_box_geometry(image, box_data)
         center = np.array([image.mat.shape[1], image.mat.shape[0]]) / 2
         farthest_corner = np.max(np.linalg.norm(box_projection - center, axis=1))
         side_length = int(np.ceil(2 * farthest_corner * self.size_result[0] / self.size_area_cropped[0]))
         return (side_length, side_length)
 
-    def pose_from_index(self, index, index_shape, image: OrthographicImage, resolution_factor=2.0):
-        return Affine(
+    def _get_roi_crop(self, image, roi):
+        """The (smaller) crop size and its offset from the image center in pixels, so that the crop covers the region of interest in all rotations"""
+        _, center, radius = get_roi_geometry(image, roi)
+        side_length = max(int(np.ceil(2 * radius * self.size_result[0] / self.size_area_cropped[0])), self.size_result[0])
+        return (side_length, side_length), (image.mat.shape[1] / 2 - center[0], image.mat.shape[0] / 2 - center[1])
+
+    def get_roi_center(self, image: OrthographicImage, roi) -> Affine:
+        """The center of the crop around the region of interest relative to the image center"""
+        _, offset = self._get_roi_crop(image, roi)
+        return Affine(x=offset[1] / image.pixel_size, y=offset[0] / image.pixel_size)
+
+    def get_roi_reward_mask(self, index_shape, image: OrthographicImage, roi, resolution_factor=2.0):
+        """Whether the pose of each reward index (of the crop around the region of interest) lies within the region"""
+        mask, _, _ = get_roi_geometry(image, roi)
+        center = self.get_roi_center(image, roi)
+
+        # Same as pose_from_index, but vectorized over all indices
+        x = resolution_factor * self.scale_factors[0] * ((np.arange(index_shape[1]) + 0.5) - index_shape[1] / 2) / image.pixel_size
+        y = resolution_factor * self.scale_factors[1] * ((np.arange(index_shape[2]) + 0.5) - index_shape[2] / 2) / image.pixel_size
+        a = np.asarray(self.a_space)[:, np.newaxis, np.newaxis]
+        position_x = center.x - (np.cos(a) * x[:, np.newaxis] + np.sin(a) * y[np.newaxis, :])
+        position_y = center.y - (-np.sin(a) * x[:, np.newaxis] + np.cos(a) * y[np.newaxis, :])
+
+        cols = np.round(image.mat.shape[1] / 2 - image.pixel_size * position_y).astype(np.int64)
+        rows = np.round(image.mat.shape[0] / 2 - image.pixel_size * position_x).astype(np.int64)
+        inside = (cols >= 0) & (cols < mask.shape[1]) & (rows >= 0) & (rows < mask.shape[0])
+        inside[inside] = mask[rows[inside], cols[inside]]
+        return inside
+
+    def pose_from_index(self, index, index_shape, image: OrthographicImage, resolution_factor=2.0, center: Affine = None):
+        pose = Affine(
             x=resolution_factor * self.scale_factors[0] * image.position_from_index(index[1], index_shape[1]),
             y=resolution_factor * self.scale_factors[1] * image.position_from_index(index[2], index_shape[2]),
             a=self.a_space[index[0]],
         ).inverse()
+        return center * pose if center is not None else pose
+
+    def get_channel_image(self, image: OrthographicImage) -> OrthographicImage:
+        """Copy only the channels the model needs, so that they are the only ones rotated and normalized"""
+        if self.channels == 'D' and image.mat.ndim == 3:
+            return OrthographicImage(np.ascontiguousarray(image.mat[:, :, 3]), image.pixel_size, image.min_depth, image.max_depth, image.camera, image.pose)
+        return image.clone()
 
-    def get_input_images(self, orig_image, box_data: BoxData):
-        image = orig_image.clone()
-        size_cropped = self._get_size_cropped(orig_image, box_data)
+    def get_input_images(self, orig_image, box_data: BoxData, roi=None):
+        """The rotated and normalized input images of the model, optionally only of the crop around a region of interest.
+        The returned array is newly allocated, so that callers can keep it across calls (e.g. in a batched model)."""
+        if roi is not None:
+            size_cropped, offset = self._get_roi_crop(orig_image, roi)
+        else:
+            size_cropped, offset = self._get_size_cropped(orig_image, box_data), (0.0, 0.0)
 
         if box_data:
-            draw_around_box2(image, box_data)
+            # Copy the needed channels and fill around the (cached) box mask in a single pass
+            mat = orig_image.mat[:, :, 3] if self.channels == 'D' and orig_image.mat.ndim == 3 else orig_image.mat
+            image = OrthographicImage(fill_around_box(orig_image, box_data, mat), orig_image.pixel_size, orig_image.min_depth, orig_image.max_depth, orig_image.camera, orig_image.pose)
+        else:
+            image = self.get_channel_image(orig_image)
 
-        result_ = [get_inference_image(image, Affine(a=a), size_cropped, self.size_area_cropped, self.size_result, return_mat=True) for a in self.a_space]
+        rotated_shape = (len(self.a_space), size_cropped[1], size_cropped[0]) + image.mat.shape[2:]
+        if self.rotated_buffer is None or self.rotated_buffer.shape != rotated_shape or self.rotated_buffer.dtype != image.mat.dtype:
+            self.rotated_buffer = np.empty(rotated_shape, dtype=image.mat.dtype)
+
+        # The sampling maps are cached per geometry, so that rotating is only a lookup
+        maps = get_inference_maps(image, size_cropped, self.size_area_cropped, self.size_result, self.a_space, offset)
+
+        def rotate(i):
+            cv2.remap(image.mat, maps[i, 0], maps[i, 1], cv2.INTER_LINEAR, dst=self.rotated_buffer[i], borderMode=cv2.BORDER_REPLICATE)
+
+        for _ in executor.map(rotate, range(len(self.a_space))):
+            pass
 
         if self.verbose:
-            cv2.imwrite('/tmp/test-input-c.png', result_[10][:, :, 3])
-            cv2.imwrite('/tmp/test-input-d.png', result_[10][:, :, 3])
+            input_image = self.rotated_buffer[10] if self.rotated_buffer[10].ndim == 2 else self.rotated_buffer[10][:, :, 3]
+            cv2.imwrite('/tmp/test-input-c.png', input_image)
+            cv2.imwrite('/tmp/test-input-d.png', input_image)
+
+        # Convert and normalize in a single pass, without temporary arrays
+        input_images = np.empty(rotated_shape[:3] + (rotated_shape[3] if len(rotated_shape) > 3 else 1,), dtype=np.float32)
+        np.divide(self.rotated_buffer, np.iinfo(image.mat.dtype).max, out=input_images.reshape(rotated_shape), dtype=np.float32)
+        return input_images
 
-        result = np.array(result_, dtype=np.float32) / np.iinfo(image.mat.dtype).max
-        if len(result.shape) == 3:
-            result = np.expand_dims(result, axis=-1)
+    def smooth_rewards(self, rewards, leading_axes=1) -> None:
+        """Smooth the rewards in place with a single filter call, over all but the leading (e.g. rotation) axes"""
+        from scipy.ndimage import gaussian_filter
 
-        return result
+        sigma = (0.0,) * leading_axes + (self.gaussian_sigma,) * (rewards.ndim - leading_axes)
+        gaussian_filter(rewards, sigma, output=rewards)
 
     @classmethod
     def keep_array_at_last_indixes(cls, array, indixes) -> None:
-        mask = np.zeros(array.shape)
-        mask[:, :, :, indixes] = 1
-        array *= mask
+        keep = np.zeros(array.shape[-1], dtype=bool)
+        keep[indixes] = True
+        array[..., np.invert(keep)] = 0
 
     @classmethod
     def set_last_dim_to_zero(cls, array, indixes):
-        array[:, :, :, indixes] = 0
+        """Broadcasts over all leading axes"""
+        array[..., indixes] = 0
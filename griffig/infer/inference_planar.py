@@ -1,8 +1,8 @@
 from time import time
 
 import cv2
+from loguru import logger
 import numpy as np
-from scipy.ndimage import gaussian_filter
 
 from _griffig import BoxData, Grasp, Gripper, OrthographicImage
 from ..infer.inference_base import InferenceBase
@@ -11,33 +11,179 @@ from ..utility.image import draw_around_box2, get_box_projection, get_inference_
 
 
 class InferencePlanar(InferenceBase):
-    def infer(self, image: OrthographicImage, method: Method, box_data: BoxData = None, gripper: Gripper = None):
+    def __init__(self, *args, coarse_step: int = None, fine_candidates: int = 1, pyramid_factor: int = None, pyramid_candidates: int = 8, pyramid_region: int = 6, pyramid_model=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Coarse-to-fine rotation search: evaluate every coarse_step-th rotation first, and then only the rotations
+        # around the best fine_candidates coarse rotations. Disabled for None.
+        self.coarse_step = coarse_step
+        self.fine_candidates = fine_candidates
+
+        # Pyramid inference: evaluate all rotations at every pyramid_factor-th reward pixel first, and then densely only
+        # in pyramid_candidates regions (of +- pyramid_region reward pixels) around the best ones. The coarse level is
+        # either evaluated sparsely by the model itself, or by a pyramid_model trained at the coarse pixel size (the
+        # pixel size divided by pyramid_factor) on downscaled images. Disabled for None.
+        self.pyramid_factor = pyramid_factor
+        self.pyramid_candidates = pyramid_candidates
+        self.pyramid_region = pyramid_region
+        self.pyramid_model = pyramid_model
+
+    def search_rotations(self, input_images, possible_indices=None):
+        """Runs the model on a subset of the rotated images, the rewards of rotations not evaluated are set to zero"""
+        number_rotations = input_images.shape[0]
+        rotations = np.arange(number_rotations)
+        coarse_indices = np.arange(min(self.coarse_step // 2, (number_rotations - 1) // 2), number_rotations, self.coarse_step)
+        coarse_reward = self.model(input_images[coarse_indices])
+
+        # Rank the coarse rotations by their best reward of the considered gripper strokes
+        ranked_reward = coarse_reward[..., self.get_considered_indices(coarse_reward.shape[-1], possible_indices)]
+        best_indices = coarse_indices[np.argsort(ranked_reward.reshape(len(coarse_indices), -1).max(axis=1))[::-1][:self.fine_candidates]]
+
+        # All rotations (also at the ends, if the number of rotations is not divisible by the step) that are at least
+        # as close to one of the best as to any other coarse rotation
+        distances = np.abs(rotations[:, np.newaxis] - coarse_indices[np.newaxis, :])
+        is_fine = (distances[:, np.isin(coarse_indices, best_indices)] == distances.min(axis=1, keepdims=True)).any(axis=1)
+        fine_indices = np.setdiff1d(rotations[is_fine], coarse_indices)
+
+        estimated_reward = np.zeros((number_rotations,) + coarse_reward.shape[1:], dtype=coarse_reward.dtype)
+        estimated_reward[coarse_indices] = coarse_reward
+        if len(fine_indices) > 0:
+            estimated_reward[fine_indices] = self.model(input_images[fine_indices])
+        return estimated_reward
+
+    def get_considered_indices(self, number_strokes, possible_indices=None):
+        """Mask of the gripper strokes that are both possible for the gripper and kept"""
+        considered = np.ones(number_strokes, dtype=bool)
+        if possible_indices is not None:
+            considered &= np.asarray(possible_indices, dtype=bool)
+        if self.keep_indixes is not None:
+            self.keep_array_at_last_indixes(considered, self.keep_indixes)
+        return considered
+
+    def search_pyramid(self, input_images, possible_indices=None):
+        """Evaluates the rewards at a coarse level first to find promising regions, and then at full resolution only
+        on crops around them. The refined rewards are stitched into the full reward shape, all other rewards are set to
+        zero. Without a pyramid model, the coarse level runs the model on a single window per coarse reward, which is
+        only cheaper than the full inference for factors larger than window / stride. Otherwise, the full inference is
+        run instead."""
+        number_rotations, height, width = input_images.shape[:3]
+        window, stride, factor = self.window, self.stride, self.pyramid_factor
+
+        # Output size of the fully convolutional model without padding
+        full_shape = ((height - window[0]) // stride + 1, (width - window[1]) // stride + 1)
+        if min(full_shape) < 1:
+            logger.warning(f'Input images of size {height}x{width} are smaller than the model window, use full inference instead.')
+            return self.model(input_images)
+
+        # Each sparse coarse reward needs its whole input window, so that the coarse level costs (window / stride / factor)^2
+        # of the full inference
+        if self.pyramid_model is None and factor <= max(window) // stride:
+            logger.warning(f'Without a pyramid model, the pyramid factor {factor} needs to be larger than {max(window) // stride} to save computation, use full inference instead.')
+            return self.model(input_images)
+
+        if self.pyramid_model is not None:
+            # The coarse model sees the same window at a factor times larger pixel size
+            size_coarse = (width // factor, height // factor)
+            coarse_images = np.stack([cv2.resize(i, size_coarse, interpolation=cv2.INTER_AREA) for i in input_images]).reshape((number_rotations, size_coarse[1], size_coarse[0], -1))
+            coarse_reward = self.pyramid_model(coarse_images)
+
+            coarse_shape = ((size_coarse[1] - window[0]) // stride + 1, (size_coarse[0] - window[1]) // stride + 1)
+            if coarse_reward.shape[1:3] != coarse_shape:
+                logger.warning(f'Pyramid model output of shape {coarse_reward.shape[1:3]} does not match the expected {coarse_shape}, use full inference instead.')
+                return self.model(input_images)
+
+            # The full resolution reward pixel with the same center of its input window
+            rows, cols = [np.clip(np.round((factor * (stride * np.arange(n) + w / 2) - w / 2) / stride).astype(np.int64), 0, m - 1) for n, w, m in zip(coarse_shape, window, full_shape)]
+
+        else:
+            # The model evaluated on the input windows of every factor-th full resolution reward pixel only
+            rows, cols = [np.arange(min(factor // 2, (m - 1) // 2), m, factor) for m in full_shape]
+            windows = np.lib.stride_tricks.sliding_window_view(input_images, window, axis=(1, 2))[:, stride * rows[:, np.newaxis], stride * cols[np.newaxis, :]]
+            windows = np.moveaxis(windows, 3, -1).reshape((-1,) + window + input_images.shape[3:])
+            coarse_reward = self.model(windows)
+
+            if coarse_reward.shape[1:3] != (1, 1):
+                logger.warning(f'Model output of shape {coarse_reward.shape[1:3]} for a single window is not a single reward, use full inference instead.')
+                return self.model(input_images)
+            coarse_reward = coarse_reward.reshape((number_rotations, len(rows), len(cols)) + coarse_reward.shape[3:])
+
+        score = coarse_reward[..., self.get_considered_indices(coarse_reward.shape[-1], possible_indices)].max(axis=-1)
+        region_shape = (min(2 * self.pyramid_region + 1, full_shape[0]), min(2 * self.pyramid_region + 1, full_shape[1]))
+        coarse_region = int(np.ceil(self.pyramid_region / factor))
+
+        def region_start(centers, index, size, full_size):
+            """The region around the center, extended to the border (while keeping its center) for the outermost coarse
+            rewards, as their rewards represent all rewards up to the border"""
+            start = centers[index] - self.pyramid_region
+            if index == 0:
+                start = max(min(start, 0), centers[index] - size + 1)
+            if index == len(centers) - 1:
+                start = min(max(start, full_size - size), centers[index])
+            return int(np.clip(start, 0, full_size - size))
+
+        regions = []
+        for _ in range(min(self.pyramid_candidates, score.size)):
+            r, i, j = np.unravel_index(np.argmax(score), score.shape)
+            if score[r, i, j] == -np.inf:
+                break
+
+            regions.append((r, region_start(rows, i, region_shape[0], full_shape[0]), region_start(cols, j, region_shape[1], full_shape[1])))
+
+            # Suppress all coarse rewards within the region (non-maximum suppression)
+            score[r, max(i - coarse_region, 0):i + coarse_region + 1, max(j - coarse_region, 0):j + coarse_region + 1] = -np.inf
+
+        crop_shape = (stride * (region_shape[0] - 1) + window[0], stride * (region_shape[1] - 1) + window[1])
+        crops = np.stack([input_images[r, stride * i0:stride * i0 + crop_shape[0], stride * j0:stride * j0 + crop_shape[1]] for r, i0, j0 in regions])
+        fine_reward = self.model(crops)
+
+        if fine_reward.shape[1:3] != region_shape:
+            logger.warning(f'Model output of shape {fine_reward.shape[1:3]} for the regions does not match the expected {region_shape}, use full inference instead.')
+            return self.model(input_images)
+
+        estimated_reward = np.zeros((number_rotations,) + full_shape + fine_reward.shape[3:], dtype=fine_reward.dtype)
+        for (r, i0, j0), reward in zip(regions, fine_reward):
+            estimated_reward[r, i0:i0 + region_shape[0], j0:j0 + region_shape[1]] = reward
+        return estimated_reward
+
+    def infer(self, image: OrthographicImage, method: Method, box_data: BoxData = None, gripper: Gripper = None, roi=None):
         start = time()
-        input_images = self.get_input_images(image, box_data)
+        input_images = self.get_input_images(image, box_data, roi)
 
         pre_duration = time() - start
         start = time()
 
-        estimated_reward = self.model(input_images)
-        
+        possible_indices = gripper.consider_indices(self.model_data.gripper_widths) if gripper else None
+        if self.pyramid_factor:
+            estimated_reward = self.search_pyramid(input_images, possible_indices)
+        elif self.coarse_step:
+            estimated_reward = self.search_rotations(input_images, possible_indices)
+        else:
+            estimated_reward = self.model(input_images)
+
         nn_duration = time() - start
         start = time()
 
         if self.gaussian_sigma:
-            for i in range(estimated_reward.shape[0]):
-                estimated_reward[i] = gaussian_filter(estimated_reward[i], self.gaussian_sigma)
+            self.smooth_rewards(estimated_reward)
 
         if gripper:
-            possible_indices = gripper.consider_indices(self.model_data.gripper_widths)
             self.set_last_dim_to_zero(estimated_reward, np.invert(possible_indices))
 
+        if self.keep_indixes is not None:
+            self.keep_array_at_last_indixes(estimated_reward, self.keep_indixes)
+
+        center = None
+        if roi is not None:
+            center = self.get_roi_center(image, roi)
+            estimated_reward[np.invert(self.get_roi_reward_mask(estimated_reward.shape, image, roi))] = 0.0
+
         for _ in range(estimated_reward.size):
             index_raveled = method(estimated_reward)
             index = np.unravel_index(index_raveled, estimated_reward.shape)
 
             action = Grasp()
             action.index = index[3]
-            action.pose = self.pose_from_index(index, estimated_reward.shape, image)
+            action.pose = self.pose_from_index(index, estimated_reward.shape, image, center=center)
             action.pose.z = np.nan
             action.estimated_reward = estimated_reward[index]
             action.detail_durations = {
@@ -2,7 +2,6 @@ from time import time
 
 import cv2
 import numpy as np
-from scipy.ndimage import gaussian_filter
 
 from pyaffx import Affine
 from _griffig import BoxData, Grasp, Gripper, OrthographicImage
@@ -12,15 +11,25 @@ from ..utility.image import draw_around_box2, get_box_projection, get_inference_
 
 
 class InferencePlanarSemantic(InferenceBase):
+    def get_input_object_images(self, object_image: OrthographicImage):
+        input_object_images = [get_inference_image(object_image, Affine(a=a), (224, 224), (224, 224), (224, 224), return_mat=True) for a in self.a_space]
+        return np.array(input_object_images) / np.iinfo(object_image.mat.dtype).max
+
+    def warmup(self, image: OrthographicImage, box_data: BoxData, object_image: OrthographicImage = None, repeat=2):
+        """Runs the preprocessing and the model on (blank) images of the expected size, so that the first inference is as fast as the following ones"""
+        object_image = object_image if object_image is not None else OrthographicImage(np.zeros_like(image.mat), image.pixel_size, image.min_depth, image.max_depth)
+        input_images = self.get_input_images(image, box_data)
+        input_object_images = self.get_input_object_images(object_image)
+        for _ in range(repeat):
+            self.model([input_images, [input_object_images]])
+
     def infer(self, image: OrthographicImage, object_image: OrthographicImage, method: Method, box_data: BoxData = None, gripper: Gripper = None):
         assert object_image is not None
 
         start = time()
 
         input_images = self.get_input_images(image, box_data)
-        input_object_images = [get_inference_image(object_image, Affine(a=a), (224, 224), (224, 224), (224, 224), return_mat=True) for a in self.a_space]
-
-        input_object_images = np.array(input_object_images) / np.iinfo(object_image.mat.dtype).max
+        input_object_images = self.get_input_object_images(object_image)
 
         pre_duration = time() - start
         start = time()
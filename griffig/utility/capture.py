@@ -0,0 +1,94 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from pyaffx import Affine
+from _griffig import Pointcloud, PointType
+
+
+class CaptureWriter:
+    """Records point clouds (and their camera poses) into a directory with a single raw data file and the metadata as
+    json, so that they can be replayed without any camera library."""
+
+    alignment = 64  # [bytes]
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.data_file = open(self.path / 'data.bin', 'wb')
+        self.scenes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_buffer(self, array):
+        self.data_file.write(b'\0' * (-self.data_file.tell() % self.alignment))
+
+        offset = self.data_file.tell()
+        array = np.ascontiguousarray(array)
+        self.data_file.write(array.data)
+        return [offset, array.nbytes]
+
+    def write(self, pointcloud: Pointcloud, camera_pose: Affine = None):
+        scene = {
+            'point_type': pointcloud.point_type.name,
+            'vertices': self._write_buffer(pointcloud.vertices),
+            'camera_pose': [camera_pose.x, camera_pose.y, camera_pose.z, camera_pose.a, camera_pose.b, camera_pose.c] if camera_pose is not None else None,
+        }
+
+        if pointcloud.texture is not None:
+            scene['texture'] = self._write_buffer(pointcloud.texture)
+            scene['texture_size'] = [pointcloud.width, pointcloud.height]
+            scene['tex_coords'] = self._write_buffer(pointcloud.tex_coords)
+
+        self.scenes.append(scene)
+
+    def close(self):
+        if self.data_file.closed:
+            return
+
+        self.data_file.close()
+        with open(self.path / 'metadata.json', 'w') as write_file:
+            json.dump({'version': 1, 'scenes': self.scenes}, write_file)
+
+
+class CaptureReader:
+    """Replays a capture by memory-mapping its data file, the point clouds reference the mapped pages directly."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+        with open(self.path / 'metadata.json', 'r') as read_file:
+            self.scenes = json.load(read_file)['scenes']
+
+        data_path = self.path / 'data.bin'
+        self.data = np.memmap(data_path, dtype=np.uint8, mode='r') if data_path.stat().st_size > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def _get_buffer(self, buffer):
+        offset, size = buffer
+        return self.data[offset:offset + size]
+
+    def __getitem__(self, index: int):
+        """Returns the point cloud and its camera pose (or None)"""
+        scene = self.scenes[index]
+
+        texture, tex_coords = None, None
+        if 'texture' in scene:
+            width, height = scene['texture_size']
+            texture = self._get_buffer(scene['texture']).reshape(height, width, 3)
+            tex_coords = self._get_buffer(scene['tex_coords'])
+
+        pointcloud = Pointcloud(points=self._get_buffer(scene['vertices']), type=PointType.__members__[scene['point_type']], texture=texture, tex_coords=tex_coords)
+        camera_pose = Affine(*scene['camera_pose']) if scene['camera_pose'] is not None else None
+        return pointcloud, camera_pose
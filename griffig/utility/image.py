@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Any, List, Sequence, Tuple, Optional, Union
 
 import cv2
@@ -87,6 +88,7 @@ def get_inference_image(
         size_area_cropped: Tuple[float, float],
         size_area_result: Tuple[float, float],
         return_mat=False,
+        dst=None,
     ) -> OrthographicImage:
     size_input = (image.mat.shape[1], image.mat.shape[0])
     center_image = (size_input[0] / 2, size_input[1] / 2)
@@ -101,7 +103,7 @@ def get_inference_image(
         scale=scale,
         cropped=(size_cropped[0] / scale, size_cropped[1] / scale),
     )
-    mat_result = cv2.warpAffine(image.mat, trans, size_cropped, borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_AREA)
+    mat_result = cv2.warpAffine(image.mat, trans, size_cropped, dst=dst, borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_AREA)
     if return_mat:
         return mat_result
 
@@ -117,6 +119,68 @@ def get_inference_image(
     )
 
 
+@lru_cache(maxsize=8)
+def _get_inference_maps(
+        size_input: Tuple[int, int],
+        size_cropped: Tuple[int, int],
+        size_area_cropped: Tuple[float, float],
+        size_area_result: Tuple[float, float],
+        a_space: Tuple[float, ...],
+    ):
+    center_image = (size_input[0] / 2, size_input[1] / 2)
+    scale = size_area_result[0] / size_area_cropped[0]
+
+    xs, ys = np.meshgrid(np.arange(size_cropped[0], dtype=np.float64), np.arange(size_cropped[1], dtype=np.float64))
+    maps = np.empty((len(a_space), 2, size_cropped[1], size_cropped[0]), dtype=np.float32)
+    for i, a in enumerate(a_space):
+        trans = get_transformation(0.0, 0.0, a, center_image, scale=scale, cropped=(size_cropped[0] / scale, size_cropped[1] / scale))
+        inverse = cv2.invertAffineTransform(trans)
+        maps[i, 0] = inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]
+        maps[i, 1] = inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2]
+
+    maps.setflags(write=False)
+    return maps
+
+
+def get_inference_maps(
+        image: OrthographicImage,
+        size_cropped: Tuple[int, int],
+        size_area_cropped: Tuple[float, float],
+        size_area_result: Tuple[float, float],
+        a_space: Sequence[float],
+        offset: Tuple[float, float] = (0.0, 0.0),
+    ):
+    """The sampling maps (x and y per angle) of get_inference_image around the image center (or shifted by the offset
+    in pixels), to be applied with cv2.remap. As they depend only on the geometry, they are cached per image size, crop
+    size, areas and angles. An offset (e.g. of a moving region of interest) translates the cached maps."""
+    size_input = (image.mat.shape[1], image.mat.shape[0])
+    maps = _get_inference_maps(size_input, tuple(size_cropped), tuple(size_area_cropped), tuple(size_area_result), tuple(float(a) for a in a_space))
+    if offset[0] == 0.0 and offset[1] == 0.0:
+        return maps
+
+    # Rotating around the shifted center is the same as sampling the rotated crop at shifted source pixels
+    return maps - np.array([offset[0], offset[1]], dtype=np.float32)[:, np.newaxis, np.newaxis]
+
+
+def get_roi_geometry(image: OrthographicImage, roi):
+    """The mask, the center (col, row) and the radius of the enclosing circle in pixels of a region of interest, given
+    either as a mask of the image or as a polygon of (x, y) points in [m]. The center is rounded to a pixel."""
+    roi = np.asarray(roi)
+    if roi.shape == image.mat.shape[:2]:
+        mask = roi.astype(bool)
+        points = cv2.findNonZero(mask.astype(np.uint8))
+        if points is None:
+            raise Exception('The region of interest is empty.')
+    else:
+        points = np.stack([image.mat.shape[1] / 2 - image.pixel_size * roi[:, 1], image.mat.shape[0] / 2 - image.pixel_size * roi[:, 0]], axis=-1)
+        mask = np.zeros(image.mat.shape[:2], dtype=np.uint8)
+        cv2.fillPoly(mask, [np.round(points).astype(np.int32)], 1)
+        mask = mask.astype(bool)
+
+    (col, row), radius = cv2.minEnclosingCircle(points.reshape(-1, 2).astype(np.float32))
+    return mask, (int(round(col)), int(round(row))), radius + 1.0
+
+
 def _get_rect_contour(center: Sequence[float], size: Sequence[float]) -> List[Sequence[float]]:
     return [
         [center[0] + size[0] / 2, center[1] + size[1] / 2, size[2]],
@@ -134,6 +198,52 @@ def get_box_projection(image: OrthographicImage, box_data: BoxData):
     return [image.project(p) for p in box_border]
 
 
+@lru_cache(maxsize=32)
+def _get_box_geometry(contour: Tuple[Tuple[float, float, float]], shape: Tuple[int, int], pixel_size: float):
+    def project(points):
+        points = np.asarray(points, dtype=np.float64)
+        projection = np.stack([shape[1] // 2 - pixel_size * points[:, 1], shape[0] // 2 - pixel_size * points[:, 0]], axis=-1)
+        return (np.sign(projection) * np.floor(np.abs(projection) + 0.5)).astype(np.int32)  # Rounded like OrthographicImage.project
+
+    box_projection = project(contour)
+    image_border_projection = project(_get_rect_contour([0.0, 0.0, 0.0], [10.0, 10.0, contour[0][2]]))
+
+    mask = np.zeros(shape, dtype=np.uint8)
+    cv2.fillPoly(mask, [image_border_projection, box_projection], 1)
+    mask = mask.astype(bool)
+
+    box_projection.setflags(write=False)
+    mask.setflags(write=False)
+    return box_projection, mask
+
+
+def get_box_geometry(image: OrthographicImage, box_data: BoxData):
+    """The projected box contour and the mask of the area around the box (same as filled by draw_around_box2). As the box
+    is usually static, both are cached per box, image size and pixel size."""
+    contour = tuple(tuple(p) for p in box_data.contour)
+    return _get_box_geometry(contour, tuple(image.mat.shape[:2]), image.pixel_size)
+
+
+def fill_around_box(image: OrthographicImage, box_data: BoxData, mat=None):
+    """Returns a copy of the mat (by default the image mat, or e.g. a channel view of it) with the area around the box
+    filled with the mean color of the box corners. Same result as cloning and draw_around_box2, but in a single pass."""
+    mat = mat if mat is not None else image.mat
+    box_projection, mask = get_box_geometry(image, box_data)
+
+    cm = get_color_scale(mat.dtype)
+    color_array = mat[np.clip(box_projection[:, 1], 0, mat.shape[0] - 1), np.clip(box_projection[:, 0], 0, mat.shape[1] - 1)].astype(np.float32)
+    if len(color_array.shape) > 1:
+        color_array[np.mean(color_array, axis=1) < cm] = np.nan
+    else:
+        color_array[color_array < cm] = np.nan
+
+    color = np.nan_to_num(np.nanmean(color_array, axis=0))
+    if np.issubdtype(mat.dtype, np.integer):
+        color = np.rint(color)
+
+    return np.where(mask if mat.ndim == 2 else mask[:, :, np.newaxis], color.astype(mat.dtype), mat)
+
+
 def draw_line(
         image: OrthographicImage,
         action_pose: Affine,
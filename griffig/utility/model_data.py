@@ -15,6 +15,15 @@ class ModelArchitecture(str, Enum):
     NonFCNPlanar = 'non-fcn-planar'  # Non-fully-convolutional planar
 
 
+def get_channels(number_channels: int) -> str:
+    """The image channels of a model input with the given number of channels"""
+    if number_channels == 1:
+        return 'D'
+    if number_channels == 4:
+        return 'RGBD'
+    raise Exception(f'Model input with {number_channels} channels is not supported.')
+
+
 class ModelData:
     def __init__(
         self,
@@ -32,6 +41,7 @@ class ModelData:
         input_type = None,
         output = None,
         version = None,
+        channels: str = None,
     ):
         self.name = name
         self.path = path
@@ -47,6 +57,7 @@ class ModelData:
         self.input_type = input_type
         self.output = output
         self.version = version
+        self.channels = channels  # 'D' or 'RGBD' to override the input channels read from the loaded model
 
     def to_dict(self):
         return self.__dict__
@@ -6,8 +6,6 @@ from tempfile import NamedTemporaryFile
 from typing import Union
 from urllib.request import urlopen
 
-import requests
-
 from .model_data import ModelArchitecture, ModelData
 
 
@@ -26,6 +24,8 @@ class ModelLibrary:
         if isinstance(model_path, str):
             matched_model_globs = glob.glob(str(cls.tmp_path / f'{name}-v*'))
             if not matched_model_globs:
+                import requests
+
                 try:
                     r = requests.get(url=cls.remote_url + name, timeout=1.0)  # [s]
                 except requests.exceptions.Timeout as e:
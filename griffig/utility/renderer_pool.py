@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+from queue import Queue
+
+from _griffig import Renderer
+
+
+class RendererPool:
+    """A fixed number of renderers, each with its own OpenGL context. A renderer is handed out to a single thread
+    at a time, so that several cells or camera streams can render concurrently (the bindings release the GIL)."""
+
+    def __init__(self, number_renderers: int, *args, renderer_type=Renderer):
+        self.renderers = Queue()
+        for _ in range(number_renderers):
+            self.renderers.put(renderer_type(*args))
+
+    def __len__(self):
+        return self.renderers.qsize()
+
+    @contextmanager
+    def acquire(self, timeout=None):
+        """Blocks until a renderer is free, and returns it to the pool afterwards"""
+        renderer = self.renderers.get(timeout=timeout)
+        try:
+            yield renderer
+        finally:
+            self.renderers.put(renderer)
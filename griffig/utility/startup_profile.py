@@ -0,0 +1,16 @@
+from contextlib import contextmanager
+from time import perf_counter
+
+
+# The durations of the (deferred) imports and the model load, in the order they happened [s]
+startup_profile = {}
+
+
+@contextmanager
+def profile(name: str):
+    """Records the duration of the first call only, later ones are served from the module cache anyway"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        startup_profile.setdefault(name, perf_counter() - start)
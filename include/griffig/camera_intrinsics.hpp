@@ -0,0 +1,13 @@
+#pragma once
+
+
+//! The intrinsics of a pinhole camera, for reprojecting its depth images
+struct CameraIntrinsics {
+    //! Focal lengths and principal point [px]
+    double fx, fy, cx, cy;
+
+    //! Scale from depth image values to meters, e.g. millimeters for the RealSense cameras
+    double depth_scale {0.001};
+
+    explicit CameraIntrinsics(double fx, double fy, double cx, double cy, double depth_scale = 0.001): fx(fx), fy(fy), cx(cx), cy(cy), depth_scale(depth_scale) { }
+};
@@ -1,9 +1,15 @@
 #pragma once
 
 #include <griffig/box_data.hpp>
+#include <griffig/camera_intrinsics.hpp>
 #include <griffig/grasp.hpp>
 #include <griffig/gripper.hpp>
 #include <griffig/orthographic_image.hpp>
+#include <griffig/parallel.hpp>
 #include <griffig/pointcloud.hpp>
+#include <griffig/pointcloud2.hpp>
+#include <griffig/pointcloud_filter.hpp>
 #include <griffig/renderer.hpp>
 #include <griffig/robot_pose.hpp>
+#include <griffig/software_renderer.hpp>
+#include <griffig/texture.hpp>
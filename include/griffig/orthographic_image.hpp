@@ -43,6 +43,9 @@ public:
     pose = image.pose;
   }
 
+  // Moves (e.g. into Python) keep the image data instead of cloning it
+  OrthographicImage(OrthographicImage&& image) = default;
+
   double depthFromValue(double value) const {
     return max_depth + (value / max_value) * (min_depth - max_depth);
   }
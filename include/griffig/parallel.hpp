@@ -0,0 +1,65 @@
+#pragma once
+
+#include <algorithm>
+#include <numeric>
+#include <thread>
+#include <vector>
+
+
+//! Split the range [0, size) into contiguous chunks, and call f(begin, end) for each chunk on its own thread
+template<class F>
+void parallel_for(size_t size, F&& f, size_t min_chunk_size = 16384) {
+    const size_t max_threads = std::max<size_t>(std::thread::hardware_concurrency(), 1);
+    const size_t number_threads = std::clamp<size_t>(size / std::max<size_t>(min_chunk_size, 1), 1, max_threads);
+    if (number_threads == 1) {
+        f(size_t {0}, size);
+        return;
+    }
+
+    const size_t chunk_size = (size + number_threads - 1) / number_threads;
+
+    std::vector<std::thread> threads;
+    threads.reserve(number_threads - 1);
+    for (size_t t = 1; t < number_threads; ++t) {
+        const size_t begin = std::min(t * chunk_size, size);
+        const size_t end = std::min(begin + chunk_size, size);
+        threads.emplace_back([&f, begin, end] { f(begin, end); });
+    }
+
+    f(size_t {0}, std::min(chunk_size, size));
+
+    for (auto& thread: threads) {
+        thread.join();
+    }
+}
+
+
+//! Collect all indices of [0, size) that pass keep(i) in order, by counting and then writing each chunk in parallel
+template<class F>
+std::vector<size_t> parallel_compact(size_t size, F&& keep) {
+    const size_t number_chunks = 4 * std::max<size_t>(std::thread::hardware_concurrency(), 1);
+    const size_t chunk_size = (size + number_chunks - 1) / number_chunks;
+
+    std::vector<size_t> offsets (number_chunks + 1, 0);
+    parallel_for(number_chunks, [&](size_t begin, size_t end) {
+        for (size_t c = begin; c < end; ++c) {
+            for (size_t i = c * chunk_size; i < std::min((c + 1) * chunk_size, size); ++i) {
+                offsets[c + 1] += keep(i) ? 1 : 0;
+            }
+        }
+    }, 1);
+    std::partial_sum(offsets.begin(), offsets.end(), offsets.begin());
+
+    std::vector<size_t> result (offsets.back());
+    parallel_for(number_chunks, [&](size_t begin, size_t end) {
+        for (size_t c = begin; c < end; ++c) {
+            size_t j = offsets[c];
+            for (size_t i = c * chunk_size; i < std::min((c + 1) * chunk_size, size); ++i) {
+                if (keep(i)) {
+                    result[j++] = i;
+                }
+            }
+        }
+    }, 1);
+    return result;
+}
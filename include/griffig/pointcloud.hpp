@@ -1,8 +1,13 @@
 #pragma once
 
-#include <GL/glew.h>
+#include <array>
+#include <memory>
+#include <vector>
+
 #include <pybind11/embed.h>
 
+#include <affx/affine.hpp>
+
 
 enum class PointType {
     XYZ,
@@ -33,33 +38,29 @@ namespace PointTypes {
 }
 
 
-class Texture {
-    GLuint gl_handle {0};
-
-public:
-    explicit Texture() {
-        glGenTextures(1, &gl_handle);
-    }
-
-    ~Texture() {
-        glFinish();
-        glDeleteTextures(1, &gl_handle);
-    }
-
-    void upload(size_t width, size_t height, const void* data) {
-        glBindTexture(GL_TEXTURE_2D, gl_handle);
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, width, height, 0, GL_RGB, GL_UNSIGNED_BYTE, data);
-
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR);
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR);
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP);
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP);
-        glPixelStorei(GL_UNPACK_ROW_LENGTH, 0);
-        glBindTexture(GL_TEXTURE_2D, 0);
+//! A rigid transformation of single precision points, e.g. from the camera into the render frame
+struct PointTransform {
+    std::array<float, 9> rotation {1.0f, 0.0f, 0.0f, 0.0f, 1.0f, 0.0f, 0.0f, 0.0f, 1.0f};
+    std::array<float, 3> translation {0.0f, 0.0f, 0.0f};
+
+    explicit PointTransform() { }
+    explicit PointTransform(const affx::Affine& affine) {
+        const auto affine_rotation = affine.quaternion().toRotationMatrix();
+        const auto affine_translation = affine.translation();
+        for (size_t row = 0; row < 3; ++row) {
+            for (size_t col = 0; col < 3; ++col) {
+                rotation[3 * row + col] = affine_rotation(row, col);
+            }
+            translation[row] = affine_translation(row);
+        }
     }
 
-    GLuint get_gl_handle() const {
-        return gl_handle;
+    std::array<float, 3> operator()(const float* v) const {
+        return {
+            rotation[0] * v[0] + rotation[1] * v[1] + rotation[2] * v[2] + translation[0],
+            rotation[3] * v[0] + rotation[4] * v[1] + rotation[5] * v[2] + translation[1],
+            rotation[6] * v[0] + rotation[7] * v[1] + rotation[8] * v[2] + translation[2],
+        };
     }
 };
 
@@ -67,18 +68,50 @@ public:
 struct Pointcloud {
     pybind11::object pc;
 
+    //! The owned points of a compacted (e.g. filtered) cloud, otherwise the points are only referenced
+    std::shared_ptr<std::vector<char>> storage;
+
     size_t size {0};
     int width {0}, height {0};
 
     PointType point_type;
-    const void* vertices;
+    const void* vertices {nullptr};
+
+    //! The bytes between consecutive points (e.g. of a strided view into a ROS message), zero if tightly packed
+    size_t point_step {0};
 
-    Texture tex;
-    const void* tex_coords;
+    //! An optional RGB texture (of width x height) with texture coordinates for each vertex
+    const void* texture {nullptr};
+    const void* tex_coords {nullptr};
 
     explicit Pointcloud() { }
     explicit Pointcloud(size_t size, PointType point_type, const void* vertices): size(size), point_type(point_type), vertices(vertices) { }
-    explicit Pointcloud(size_t size, int width, int height, const void* vertices, const void* texture, const void* tex_coords): size(size), point_type(PointType::XYZ), width(width), height(height), vertices(vertices), tex_coords(tex_coords) {
-        tex.upload(width, height, texture);
+    explicit Pointcloud(size_t size, int width, int height, const void* vertices, const void* texture, const void* tex_coords): size(size), point_type(PointType::XYZ), width(width), height(height), vertices(vertices), texture(texture), tex_coords(tex_coords) { }
+
+    bool has_texture() const {
+        return texture && tex_coords;
+    }
+
+    size_t stride() const {
+        return point_step ? point_step : point_size(point_type);
+    }
+
+    //! The size of the referenced vertex memory, up to the end of the last point
+    size_t vertices_size() const {
+        return size ? (size - 1) * stride() + point_size(point_type) : 0;
+    }
+
+    const void* vertex(size_t i) const {
+        return (const char *)vertices + i * stride();
+    }
+
+    static size_t point_size(PointType type) {
+        switch (type) {
+            default:
+            case PointType::XYZWRGBA: return sizeof(PointTypes::XYZWRGBA);
+            case PointType::XYZ: return sizeof(PointTypes::XYZ);
+            case PointType::XYZRGB: return sizeof(PointTypes::XYZRGB);
+            case PointType::UV: return sizeof(PointTypes::UV);
+        }
     }
 };
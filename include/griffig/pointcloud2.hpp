@@ -0,0 +1,175 @@
+#pragma once
+
+#include <algorithm>
+#include <cmath>
+#include <cstddef>
+#include <cstdint>
+#include <cstring>
+#include <memory>
+#include <optional>
+#include <stdexcept>
+#include <vector>
+
+#include <griffig/parallel.hpp>
+#include <griffig/pointcloud.hpp>
+
+
+//! The point layout of a ROS sensor_msgs/PointCloud2 message (without depending on ROS itself). Compatible layouts
+//! are referenced as strided XYZ or XYZWRGBA points without copying, all others are repacked natively in a single
+//! parallel pass.
+struct Pointcloud2Layout {
+    //! Same values as the datatypes of sensor_msgs/PointField
+    enum Datatype: uint8_t {
+        INT8 = 1,
+        UINT8 = 2,
+        INT16 = 3,
+        UINT16 = 4,
+        INT32 = 5,
+        UINT32 = 6,
+        FLOAT32 = 7,
+        FLOAT64 = 8,
+    };
+
+    struct Field {
+        size_t offset;
+        uint8_t datatype;
+    };
+
+    size_t width {0}, height {0};
+    size_t point_step {0}, row_step {0};
+    bool is_bigendian {false};
+
+    std::optional<Field> x, y, z;
+
+    //! The color of the "rgb" or "rgba" field, packed into 4 bytes. Same as for the XYZWRGBA points of messages
+    //! without a layout, the bytes are read in memory order as red, green, blue and alpha.
+    std::optional<Field> rgb;
+
+    static size_t datatype_size(uint8_t datatype) {
+        switch (datatype) {
+            case INT8: case UINT8: return 1;
+            case INT16: case UINT16: return 2;
+            case INT32: case UINT32: case FLOAT32: return 4;
+            case FLOAT64: return 8;
+            default: throw std::runtime_error("Unknown point field datatype " + std::to_string(datatype) + ".");
+        }
+    }
+
+    static bool is_host_bigendian() {
+        const uint16_t one {1};
+        uint8_t first_byte;
+        std::memcpy(&first_byte, &one, 1);
+        return first_byte == 0;
+    }
+
+    //! Whether the points can be referenced as strided XYZ points, which needs aligned float32 coordinates in host
+    //! byte order and no padding between the rows of an organized cloud
+    bool is_view_compatible() const {
+        return x->datatype == FLOAT32 && y->datatype == FLOAT32 && z->datatype == FLOAT32
+            && y->offset == x->offset + 4 && z->offset == x->offset + 8
+            && x->offset % 4 == 0 && point_step % 4 == 0
+            && (height <= 1 || row_step == width * point_step)
+            && is_bigendian == is_host_bigendian();
+    }
+
+    //! Whether the colored points can be referenced as strided XYZWRGBA points, e.g. the layout of griffig itself
+    bool is_color_view_compatible() const {
+        return is_view_compatible() && rgb->offset == x->offset + offsetof(PointTypes::XYZWRGBA, r)
+            && x->offset + sizeof(PointTypes::XYZWRGBA) <= point_step;
+    }
+
+    //! References or repacks the points of the message data, which then needs to outlive the point cloud. Invalid
+    //! (NaN) points are skipped when repacking, and by the renderers otherwise.
+    Pointcloud to_pointcloud(const void* data, size_t data_size) const {
+        check(data_size);
+
+        const size_t number_points = width * height;
+        if (rgb ? is_color_view_compatible() : is_view_compatible()) {
+            Pointcloud result {number_points, rgb ? PointType::XYZWRGBA : PointType::XYZ, (const char *)data + x->offset};
+            result.point_step = point_step;
+            return result;
+        }
+
+        const bool swap_bytes = (is_bigendian != is_host_bigendian());
+        auto point_at = [&](size_t i) {
+            return (const char *)data + (i / width) * row_step + (i % width) * point_step;
+        };
+
+        const auto indices = parallel_compact(number_points, [&](size_t i) {
+            const char* point = point_at(i);
+            return std::isfinite(read(point, *x, swap_bytes)) && std::isfinite(read(point, *y, swap_bytes)) && std::isfinite(read(point, *z, swap_bytes));
+        });
+
+        const PointType point_type = rgb ? PointType::XYZWRGBA : PointType::XYZ;
+        const size_t point_size = Pointcloud::point_size(point_type);
+        auto storage = std::make_shared<std::vector<char>>(indices.size() * point_size);
+        char* vertices = storage->data();
+
+        parallel_for(indices.size(), [&](size_t begin, size_t end) {
+            for (size_t i = begin; i < end; ++i) {
+                const char* point = point_at(indices[i]);
+                const float position[3] = {(float)read(point, *x, swap_bytes), (float)read(point, *y, swap_bytes), (float)read(point, *z, swap_bytes)};
+
+                if (!rgb) {
+                    std::memcpy(vertices + i * point_size, position, sizeof(position));
+                    continue;
+                }
+
+                auto& target = *(PointTypes::XYZWRGBA *)(vertices + i * point_size);
+                target = {position[0], position[1], position[2], 1.0f};
+                std::memcpy(&target.r, point + rgb->offset, 4);
+            }
+        });
+
+        Pointcloud result {indices.size(), point_type, vertices};
+        result.storage = std::move(storage);
+        return result;
+    }
+
+private:
+    void check(size_t data_size) const {
+        if (!x || !y || !z) {
+            throw std::runtime_error("The point cloud needs x, y and z fields.");
+        }
+
+        for (const auto& field: {*x, *y, *z}) {
+            if (field.offset + datatype_size(field.datatype) > point_step) {
+                throw std::runtime_error("A point field exceeds the point step.");
+            }
+        }
+
+        if (rgb && (datatype_size(rgb->datatype) != 4 || rgb->offset + 4 > point_step)) {
+            throw std::runtime_error("The color field needs to be packed into 4 bytes.");
+        }
+
+        if (height > 1 && row_step < width * point_step) {
+            throw std::runtime_error("The row step is smaller than a row of points.");
+        }
+
+        const size_t required_size = (height > 0) ? (height - 1) * row_step + width * point_step : 0;
+        if (data_size < required_size) {
+            throw std::runtime_error("The point cloud data is smaller than given by its layout.");
+        }
+    }
+
+    //! Reads a single coordinate of any datatype (swapped into host byte order) as double
+    static double read(const char* point, const Field& field, bool swap_bytes) {
+        unsigned char bytes[8];
+        const size_t size = datatype_size(field.datatype);
+        std::memcpy(bytes, point + field.offset, size);
+        if (swap_bytes) {
+            std::reverse(bytes, bytes + size);
+        }
+
+        switch (field.datatype) {
+            case INT8: { int8_t v; std::memcpy(&v, bytes, size); return v; }
+            case UINT8: { uint8_t v; std::memcpy(&v, bytes, size); return v; }
+            case INT16: { int16_t v; std::memcpy(&v, bytes, size); return v; }
+            case UINT16: { uint16_t v; std::memcpy(&v, bytes, size); return v; }
+            case INT32: { int32_t v; std::memcpy(&v, bytes, size); return v; }
+            case UINT32: { uint32_t v; std::memcpy(&v, bytes, size); return v; }
+            case FLOAT32: { float v; std::memcpy(&v, bytes, size); return v; }
+            default: { double v; std::memcpy(&v, bytes, size); return v; }
+        }
+    }
+};
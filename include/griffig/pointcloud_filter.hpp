@@ -0,0 +1,224 @@
+#pragma once
+
+#include <array>
+#include <atomic>
+#include <cmath>
+#include <cstdint>
+#include <cstring>
+#include <limits>
+#include <memory>
+#include <optional>
+#include <stdexcept>
+#include <vector>
+
+#include <opencv2/opencv.hpp>
+
+#include <griffig/box_data.hpp>
+#include <griffig/parallel.hpp>
+#include <griffig/pointcloud.hpp>
+
+
+//! An optional stage before rendering, so that the render cost scales with the box area instead of the sensor
+//! resolution. It crops to the box and depth range, keeps only the nearest point per pixel of the render grid,
+//! and removes statistical outliers. Only the remaining points are copied into the compacted result.
+struct PointcloudFilter {
+    //! Crop to the contour of the box (in the image plane, like the renderer draws it)
+    std::optional<BoxData> box_data;
+
+    //! Crop to the depth range (relative to the camera position)
+    double min_depth {0.0}, max_depth {std::numeric_limits<double>::infinity()};
+
+    //! Keep only the nearest point per pixel of the render grid, disabled for a pixel size of zero
+    double pixel_size {0.0};
+    std::array<int, 2> size {0, 0};
+    std::array<double, 3> camera_position {0.0, 0.0, 0.0};
+
+    //! Transforms the points into the render frame, same as the camera pose of the renderers
+    std::optional<affx::Affine> camera_pose;
+
+    //! Remove points whose mean distance to the points of the neighboring pixels is more than the given number of
+    //! standard deviations above the mean (of all points), needs the render grid
+    bool remove_outliers {false};
+    double outlier_std_ratio {2.0};
+
+    explicit PointcloudFilter() { }
+    explicit PointcloudFilter(const std::optional<BoxData>& box_data, double min_depth, double max_depth, double pixel_size, const std::array<int, 2>& size, const std::array<double, 3>& camera_position, const std::optional<affx::Affine>& camera_pose, bool remove_outliers, double outlier_std_ratio): box_data(box_data), min_depth(min_depth), max_depth(max_depth), pixel_size(pixel_size), size(size), camera_position(camera_position), camera_pose(camera_pose), remove_outliers(remove_outliers), outlier_std_ratio(outlier_std_ratio) { }
+
+    Pointcloud apply(const Pointcloud& cloud) const {
+        if (cloud.size > std::numeric_limits<uint32_t>::max()) {
+            throw std::runtime_error("Too many points to filter.");
+        }
+
+        const bool use_grid = (pixel_size > 0.0);
+        if (remove_outliers && !use_grid) {
+            throw std::runtime_error("Outlier removal needs the render grid, please set a pixel size.");
+        }
+        if (use_grid && (size[0] <= 0 || size[1] <= 0)) {
+            throw std::runtime_error("The render grid needs a size.");
+        }
+
+        // Vertices are swapped into the image plane, same as the box contour is drawn by the renderer
+        std::vector<cv::Point2f> contour;
+        if (box_data) {
+            for (const auto& c: box_data->contour) {
+                contour.emplace_back(c[1], c[0]);
+            }
+        }
+
+        const PointTransform transform = camera_pose ? PointTransform(*camera_pose) : PointTransform();
+
+        auto is_inside = [&](const std::array<float, 3>& p) {
+            const double depth = p[2] - camera_position[2];
+            // Negated to skip NaN points as well
+            if (!(min_depth <= depth && depth <= max_depth)) {
+                return false;
+            }
+            return contour.empty() || cv::pointPolygonTest(contour, cv::Point2f(p[0], p[1]), false) >= 0;
+        };
+
+        std::vector<size_t> indices;
+        if (!use_grid) {
+            std::vector<uint8_t> keep (cloud.size);
+            parallel_for(cloud.size, [&](size_t begin, size_t end) {
+                for (size_t i = begin; i < end; ++i) {
+                    keep[i] = is_inside(transform((const float *)cloud.vertex(i)));
+                }
+            });
+            indices = parallel_compact(cloud.size, [&](size_t i) { return keep[i]; });
+
+        } else {
+            const int width = size[0], height = size[1];
+            const size_t grid_size = (size_t)width * height;
+
+            // Per pixel: the depth (as float bits) in the upper, and the index of the nearest point in the lower 32 bits
+            constexpr uint64_t empty_pixel {std::numeric_limits<uint64_t>::max()};
+            auto nearest = std::make_unique<std::atomic<uint64_t>[]>(grid_size);
+            parallel_for(grid_size, [&](size_t begin, size_t end) {
+                for (size_t i = begin; i < end; ++i) {
+                    nearest[i].store(empty_pixel, std::memory_order_relaxed);
+                }
+            });
+
+            // Same pixel grid as the renderers
+            parallel_for(cloud.size, [&](size_t begin, size_t end) {
+                for (size_t i = begin; i < end; ++i) {
+                    const auto p = transform((const float *)cloud.vertex(i));
+                    if (!is_inside(p)) {
+                        continue;
+                    }
+
+                    const double col = width / 2.0 - pixel_size * (p[0] - camera_position[0]);
+                    const double row = height / 2.0 - pixel_size * (p[1] - camera_position[1]);
+                    if (!(col >= 0.0 && col < width && row >= 0.0 && row < height)) {
+                        continue;
+                    }
+
+                    // Non-negative floats keep their order as integers
+                    const float depth = std::max<float>(p[2] - camera_position[2], 0.0f);
+                    uint32_t depth_bits;
+                    std::memcpy(&depth_bits, &depth, sizeof(depth));
+
+                    auto& pixel = nearest[(size_t)row * width + (size_t)col];
+                    const uint64_t key = ((uint64_t)depth_bits << 32) | (uint64_t)i;
+                    uint64_t current = pixel.load(std::memory_order_relaxed);
+                    while (key < current && !pixel.compare_exchange_weak(current, key, std::memory_order_relaxed)) { }
+                }
+            });
+
+            auto point_at = [&](size_t cell) {
+                return (const float *)cloud.vertex(nearest[cell].load(std::memory_order_relaxed) & 0xFFFFFFFF);
+            };
+
+            std::vector<float> mean_distances;
+            float max_mean_distance {std::numeric_limits<float>::infinity()};
+            if (remove_outliers) {
+                // The mean distance to the points of the 8-neighborhood, infinite for isolated points
+                mean_distances.resize(grid_size);
+                parallel_for(height, [&](size_t begin, size_t end) {
+                    for (size_t row = begin; row < end; ++row) {
+                        for (size_t col = 0; col < (size_t)width; ++col) {
+                            const size_t cell = row * width + col;
+                            if (nearest[cell].load(std::memory_order_relaxed) == empty_pixel) {
+                                continue;
+                            }
+
+                            const float* p = point_at(cell);
+                            float distance_sum {0.0f};
+                            size_t neighbors {0};
+                            for (size_t r = (row > 0) ? row - 1 : 0; r <= std::min<size_t>(row + 1, height - 1); ++r) {
+                                for (size_t c = (col > 0) ? col - 1 : 0; c <= std::min<size_t>(col + 1, width - 1); ++c) {
+                                    const size_t neighbor = r * width + c;
+                                    if (neighbor == cell || nearest[neighbor].load(std::memory_order_relaxed) == empty_pixel) {
+                                        continue;
+                                    }
+
+                                    const float* q = point_at(neighbor);
+                                    distance_sum += std::sqrt((p[0] - q[0]) * (p[0] - q[0]) + (p[1] - q[1]) * (p[1] - q[1]) + (p[2] - q[2]) * (p[2] - q[2]));
+                                    neighbors += 1;
+                                }
+                            }
+
+                            mean_distances[cell] = (neighbors > 0) ? distance_sum / neighbors : std::numeric_limits<float>::infinity();
+                        }
+                    }
+                }, 16);
+
+                double sum {0.0}, sum_squared {0.0};
+                size_t count {0};
+                for (size_t cell = 0; cell < grid_size; ++cell) {
+                    if (nearest[cell].load(std::memory_order_relaxed) != empty_pixel && std::isfinite(mean_distances[cell])) {
+                        sum += mean_distances[cell];
+                        sum_squared += mean_distances[cell] * mean_distances[cell];
+                        count += 1;
+                    }
+                }
+
+                if (count > 0) {
+                    const double mean = sum / count;
+                    const double std_dev = std::sqrt(std::max(sum_squared / count - mean * mean, 0.0));
+                    max_mean_distance = mean + outlier_std_ratio * std_dev;
+                }
+            }
+
+            const auto cells = parallel_compact(grid_size, [&](size_t cell) {
+                return nearest[cell].load(std::memory_order_relaxed) != empty_pixel && (!remove_outliers || mean_distances[cell] <= max_mean_distance);
+            });
+
+            indices.resize(cells.size());
+            parallel_for(cells.size(), [&](size_t begin, size_t end) {
+                for (size_t i = begin; i < end; ++i) {
+                    indices[i] = nearest[cells[i]].load(std::memory_order_relaxed) & 0xFFFFFFFF;
+                }
+            });
+        }
+
+        return gather(cloud, indices);
+    }
+
+private:
+    //! Copies the given points (and their texture coordinates) into a tightly packed cloud that owns them. The texture is
+    //! only referenced, the caller needs to keep the Python object of the source cloud alive (which needs the GIL).
+    static Pointcloud gather(const Pointcloud& cloud, const std::vector<size_t>& indices) {
+        const size_t point_size = Pointcloud::point_size(cloud.point_type);
+        const bool has_texture = cloud.has_texture();
+        const size_t vertices_size = indices.size() * point_size;
+        const size_t tex_coords_size = has_texture ? indices.size() * sizeof(PointTypes::UV) : 0;
+
+        auto storage = std::make_shared<std::vector<char>>(vertices_size + tex_coords_size);
+        char* vertices = storage->data();
+        char* tex_coords = vertices + vertices_size;
+
+        parallel_for(indices.size(), [&](size_t begin, size_t end) {
+            for (size_t i = begin; i < end; ++i) {
+                std::memcpy(vertices + i * point_size, cloud.vertex(indices[i]), point_size);
+                if (has_texture) {
+                    std::memcpy(tex_coords + i * sizeof(PointTypes::UV), (const PointTypes::UV *)cloud.tex_coords + indices[i], sizeof(PointTypes::UV));
+                }
+            }
+        });
+
+        Pointcloud result = has_texture ? Pointcloud(indices.size(), cloud.width, cloud.height, vertices, cloud.texture, tex_coords) : Pointcloud(indices.size(), cloud.point_type, vertices);
+        result.storage = std::move(storage);
+        return result;
+    }
+};
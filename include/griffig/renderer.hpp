@@ -1,8 +1,15 @@
 #pragma once
 
+#include <algorithm>
 #include <array>
+#include <cmath>
+#include <cstddef>
+#include <memory>
+#include <mutex>
 #include <optional>
-#include <iostream>
+#include <stdexcept>
+#include <string>
+#include <vector>
 
 #include <GL/glew.h>
 #include <EGL/egl.h>
@@ -19,6 +26,13 @@
 #include <griffig/orthographic_image.hpp>
 #include <griffig/pointcloud.hpp>
 #include <griffig/robot_pose.hpp>
+#include <griffig/texture.hpp>
+
+
+enum class RenderMode {
+    Immediate, // One GL call per point
+    VertexBuffer, // Upload points into persistent vertex buffers, draw with a single call
+};
 
 
 class Renderer {
@@ -26,19 +40,73 @@ class Renderer {
 
     EGLDisplay egl_display;
     EGLContext egl_context;
+
+    //! All renderers share the default display, which is only terminated after the last one is closed
+    inline static std::mutex display_mutex;
+    inline static size_t display_users {0};
+
+    //! The context is only current on the calling thread during a (public) call, so that a renderer can be used from
+    //! any thread, but only by one at a time. Nested calls of the same thread keep the context current.
+    std::recursive_mutex context_mutex;
+    size_t context_depth {0};
+
+    class CurrentContext {
+        Renderer& renderer;
+        std::lock_guard<std::recursive_mutex> lock;
+
+    public:
+        explicit CurrentContext(Renderer& renderer): renderer(renderer), lock(renderer.context_mutex) {
+            if (renderer.context_depth == 0 && !eglMakeCurrent(renderer.egl_display, EGL_NO_SURFACE, EGL_NO_SURFACE, renderer.egl_context)) {
+                throw std::runtime_error("Could not make the OpenGL context current: " + std::to_string(eglGetError()));
+            }
+            renderer.context_depth += 1;
+        }
+
+        ~CurrentContext() {
+            renderer.context_depth -= 1;
+            if (renderer.context_depth == 0) {
+                eglMakeCurrent(renderer.egl_display, EGL_NO_SURFACE, EGL_NO_SURFACE, EGL_NO_CONTEXT);
+            }
+        }
+    };
     GLuint egl_framebuffer, egl_color, egl_depth, egl_stencil;
 
+    //! Vertex buffers are kept between frames and only grow if needed
+    GLuint vertex_buffer {0}, tex_coord_buffer {0};
+    size_t vertex_buffer_capacity {0}, tex_coord_buffer_capacity {0};
+
+    //! The color textures of the point clouds (one per cloud of a fused render), uploaded when rendering
+    std::vector<std::unique_ptr<Texture>> textures;
+
+    //! Depth-only atlas for batched collision checks, each pose is rendered into its own tile
+    GLuint collision_framebuffer {0}, collision_depth {0};
+    int collision_width {0}, collision_height {0};
+
+    //! A frame of the asynchronous stream, whose read-back into a pixel pack buffer is still in flight
+    struct PendingFrame {
+        bool valid {false};
+        bool draw_texture;
+        double pixel_density, min_depth, max_depth;
+        GLsync fence {nullptr};
+    };
+
+    //! Double-buffered pixel pack buffers, each holds the color (RGBA16) followed by the depth (float32) of a frame
+    std::array<GLuint, 2> pack_buffers {0, 0};
+    std::array<size_t, 2> pack_buffer_capacities {0, 0};
+    std::array<PendingFrame, 2> pending_frames;
+    size_t pending_index {0};
+
     void init_egl(int width, int height) {
+        std::lock_guard<std::mutex> display_lock {display_mutex};
+
         egl_display = eglGetDisplay(EGL_DEFAULT_DISPLAY);
         if (egl_display == EGL_NO_DISPLAY) {
-            std::cout << "display: " << eglGetError() << std::endl;
-            exit(EXIT_FAILURE);
+            throw std::runtime_error("Could not create OpenGL renderer, EGL display: " + std::to_string(eglGetError()));
         }
 
         EGLint major, minor;
         if (!eglInitialize(egl_display, &major, &minor)) {
-            std::cout << "init: " << eglGetError() << std::endl;
-            exit(EXIT_FAILURE);
+            throw std::runtime_error("Could not create OpenGL renderer, EGL init: " + std::to_string(eglGetError()));
         }
 
         EGLint const configAttribs[] = {
@@ -51,8 +119,7 @@ class Renderer {
         EGLint numConfigs;
         EGLConfig eglCfg;
         if (!eglChooseConfig(egl_display, configAttribs, NULL, 0, &numConfigs)) {
-            std::cout << "choose config: " << eglGetError() << std::endl;
-            exit(EXIT_FAILURE);
+            throw std::runtime_error("Could not create OpenGL renderer, EGL choose config: " + std::to_string(eglGetError()));
         }
 
         // std::cout << "numConfigs: " << numConfigs << std::endl;
@@ -60,19 +127,16 @@ class Renderer {
 
         egl_context = eglCreateContext(egl_display, eglCfg, EGL_NO_CONTEXT, NULL);
         if (egl_context == NULL) {
-            std::cout << "create context: " << eglGetError() << std::endl;
-            exit(EXIT_FAILURE);
+            throw std::runtime_error("Could not create OpenGL renderer, EGL create context: " + std::to_string(eglGetError()));
         }
 
         if (!eglMakeCurrent(egl_display, EGL_NO_SURFACE, EGL_NO_SURFACE, egl_context)) {
-            std::cout << "make current: " << eglGetError() << std::endl;
-            exit(EXIT_FAILURE);
+            throw std::runtime_error("Could not create OpenGL renderer, EGL make current: " + std::to_string(eglGetError()));
         }
 
         GLenum glewinit = glewInit();
         if (glewinit != GLEW_OK) {
-            std::cout << "glew init: " << glewinit << std::endl;
-            exit(EXIT_FAILURE);
+            throw std::runtime_error("Could not create OpenGL renderer, glew init: " + std::to_string(glewinit));
         }
 
         glGenFramebuffers(1, &egl_framebuffer);
@@ -94,6 +158,14 @@ class Renderer {
         glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, egl_depth);
         glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_STENCIL_ATTACHMENT, GL_RENDERBUFFER, egl_depth);
 
+        glGenBuffers(1, &vertex_buffer);
+        glGenBuffers(1, &tex_coord_buffer);
+
+        glGenFramebuffers(1, &collision_framebuffer);
+        glGenRenderbuffers(1, &collision_depth);
+        glGenBuffers(pack_buffers.size(), pack_buffers.data());
+        glBindFramebuffer(GL_FRAMEBUFFER, egl_framebuffer);
+
         glViewport(0, 0, width, height);
         glClearColor(0, 0, 0, 0);
 
@@ -102,10 +174,357 @@ class Renderer {
         depth_32f = cv::Mat::zeros(size, CV_32FC1);
         depth_16u = cv::Mat::zeros(size, CV_16UC1);
         mask = cv::Mat::zeros(size, CV_8UC1);
+
+        // Release the context from the constructing thread, each call makes it current again
+        eglMakeCurrent(egl_display, EGL_NO_SURFACE, EGL_NO_SURFACE, EGL_NO_CONTEXT);
+        display_users += 1;
     }
 
     void close_egl() {
-        eglTerminate(egl_display);
+        {
+            CurrentContext current {*this};
+            close_gl();
+        }
+
+        eglDestroyContext(egl_display, egl_context);
+
+        std::lock_guard<std::mutex> display_lock {display_mutex};
+        display_users -= 1;
+        if (display_users == 0) {
+            eglTerminate(egl_display);
+        }
+    }
+
+    void close_gl() {
+        textures.clear();
+        for (auto& frame: pending_frames) {
+            if (frame.fence) {
+                glDeleteSync(frame.fence);
+            }
+        }
+        glDeleteBuffers(pack_buffers.size(), pack_buffers.data());
+        glDeleteBuffers(1, &vertex_buffer);
+        glDeleteBuffers(1, &tex_coord_buffer);
+        glDeleteRenderbuffers(1, &collision_depth);
+        glDeleteFramebuffers(1, &collision_framebuffer);
+    }
+
+    void upload_buffer(GLuint buffer, size_t& capacity, size_t size, const void* data) {
+        glBindBuffer(GL_ARRAY_BUFFER, buffer);
+        capacity = std::max(capacity, size);
+
+        // Orphan the storage of the last frame, so that the driver doesn't need to wait for it
+        glBufferData(GL_ARRAY_BUFFER, capacity, nullptr, GL_STREAM_DRAW);
+        glBufferSubData(GL_ARRAY_BUFFER, 0, size, data);
+    }
+
+    //! Grows the collision atlas (never shrinks it) and binds it
+    void bind_collision_framebuffer(int width, int height) {
+        glBindFramebuffer(GL_FRAMEBUFFER, collision_framebuffer);
+        if (width <= collision_width && height <= collision_height) {
+            return;
+        }
+
+        collision_width = std::max(width, collision_width);
+        collision_height = std::max(height, collision_height);
+
+        glBindRenderbuffer(GL_RENDERBUFFER, collision_depth);
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT32F, collision_width, collision_height);
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, collision_depth);
+        glDrawBuffer(GL_NONE);
+        glReadBuffer(GL_NONE);
+    }
+
+    //! The image region that both finger boxes of a pose can cover, with a pixel margin and clipped to the image
+    cv::Rect get_gripper_roi(const OrthographicImage& image, const Gripper& gripper, const RobotPose& pose) const {
+        const int image_width = image.mat.cols;
+        const int image_height = image.mat.rows;
+
+        double min_col {(double)image_width}, max_col {0.0}, min_row {(double)image_height}, max_row {0.0};
+        for (const double side: {1.0, -1.0}) {
+            const Affine finger = image.pose.inverse() * pose * Affine(0.0, side * pose.d / 2, 0.0);
+            for (const double x: {-gripper.finger_width / 2, gripper.finger_width / 2}) {
+                for (const double y: {-gripper.finger_extent / 2, gripper.finger_extent / 2}) {
+                    for (const double z: {0.0, gripper.finger_height}) {
+                        // Same projection as draw_affines, glOrtho and gluLookAt
+                        const Affine corner = finger * Affine(x, y, z);
+                        const double col = image_width / 2.0 - image.pixel_size * (corner.y() - camera_position[0]);
+                        const double row = image_height / 2.0 - image.pixel_size * (corner.x() - camera_position[1]);
+
+                        min_col = std::min(min_col, col);
+                        max_col = std::max(max_col, col);
+                        min_row = std::min(min_row, row);
+                        max_row = std::max(max_row, row);
+                    }
+                }
+            }
+        }
+
+        const cv::Rect roi {cv::Point((int)std::floor(min_col) - 1, (int)std::floor(min_row) - 1), cv::Point((int)std::ceil(max_col) + 1, (int)std::ceil(max_row) + 1)};
+        return roi & cv::Rect(0, 0, image_width, image_height);
+    }
+
+    template<bool draw_texture>
+    void draw_points_immediate(const Pointcloud& cloud) {
+        glBegin(GL_POINTS);
+        {
+            if (cloud.point_type == PointType::XYZ) {
+                for (size_t i = 0; i < cloud.size; ++i) {
+                    glVertex3fv(&((const PointTypes::XYZ *)cloud.vertex(i))->x);
+                    if (draw_texture && cloud.tex_coords) {
+                        glTexCoord2fv(&((PointTypes::UV *)cloud.tex_coords + i)->u);
+                    }
+                }
+
+            } else if (cloud.point_type == PointType::XYZWRGBA) {
+                for (size_t i = 0; i < cloud.size; ++i) {
+                    const auto* point = (const PointTypes::XYZWRGBA *)cloud.vertex(i);
+                    glVertex3fv(&point->x);
+                    if constexpr (draw_texture) {
+                        glColor3ubv(&point->r);
+                    }
+                }
+            }
+        }
+        glEnd();
+    }
+
+    template<bool draw_texture>
+    void draw_points_vertex_buffer(const Pointcloud& cloud) {
+        if (cloud.point_type == PointType::XYZ) {
+            upload_buffer(vertex_buffer, vertex_buffer_capacity, cloud.vertices_size(), cloud.vertices);
+            glVertexPointer(3, GL_FLOAT, cloud.stride(), nullptr);
+            glEnableClientState(GL_VERTEX_ARRAY);
+
+            if (draw_texture && cloud.tex_coords) {
+                upload_buffer(tex_coord_buffer, tex_coord_buffer_capacity, cloud.size * sizeof(PointTypes::UV), cloud.tex_coords);
+                glTexCoordPointer(2, GL_FLOAT, sizeof(PointTypes::UV), nullptr);
+                glEnableClientState(GL_TEXTURE_COORD_ARRAY);
+            }
+
+        } else if (cloud.point_type == PointType::XYZWRGBA) {
+            upload_buffer(vertex_buffer, vertex_buffer_capacity, cloud.vertices_size(), cloud.vertices);
+            glVertexPointer(3, GL_FLOAT, cloud.stride(), (const void*)offsetof(PointTypes::XYZWRGBA, x));
+            glEnableClientState(GL_VERTEX_ARRAY);
+
+            if constexpr (draw_texture) {
+                glColorPointer(3, GL_UNSIGNED_BYTE, cloud.stride(), (const void*)offsetof(PointTypes::XYZWRGBA, r));
+                glEnableClientState(GL_COLOR_ARRAY);
+            }
+
+        } else {
+            return;
+        }
+
+        glDrawArrays(GL_POINTS, 0, cloud.size);
+
+        glDisableClientState(GL_VERTEX_ARRAY);
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY);
+        glDisableClientState(GL_COLOR_ARRAY);
+        glBindBuffer(GL_ARRAY_BUFFER, 0);
+    }
+
+    //! Column-major OpenGL matrix of an affine transformation
+    static std::array<GLdouble, 16> get_gl_matrix(const Affine& affine) {
+        const auto rotation = affine.quaternion().toRotationMatrix();
+        const auto translation = affine.translation();
+        return {
+            rotation(0, 0), rotation(1, 0), rotation(2, 0), 0.0,
+            rotation(0, 1), rotation(1, 1), rotation(2, 1), 0.0,
+            rotation(0, 2), rotation(1, 2), rotation(2, 2), 0.0,
+            translation(0), translation(1), translation(2), 1.0,
+        };
+    }
+
+    //! Clears the framebuffer and sets up the orthographic projection and camera
+    void setup_view(double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position) {
+        glEnable(GL_TEXTURE_2D);
+        glEnable(GL_DEPTH_TEST);
+        glBindTexture(GL_TEXTURE_2D, 0);
+
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT);
+
+        const double alpha = 1.0 / (2 * pixel_density);
+        glMatrixMode(GL_PROJECTION);
+        glLoadIdentity();
+        glOrtho(alpha * width, -alpha * width, -alpha * height, alpha * height, min_depth, max_depth);
+
+        glMatrixMode(GL_MODELVIEW);
+        glLoadIdentity();
+        gluLookAt(camera_position[0], camera_position[1], camera_position[2], 0.0, 0.0, 1.0, 0.0, -1.0, 0.0);
+
+        glEnable(GL_POINT_SMOOTH);
+        // glPointSize((float)width / 640);
+    }
+
+    //! Draws a cloud with the current modelview matrix, its texture is uploaded into the given texture slot
+    template<bool draw_texture>
+    void draw_cloud(const Pointcloud& cloud, size_t texture_index = 0) {
+        if (draw_texture && cloud.has_texture()) {
+            const float tex_border_color[] = { 0.8f, 0.8f, 0.8f, 0.8f };
+
+            while (textures.size() <= texture_index) {
+                textures.push_back(std::make_unique<Texture>());
+            }
+            textures[texture_index]->upload(cloud.width, cloud.height, cloud.texture);
+
+            glEnable(GL_TEXTURE_2D);
+            glBindTexture(GL_TEXTURE_2D, textures[texture_index]->get_gl_handle());
+
+            glTexParameterfv(GL_TEXTURE_2D, GL_TEXTURE_BORDER_COLOR, tex_border_color);
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, 0x812F);
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, 0x812F);
+
+            // Don't modulate the texture with the color of previous draw calls
+            glColor3f(1.0, 1.0, 1.0);
+
+        } else {
+            glBindTexture(GL_TEXTURE_2D, 0);
+        }
+
+        if (render_mode == RenderMode::VertexBuffer) {
+            draw_points_vertex_buffer<draw_texture>(cloud);
+        } else {
+            draw_points_immediate<draw_texture>(cloud);
+        }
+    }
+
+    template<bool draw_texture>
+    void draw_pointcloud(const Pointcloud& cloud, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position, const std::optional<Affine>& camera_pose) {
+        setup_view(pixel_density, min_depth, max_depth, camera_position);
+
+        // The camera pose transforms the points into the render frame
+        if (camera_pose) {
+            const auto matrix = get_gl_matrix(*camera_pose);
+            glMatrixMode(GL_MODELVIEW);
+            glMultMatrixd(matrix.data());
+        }
+
+        draw_cloud<draw_texture>(cloud);
+    }
+
+    //! Draws all clouds into the same depth buffer, each transformed by its camera pose into the common frame
+    template<bool draw_texture>
+    void draw_pointclouds(const std::vector<Pointcloud>& clouds, const std::vector<Affine>& camera_poses, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position) {
+        if (clouds.size() != camera_poses.size()) {
+            throw std::runtime_error("Each point cloud needs its own camera pose.");
+        }
+
+        setup_view(pixel_density, min_depth, max_depth, camera_position);
+
+        glMatrixMode(GL_MODELVIEW);
+        for (size_t i = 0; i < clouds.size(); ++i) {
+            const auto matrix = get_gl_matrix(camera_poses[i]);
+
+            glPushMatrix();
+            glMultMatrixd(matrix.data());
+            draw_cloud<draw_texture>(clouds[i], i);
+            glPopMatrix();
+        }
+    }
+
+    void check_output(const cv::Mat& output, bool draw_texture) const {
+        if (output.size() != cv::Size(width, height) || output.type() != (draw_texture ? CV_16UC4 : CV_16UC1)) {
+            throw std::runtime_error("Output image does not match the renderer size or type.");
+        }
+    }
+
+    //! Reads the framebuffer into the output image, the depth goes into the last channel
+    template<bool draw_texture>
+    void read_output(cv::Mat& output) {
+        // Only (re-)allocated if the size changes
+        depth_32f.create(output.size(), CV_32FC1);
+        glPixelStorei(GL_PACK_ALIGNMENT, 4);
+        glPixelStorei(GL_PACK_ROW_LENGTH, 0);
+        glReadPixels(0, 0, depth_32f.cols, depth_32f.rows, GL_DEPTH_COMPONENT, GL_FLOAT, depth_32f.data);
+
+        // Depth value is (1 - depth) * 255 * 255
+        if constexpr (!draw_texture) {
+            depth_32f.convertTo(output, CV_16U, -255.0 * 255, 255.0 * 255);
+            return;
+        }
+
+        depth_32f.convertTo(depth_16u, CV_16U, -255.0 * 255, 255.0 * 255);
+
+        glPixelStorei(GL_PACK_ALIGNMENT, (output.step & 3) ? 1 : 4);
+        glPixelStorei(GL_PACK_ROW_LENGTH, output.step / output.elemSize());
+        glReadPixels(0, 0, output.cols, output.rows, GL_RGBA, GL_UNSIGNED_SHORT, output.data);
+        glPixelStorei(GL_PACK_ROW_LENGTH, 0);
+
+        const int from_to[] = {0, 3};
+        cv::mixChannels(&depth_16u, 1, &output, 1, from_to, 1);
+    }
+
+    //! Reads the current framebuffer into a pixel pack buffer without waiting for the rendering to finish
+    template<bool draw_texture>
+    void start_readback(size_t index, double pixel_density, double min_depth, double max_depth) {
+        const size_t color_size = draw_texture ? (size_t)width * height * 4 * sizeof(GLushort) : 0;
+        const size_t depth_size = (size_t)width * height * sizeof(GLfloat);
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pack_buffers[index]);
+        if (pack_buffer_capacities[index] < color_size + depth_size) {
+            pack_buffer_capacities[index] = color_size + depth_size;
+            glBufferData(GL_PIXEL_PACK_BUFFER, pack_buffer_capacities[index], nullptr, GL_STREAM_READ);
+        }
+
+        glPixelStorei(GL_PACK_ALIGNMENT, 4);
+        glPixelStorei(GL_PACK_ROW_LENGTH, 0);
+        if constexpr (draw_texture) {
+            glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_SHORT, nullptr);
+        }
+        glReadPixels(0, 0, width, height, GL_DEPTH_COMPONENT, GL_FLOAT, (void*)color_size);
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0);
+
+        auto& frame = pending_frames[index];
+        frame.valid = true;
+        frame.draw_texture = draw_texture;
+        frame.pixel_density = pixel_density;
+        frame.min_depth = min_depth;
+        frame.max_depth = max_depth;
+        frame.fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0);
+    }
+
+    //! Waits for a pending read-back (usually finished already) and copies it into the output image
+    std::optional<OrthographicImage> finish_readback(size_t index, cv::Mat& output) {
+        auto& frame = pending_frames[index];
+        if (!frame.valid) {
+            return std::nullopt;
+        }
+
+        check_output(output, frame.draw_texture);
+
+        glClientWaitSync(frame.fence, GL_SYNC_FLUSH_COMMANDS_BIT, GL_TIMEOUT_IGNORED);
+        glDeleteSync(frame.fence);
+        frame.fence = nullptr;
+        frame.valid = false;
+
+        const size_t color_size = frame.draw_texture ? (size_t)width * height * 4 * sizeof(GLushort) : 0;
+        const size_t depth_size = (size_t)width * height * sizeof(GLfloat);
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pack_buffers[index]);
+        auto* buffer = (unsigned char *)glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, color_size + depth_size, GL_MAP_READ_BIT);
+        if (!buffer) {
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0);
+            throw std::runtime_error("Could not map the read-back buffer.");
+        }
+
+        // Depth value is (1 - depth) * 255 * 255
+        const cv::Mat depth {cv::Size(width, height), CV_32FC1, buffer + color_size};
+        if (!frame.draw_texture) {
+            depth.convertTo(output, CV_16U, -255.0 * 255, 255.0 * 255);
+
+        } else {
+            depth.convertTo(depth_16u, CV_16U, -255.0 * 255, 255.0 * 255);
+            cv::Mat(cv::Size(width, height), CV_16UC4, buffer).copyTo(output);
+
+            const int from_to[] = {0, 3};
+            cv::mixChannels(&depth_16u, 1, &output, 1, from_to, 1);
+        }
+
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER);
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0);
+
+        return OrthographicImage(output, frame.pixel_density, frame.min_depth, frame.max_depth);
     }
 
     void draw_affines(const std::array<Affine, 4>& affines) {
@@ -245,6 +664,7 @@ public:
 
     std::optional<BoxData> box_contour;
     std::array<double, 3> camera_position {0.0, 0.0, 0.0};
+    RenderMode render_mode {RenderMode::VertexBuffer};
     cv::Mat color, depth_32f, depth_16u, mask;
 
     // When no box_data is given: Griffig Main
@@ -274,6 +694,8 @@ public:
             throw std::runtime_error("Renderer size mismatch.");
         }
 
+        CurrentContext current {*this};
+
         const cv::Size size {(int)width, (int)height};
         color = cv::Mat::zeros(size, CV_16UC4);
         depth_32f = cv::Mat::zeros(size, CV_32FC1);
@@ -321,6 +743,8 @@ public:
             throw std::runtime_error("Renderer size mismatch.");
         }
 
+        CurrentContext current {*this};
+
         const cv::Size size {(int)width, (int)height};
         color = cv::Mat::zeros(size, CV_16UC4);
         depth_32f = cv::Mat::zeros(size, CV_32FC1);
@@ -362,54 +786,119 @@ public:
         color.copyTo(image.mat, mask);
     }
 
-    bool check_gripper_collision(OrthographicImage& image, const Gripper& gripper, const RobotPose& pose) {
-        int width = image.mat.cols;
-        int height = image.mat.rows;
-        cv::Mat depth_32f = cv::Mat::zeros(cv::Size(width, height), CV_32FC1);
+    //! Returns for each pose how far (in meters) the finger boxes penetrate the depth image, zero for no collision.
+    //! All poses are drawn into their own tile of a depth-only atlas, only the region around each pose is compared.
+    std::vector<double> calculate_gripper_penetrations(const OrthographicImage& image, const Gripper& gripper, const std::vector<RobotPose>& poses) {
+        std::vector<double> penetrations (poses.size(), 0.0);
+        if (poses.empty()) {
+            return penetrations;
+        }
+
+        CurrentContext current {*this};
 
-        glClearDepth(0.0);
+        std::vector<cv::Rect> rois (poses.size());
+        int tile_width {1}, tile_height {1};
+        for (size_t i = 0; i < poses.size(); ++i) {
+            rois[i] = get_gripper_roi(image, gripper, poses[i]);
+            tile_width = std::max(tile_width, rois[i].width);
+            tile_height = std::max(tile_height, rois[i].height);
+        }
+
+        GLint max_size;
+        glGetIntegerv(GL_MAX_RENDERBUFFER_SIZE, &max_size);
+        max_size = std::min<GLint>(max_size, 8192);
+
+        const size_t columns = std::clamp<size_t>(max_size / tile_width, 1, poses.size());
+        const size_t batch_size = columns * std::max<size_t>(max_size / tile_height, 1);
+        const std::array<double, 3> finger_box = {gripper.finger_width, gripper.finger_extent, gripper.finger_height};
+        const double width_half = image.mat.cols / 2.0, height_half = image.mat.rows / 2.0;
 
-        glClear(GL_DEPTH_BUFFER_BIT);
+        glDisable(GL_TEXTURE_2D);
         glEnable(GL_DEPTH_TEST);
         glDepthFunc(GL_GREATER);
+        glClearDepth(0.0);
 
-        const double alpha = 1.0 / (2 * image.pixel_size);
-        glMatrixMode(GL_PROJECTION);
-        glLoadIdentity();
-        glOrtho(alpha * width, -alpha * width, -alpha * height, alpha * height, image.min_depth, image.max_depth);
+        cv::Mat atlas_depth, image_depth_16u, image_depth;
+        for (size_t batch_begin = 0; batch_begin < poses.size(); batch_begin += batch_size) {
+            const size_t batch_end = std::min(batch_begin + batch_size, poses.size());
+            const size_t rows = (batch_end - batch_begin + columns - 1) / columns;
 
-        glMatrixMode(GL_MODELVIEW);
-        glLoadIdentity();
-        gluLookAt(camera_position[0], camera_position[1], camera_position[2], 0, 0, 1, 0, -1, 0);
+            bind_collision_framebuffer(columns * tile_width, rows * tile_height);
+            glViewport(0, 0, collision_width, collision_height);
+            glClear(GL_DEPTH_BUFFER_BIT);
 
-        glBegin(GL_QUADS);
+            for (size_t i = batch_begin; i < batch_end; ++i) {
+                const cv::Rect& roi = rois[i];
+                if (roi.empty()) {
+                    continue;
+                }
 
-        // Render fingers
-        std::array<double, 3> finger_box = {gripper.finger_width, gripper.finger_extent, gripper.finger_height};
-        draw_cube(image.pose.inverse() * pose * Affine(0.0, pose.d / 2, 0.0), finger_box);
-        draw_cube(image.pose.inverse() * pose * Affine(0.0, -pose.d / 2, 0.0), finger_box);
+                // Restrict the full image projection to the region of interest
+                const size_t tile = i - batch_begin;
+                glViewport((tile % columns) * tile_width, (tile / columns) * tile_height, roi.width, roi.height);
 
-        // Render gripper
-        // if (gripper_size[0] > 0.0) {
-        //     draw_cube(image.pose.inverse() * pose * Affine(0.0, 0.0, finger_height), gripper_size);
-        // }
+                glMatrixMode(GL_PROJECTION);
+                glLoadIdentity();
+                glOrtho((width_half - roi.x) / image.pixel_size, (width_half - roi.x - roi.width) / image.pixel_size, (roi.y - height_half) / image.pixel_size, (roi.y + roi.height - height_half) / image.pixel_size, image.min_depth, image.max_depth);
 
-        glEnd();
+                glMatrixMode(GL_MODELVIEW);
+                glLoadIdentity();
+                gluLookAt(camera_position[0], camera_position[1], camera_position[2], 0, 0, 1, 0, -1, 0);
 
-        glPixelStorei(GL_PACK_ALIGNMENT, (depth_32f.step & 3) ? 1 : 4);
-        glPixelStorei(GL_PACK_ROW_LENGTH, depth_32f.step / depth_32f.elemSize());
-        glReadPixels(0, 0, depth_32f.cols, depth_32f.rows, GL_DEPTH_COMPONENT, GL_FLOAT, depth_32f.data);
+                glBegin(GL_QUADS);
+                draw_cube(image.pose.inverse() * poses[i] * Affine(0.0, poses[i].d / 2, 0.0), finger_box);
+                draw_cube(image.pose.inverse() * poses[i] * Affine(0.0, -poses[i].d / 2, 0.0), finger_box);
+                glEnd();
+            }
 
-        depth_32f = (1 - depth_32f);
+            atlas_depth.create(rows * tile_height, columns * tile_width, CV_32FC1);
+            glPixelStorei(GL_PACK_ALIGNMENT, 4);
+            glPixelStorei(GL_PACK_ROW_LENGTH, 0);
+            glReadPixels(0, 0, atlas_depth.cols, atlas_depth.rows, GL_DEPTH_COMPONENT, GL_FLOAT, atlas_depth.data);
 
-        cv::Mat image_16u = cv::Mat::zeros(cv::Size(width, height), CV_16UC1);
-        cv::Mat image_32f = cv::Mat::zeros(cv::Size(width, height), CV_32FC1);
-        cv::extractChannel(image.mat, image_16u, 3);
-        image_16u.convertTo(image_32f, CV_32F);
-        image_32f /= 255 * 255;
+            for (size_t i = batch_begin; i < batch_end; ++i) {
+                const cv::Rect& roi = rois[i];
+                if (roi.empty()) {
+                    continue;
+                }
+
+                const size_t tile = i - batch_begin;
+                const cv::Mat finger_depth = 1 - atlas_depth(cv::Rect((tile % columns) * tile_width, (tile / columns) * tile_height, roi.width, roi.height));
+
+                if (image.mat.channels() == 1) {
+                    image_depth_16u = image.mat(roi);
+                } else {
+                    cv::extractChannel(image.mat(roi), image_depth_16u, 3);
+                }
+                image_depth_16u.convertTo(image_depth, CV_32F, 1.0 / (255 * 255));
+
+                double max_penetration;
+                cv::minMaxLoc(image_depth - finger_depth, nullptr, &max_penetration);
+                penetrations[i] = std::max(max_penetration, 0.0) * (image.max_depth - image.min_depth);
+            }
+        }
+
+        // Restore the state for rendering point clouds
+        glClearDepth(1.0);
+        glDepthFunc(GL_LESS);
+        glBindFramebuffer(GL_FRAMEBUFFER, egl_framebuffer);
+        glViewport(0, 0, width, height);
+
+        return penetrations;
+    }
+
+    std::vector<bool> check_gripper_collisions(const OrthographicImage& image, const Gripper& gripper, const std::vector<RobotPose>& poses) {
+        const auto penetrations = calculate_gripper_penetrations(image, gripper, poses);
+
+        std::vector<bool> result (penetrations.size());
+        for (size_t i = 0; i < penetrations.size(); ++i) {
+            result[i] = (penetrations[i] > 0.0);
+        }
+        return result;
+    }
 
-        bool no_collision = cv::checkRange(depth_32f - image_32f, true, 0, 0.0, 1.01);
-        return !no_collision;
+    bool check_gripper_collision(const OrthographicImage& image, const Gripper& gripper, const RobotPose& pose) {
+        return check_gripper_collisions(image, gripper, {pose})[0];
     }
 
     template<bool draw_texture>
@@ -421,110 +910,71 @@ public:
     }
 
     template<bool draw_texture>
-    OrthographicImage render_pointcloud(const Pointcloud& cloud, double pixel_density, double min_depth, double max_depth) {
-        cv::Mat mat = render_pointcloud_mat<draw_texture>(cloud, pixel_density, min_depth, max_depth, camera_position);
+    OrthographicImage render_pointcloud(const Pointcloud& cloud, double pixel_density, double min_depth, double max_depth, const std::optional<Affine>& camera_pose = std::nullopt) {
+        cv::Mat mat = render_pointcloud_mat<draw_texture>(cloud, pixel_density, min_depth, max_depth, camera_position, camera_pose);
         return OrthographicImage(mat, pixel_density, min_depth, max_depth);
     }
 
     template<bool draw_texture>
-    cv::Mat render_pointcloud_mat(const Pointcloud& cloud, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position) {
-        cv::Size size {(int)width, (int)height};
-        color = cv::Mat::zeros(size, CV_16UC4);
-        depth_32f = cv::Mat::zeros(size, CV_32FC1);
-        depth_16u = cv::Mat::zeros(size, CV_16UC1);
-
-        if (!cloud.size) {
-            if constexpr (draw_texture) {
-                return color;
-            } else {
-                return depth_16u;
-            }
-        }
-
-        glEnable(GL_TEXTURE_2D);
-        glEnable(GL_DEPTH_TEST);
-        glBindTexture(GL_TEXTURE_2D, 0);
-
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT);
-
-        const double alpha = 1.0 / (2 * pixel_density);
-        glMatrixMode(GL_PROJECTION);
-        glLoadIdentity();
-        glOrtho(alpha * size.width, -alpha * size.width, -alpha * size.height, alpha * size.height, min_depth, max_depth);
-
-        glMatrixMode(GL_MODELVIEW);
-        glLoadIdentity();
-        gluLookAt(camera_position[0], camera_position[1], camera_position[2], 0.0, 0.0, 1.0, 0.0, -1.0, 0.0);
-
-        if constexpr (draw_texture) {
-            const float tex_border_color[] = { 0.8f, 0.8f, 0.8f, 0.8f };
+    cv::Mat render_pointcloud_mat(const Pointcloud& cloud, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position, const std::optional<Affine>& camera_pose = std::nullopt) {
+        cv::Mat result {cv::Size(width, height), draw_texture ? CV_16UC4 : CV_16UC1};
+        render_pointcloud_into<draw_texture>(cloud, result, pixel_density, min_depth, max_depth, camera_position, camera_pose);
+        return result;
+    }
 
-            glEnable(GL_TEXTURE_2D);
-            glBindTexture(GL_TEXTURE_2D, cloud.tex.get_gl_handle());
+    //! Render into a caller-owned (and reusable) image of the renderer size, either CV_16UC4 or CV_16UC1 without texture.
+    //! An optional camera pose transforms the points (in the camera frame) into the render frame on the GPU.
+    template<bool draw_texture>
+    void render_pointcloud_into(const Pointcloud& cloud, cv::Mat& output, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position, const std::optional<Affine>& camera_pose = std::nullopt) {
+        check_output(output, draw_texture);
 
-            glTexParameterfv(GL_TEXTURE_2D, GL_TEXTURE_BORDER_COLOR, tex_border_color);
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, 0x812F);
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, 0x812F);
+        if (!cloud.size) {
+            output.setTo(0);
+            return;
         }
 
-        glEnable(GL_POINT_SMOOTH);
-
-        // glPointSize((float)size.width / 640);
-        auto color_format = GL_BGRA;
-
-        // GLuint vertBufID {0};
-        // glGenBuffers(1, &vertBufID);
-        // glBindBuffer(GL_ARRAY_BUFFER, vertBufID);
-        // glBufferData(GL_ARRAY_BUFFER, cloud.size*sizeof(PointTypes::XYZ), cloud.vertices, GL_STATIC_DRAW);
-
-        // glBindBuffer(GL_ARRAY_BUFFER, vertBufID);
-        // int stride = sizeof(PointTypes::XYZ);
-        // char *offset = (char*)NULL;
-
-        // glVertexPointer(3, GL_FLOAT, stride, offset);
-        // glEnableClientState(GL_VERTEX_ARRAY);
-
-        // glDrawArrays(GL_POINTS, 0, cloud.size);
-        // glDisableClientState(GL_VERTEX_ARRAY);
+        CurrentContext current {*this};
+        draw_pointcloud<draw_texture>(cloud, pixel_density, min_depth, max_depth, camera_position, camera_pose);
+        read_output<draw_texture>(output);
+    }
 
-        glBegin(GL_POINTS);
-        {
-            if (cloud.point_type == PointType::XYZ) {
-                for (size_t i = 0; i < cloud.size; ++i) {
-                    glVertex3fv(&((PointTypes::XYZ *)cloud.vertices + i)->x);
-                    if constexpr (draw_texture) {
-                        glTexCoord2fv(&((PointTypes::UV *)cloud.tex_coords + i)->u);
-                    }
-                }
+    //! Fuses several point clouds (e.g. of multiple cameras) into a single image in one pass. The camera poses
+    //! transform the points of each cloud into the common frame, which is then rendered like a single cloud.
+    template<bool draw_texture>
+    void render_pointclouds_into(const std::vector<Pointcloud>& clouds, const std::vector<Affine>& camera_poses, cv::Mat& output, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position) {
+        check_output(output, draw_texture);
 
-            } else if (cloud.point_type == PointType::XYZWRGBA) {
-                color_format = GL_RGBA;
+        CurrentContext current {*this};
+        draw_pointclouds<draw_texture>(clouds, camera_poses, pixel_density, min_depth, max_depth, camera_position);
+        read_output<draw_texture>(output);
+    }
 
-                for (size_t i = 0; i < cloud.size; ++i) {
-                    glVertex3fv(&((PointTypes::XYZWRGBA *)cloud.vertices + i)->x);
-                    if constexpr (draw_texture) {
-                        glColor3ubv(&((PointTypes::XYZWRGBA *)cloud.vertices + i)->r);
-                    }
-                }
-            }
+    //! Streaming render: Starts rendering the given cloud and returns the previous frame of the stream (copied into
+    //! the output image), so that the read-back of one frame overlaps with the upload and drawing of the next.
+    //! Returns nothing for the first frame of a stream.
+    template<bool draw_texture>
+    std::optional<OrthographicImage> render_pointcloud_async(const Pointcloud& cloud, cv::Mat& output, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position, const std::optional<Affine>& camera_pose = std::nullopt) {
+        CurrentContext current {*this};
+
+        const size_t index = pending_index;
+        if (pending_frames[index].valid) {
+            // Only if the frame before the previous one was never returned
+            glDeleteSync(pending_frames[index].fence);
+            pending_frames[index].fence = nullptr;
         }
-        glEnd();
 
-        glPixelStorei(GL_PACK_ALIGNMENT, (color.step & 3) ? 1 : 4);
-        glReadPixels(0, 0, depth_32f.cols, depth_32f.rows, GL_DEPTH_COMPONENT, GL_FLOAT, depth_32f.data);
-
-        depth_32f = (1 - depth_32f) * 255 * 255;
-        depth_32f.convertTo(depth_16u, CV_16U);
+        draw_pointcloud<draw_texture>(cloud, pixel_density, min_depth, max_depth, camera_position, camera_pose);
+        start_readback<draw_texture>(index, pixel_density, min_depth, max_depth);
 
-        if constexpr (!draw_texture)  {
-            cv::cvtColor(depth_16u, depth_16u, cv::COLOR_RGB2GRAY);
-            return depth_16u;
-        }
+        pending_index = (index + 1) % pending_frames.size();
+        return finish_readback(pending_index, output);
+    }
 
-        glReadPixels(0, 0, color.cols, color.rows, color_format, GL_UNSIGNED_SHORT, color.data);
+    //! Returns the last frame of the stream, if there is any left
+    std::optional<OrthographicImage> finish_pointcloud_async(cv::Mat& output) {
+        CurrentContext current {*this};
 
-        const int from_to[] = {0, 3};
-        mixChannels(&depth_16u, 1, &color, 1, from_to, 1);
-        return color;
+        const size_t index = (pending_index + pending_frames.size() - 1) % pending_frames.size();
+        return finish_readback(index, output);
     }
 };
\ No newline at end of file
@@ -0,0 +1,286 @@
+#pragma once
+
+#include <algorithm>
+#include <array>
+#include <atomic>
+#include <cstdint>
+#include <cstring>
+#include <limits>
+#include <memory>
+#include <mutex>
+#include <optional>
+#include <stdexcept>
+#include <vector>
+
+#include <opencv2/opencv.hpp>
+
+#include <affx/affine.hpp>
+#include <griffig/box_data.hpp>
+#include <griffig/camera_intrinsics.hpp>
+#include <griffig/orthographic_image.hpp>
+#include <griffig/parallel.hpp>
+#include <griffig/pointcloud.hpp>
+
+
+//! A pure CPU renderer for machines without EGL. It projects all points orthographically (like the OpenGL renderer)
+//! and keeps the nearest point per pixel, by a parallel scatter-min over a packed (depth, point index) key.
+class SoftwareRenderer {
+    using Affine = affx::Affine;
+
+    static constexpr uint64_t empty_pixel {std::numeric_limits<uint64_t>::max()};
+
+    //! Per pixel: the depth (as float bits) in the upper, and the index of the nearest point in the lower 32 bits
+    std::unique_ptr<std::atomic<uint64_t>[]> nearest;
+    size_t nearest_size {0};
+
+    //! The buffer above is shared between calls, so that a renderer can be used by one thread at a time
+    std::mutex nearest_mutex;
+
+    void clear_nearest(size_t size) {
+        if (size != nearest_size) {
+            nearest = std::make_unique<std::atomic<uint64_t>[]>(size);
+            nearest_size = size;
+        }
+
+        parallel_for(size, [&](size_t begin, size_t end) {
+            for (size_t i = begin; i < end; ++i) {
+                nearest[i].store(empty_pixel, std::memory_order_relaxed);
+            }
+        });
+    }
+
+    static void store_nearest(std::atomic<uint64_t>& pixel, uint64_t key) {
+        uint64_t current = pixel.load(std::memory_order_relaxed);
+        while (key < current && !pixel.compare_exchange_weak(current, key, std::memory_order_relaxed)) { }
+    }
+
+    void check_output(const cv::Mat& result, bool draw_texture) const {
+        if (result.size() != cv::Size(width, height) || result.type() != (draw_texture ? CV_16UC4 : CV_16UC1)) {
+            throw std::runtime_error("Output image does not match the renderer size or type.");
+        }
+    }
+
+    //! Same projection as glOrtho and gluLookAt of the OpenGL renderer, for a point in the render frame
+    void project_point(const std::array<float, 3>& p, size_t index, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position) {
+        const float depth = ((p[2] - camera_position[2]) - min_depth) / (max_depth - min_depth);
+        const double col = width / 2.0 - pixel_density * (p[0] - camera_position[0]);
+        const double row = height / 2.0 - pixel_density * (p[1] - camera_position[1]);
+
+        // Negated to skip NaN points as well
+        if (!(depth >= 0.0f && depth <= 1.0f && col >= 0.0 && col < width && row >= 0.0 && row < height)) {
+            return;
+        }
+
+        uint32_t depth_bits;
+        std::memcpy(&depth_bits, &depth, sizeof(depth));
+        store_nearest(nearest[(size_t)row * width + (size_t)col], ((uint64_t)depth_bits << 32) | (uint64_t)index);
+    }
+
+    void project_cloud(const Pointcloud& cloud, size_t index_offset, const PointTransform& transform, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position) {
+        parallel_for(cloud.size, [&](size_t begin, size_t end) {
+            for (size_t i = begin; i < end; ++i) {
+                project_point(transform((const float *)cloud.vertex(i)), index_offset + i, pixel_density, min_depth, max_depth, camera_position);
+            }
+        });
+    }
+
+    //! Writes the depth of the nearest point per pixel into the last channel, and its color via set_color(index, pixel)
+    template<bool draw_texture, class F>
+    void fill_output(cv::Mat& result, F&& set_color) {
+        parallel_for(height, [&](size_t begin, size_t end) {
+            for (size_t row = begin; row < end; ++row) {
+                for (size_t col = 0; col < (size_t)width; ++col) {
+                    const uint64_t key = nearest[row * width + col].load(std::memory_order_relaxed);
+                    if (key == empty_pixel) {
+                        continue;
+                    }
+
+                    const uint32_t depth_bits = key >> 32;
+                    const size_t index = key & 0xFFFFFFFF;
+
+                    float depth;
+                    std::memcpy(&depth, &depth_bits, sizeof(depth));
+                    const ushort value = cv::saturate_cast<ushort>((1.0f - depth) * 255 * 255);
+
+                    if constexpr (!draw_texture) {
+                        result.at<ushort>(row, col) = value;
+                        continue;
+                    }
+
+                    auto& pixel = result.at<cv::Vec4w>(row, col);
+                    pixel[3] = value;
+                    set_color(index, pixel);
+                }
+            }
+        }, 16);
+    }
+
+    template<bool draw_texture>
+    void fill_output(const std::vector<const Pointcloud*>& clouds, const std::vector<size_t>& index_offsets, cv::Mat& result) {
+        fill_output<draw_texture>(result, [&](size_t index, cv::Vec4w& pixel) {
+            const size_t c = std::upper_bound(index_offsets.begin(), index_offsets.end(), index) - index_offsets.begin() - 1;
+            const Pointcloud& cloud = *clouds[c];
+            const size_t i = index - index_offsets[c];
+
+            if (cloud.point_type == PointType::XYZWRGBA) {
+                const auto* point = (const PointTypes::XYZWRGBA *)cloud.vertex(i);
+                pixel[0] = 257 * point->r;
+                pixel[1] = 257 * point->g;
+                pixel[2] = 257 * point->b;
+
+            } else if (cloud.point_type == PointType::XYZ && cloud.has_texture()) {
+                // BGR order, same as the read-back of the OpenGL renderer
+                const auto rgb = sample_texture(cloud, i);
+                pixel[0] = 257 * rgb[2];
+                pixel[1] = 257 * rgb[1];
+                pixel[2] = 257 * rgb[0];
+            }
+        });
+    }
+
+    static cv::Vec3b sample_texture(const Pointcloud& cloud, size_t i) {
+        const auto& uv = *((const PointTypes::UV *)cloud.tex_coords + i);
+        const int x = std::clamp<int>(uv.u * cloud.width, 0, cloud.width - 1);
+        const int y = std::clamp<int>(uv.v * cloud.height, 0, cloud.height - 1);
+        const auto* texel = (const unsigned char *)cloud.texture + 3 * ((size_t)y * cloud.width + x);
+        return {texel[0], texel[1], texel[2]};
+    }
+
+public:
+    int width, height;
+    double pixel_size;
+    double typical_camera_distance;
+    double depth_diff;
+
+    std::optional<BoxData> box_contour;
+    std::array<double, 3> camera_position {0.0, 0.0, 0.0};
+
+    explicit SoftwareRenderer(const std::array<int, 2>& size, double typical_camera_distance, double pixel_size, double depth_diff): width(size[0]), height(size[1]), pixel_size(pixel_size), typical_camera_distance(typical_camera_distance), depth_diff(depth_diff) { }
+
+    explicit SoftwareRenderer(const BoxData& box_data, double typical_camera_distance, double pixel_size, double depth_diff): pixel_size(pixel_size), typical_camera_distance(typical_camera_distance), depth_diff(depth_diff), box_contour(box_data) {
+        const auto size = box_data.get_rect(pixel_size, 5);
+        width = size[0];
+        height = size[1];
+    }
+
+    template<bool draw_texture>
+    OrthographicImage render_pointcloud(const Pointcloud& cloud) {
+        const double min_depth = typical_camera_distance - depth_diff;
+        const double max_depth = typical_camera_distance;
+
+        return render_pointcloud<draw_texture>(cloud, pixel_size, min_depth, max_depth);
+    }
+
+    template<bool draw_texture>
+    OrthographicImage render_pointcloud(const Pointcloud& cloud, double pixel_density, double min_depth, double max_depth, const std::optional<Affine>& camera_pose = std::nullopt) {
+        cv::Mat mat = render_pointcloud_mat<draw_texture>(cloud, pixel_density, min_depth, max_depth, camera_position, camera_pose);
+        return OrthographicImage(mat, pixel_density, min_depth, max_depth);
+    }
+
+    template<bool draw_texture>
+    cv::Mat render_pointcloud_mat(const Pointcloud& cloud, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position, const std::optional<Affine>& camera_pose = std::nullopt) {
+        cv::Mat result {cv::Size(width, height), draw_texture ? CV_16UC4 : CV_16UC1};
+        render_pointcloud_into<draw_texture>(cloud, result, pixel_density, min_depth, max_depth, camera_position, camera_pose);
+        return result;
+    }
+
+    //! Render into a caller-owned (and reusable) image of the renderer size, either CV_16UC4 or CV_16UC1 without texture.
+    //! An optional camera pose transforms the points (in the camera frame) into the render frame.
+    template<bool draw_texture>
+    void render_pointcloud_into(const Pointcloud& cloud, cv::Mat& result, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position, const std::optional<Affine>& camera_pose = std::nullopt) {
+        check_output(result, draw_texture);
+
+        result.setTo(0);
+        if (!cloud.size) {
+            return;
+        }
+
+        std::lock_guard<std::mutex> lock {nearest_mutex};
+        clear_nearest((size_t)width * height);
+        project_cloud(cloud, 0, camera_pose ? PointTransform(*camera_pose) : PointTransform(), pixel_density, min_depth, max_depth, camera_position);
+        fill_output<draw_texture>({&cloud}, {0}, result);
+    }
+
+    //! Fuses several point clouds (e.g. of multiple cameras) into a single image. The camera poses transform the
+    //! points of each cloud into the common frame, which is then rendered like a single cloud.
+    template<bool draw_texture>
+    void render_pointclouds_into(const std::vector<Pointcloud>& clouds, const std::vector<Affine>& camera_poses, cv::Mat& result, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position) {
+        if (clouds.size() != camera_poses.size()) {
+            throw std::runtime_error("Each point cloud needs its own camera pose.");
+        }
+        check_output(result, draw_texture);
+
+        result.setTo(0);
+
+        std::lock_guard<std::mutex> lock {nearest_mutex};
+        clear_nearest((size_t)width * height);
+
+        // The points of all clouds are indexed consecutively
+        std::vector<const Pointcloud*> cloud_pointers (clouds.size());
+        std::vector<size_t> index_offsets (clouds.size());
+        size_t index_offset {0};
+        for (size_t i = 0; i < clouds.size(); ++i) {
+            cloud_pointers[i] = &clouds[i];
+            index_offsets[i] = index_offset;
+            index_offset += clouds[i].size;
+        }
+
+        if (index_offset > std::numeric_limits<uint32_t>::max()) {
+            throw std::runtime_error("Too many points to render.");
+        }
+
+        for (size_t i = 0; i < clouds.size(); ++i) {
+            project_cloud(clouds[i], index_offsets[i], PointTransform(camera_poses[i]), pixel_density, min_depth, max_depth, camera_position);
+        }
+
+        fill_output<draw_texture>(cloud_pointers, index_offsets, result);
+    }
+
+    //! Reprojects the depth image (CV_16UC1 or CV_32FC1) of a pinhole camera straight into the orthographic image, without
+    //! creating a point cloud. The optional color image (CV_8UC3 in RGB order) needs to be aligned to the depth image.
+    //! Invalid pixels with a depth of zero are skipped.
+    template<bool draw_texture>
+    void reproject_image_into(const cv::Mat& depth, const std::optional<cv::Mat>& color, const CameraIntrinsics& intrinsics, cv::Mat& result, double pixel_density, double min_depth, double max_depth, const std::array<double, 3>& camera_position, const std::optional<Affine>& camera_pose = std::nullopt) {
+        if (depth.type() != CV_16UC1 && depth.type() != CV_32FC1) {
+            throw std::runtime_error("Depth image must be either uint16 or float32.");
+        }
+        if (color && (color->type() != CV_8UC3 || color->size() != depth.size())) {
+            throw std::runtime_error("Color image must be an uint8 RGB image of the depth image size.");
+        }
+        if (depth.total() > std::numeric_limits<uint32_t>::max()) {
+            throw std::runtime_error("Too many pixels to reproject.");
+        }
+        check_output(result, draw_texture);
+
+        result.setTo(0);
+
+        std::lock_guard<std::mutex> lock {nearest_mutex};
+        clear_nearest((size_t)width * height);
+
+        const PointTransform transform = camera_pose ? PointTransform(*camera_pose) : PointTransform();
+        parallel_for(depth.rows, [&](size_t begin, size_t end) {
+            for (size_t v = begin; v < end; ++v) {
+                for (size_t u = 0; u < (size_t)depth.cols; ++u) {
+                    const double value = (depth.type() == CV_16UC1) ? depth.at<ushort>(v, u) : depth.at<float>(v, u);
+                    if (!(value > 0.0)) {
+                        continue;
+                    }
+
+                    const float z = value * intrinsics.depth_scale;
+                    const float point[3] = {(float)((u - intrinsics.cx) * z / intrinsics.fx), (float)((v - intrinsics.cy) * z / intrinsics.fy), z};
+                    project_point(transform(point), v * depth.cols + u, pixel_density, min_depth, max_depth, camera_position);
+                }
+            }
+        }, 16);
+
+        fill_output<draw_texture>(result, [&](size_t index, cv::Vec4w& pixel) {
+            if (color) {
+                // BGR order, same as textured point clouds
+                const auto& rgb = color->at<cv::Vec3b>(index / depth.cols, index % depth.cols);
+                pixel[0] = 257 * rgb[2];
+                pixel[1] = 257 * rgb[1];
+                pixel[2] = 257 * rgb[0];
+            }
+        });
+    }
+};
\ No newline at end of file
@@ -0,0 +1,78 @@
+#pragma once
+
+#include <array>
+#include <cstring>
+
+#include <GL/glew.h>
+
+
+class Texture {
+    GLuint gl_handle {0};
+
+    //! The storage is only allocated if the size changes, afterwards frames are streamed via sub-image uploads
+    size_t width {0}, height {0};
+
+    //! Double-buffered pixel unpack buffers, so that copying the next frame doesn't wait for the upload of the last one
+    std::array<GLuint, 2> pixel_buffers {0, 0};
+    size_t pixel_buffer_index {0};
+
+public:
+    explicit Texture() {
+        glGenTextures(1, &gl_handle);
+        glGenBuffers(pixel_buffers.size(), pixel_buffers.data());
+    }
+
+    ~Texture() {
+        glFinish();
+        glDeleteBuffers(pixel_buffers.size(), pixel_buffers.data());
+        glDeleteTextures(1, &gl_handle);
+    }
+
+    //! Uploads the data swapped into BGR order, so that textured clouds can be read back as RGBA like colored ones
+    void upload(size_t width, size_t height, const void* data) {
+        glBindTexture(GL_TEXTURE_2D, gl_handle);
+
+        // Rows of RGB data are not 4-byte aligned in general
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1);
+        glPixelStorei(GL_UNPACK_ROW_LENGTH, 0);
+
+        if (width != this->width || height != this->height) {
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, width, height, 0, GL_RGB, GL_UNSIGNED_BYTE, nullptr);
+
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR);
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR);
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP);
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP);
+
+            this->width = width;
+            this->height = height;
+        }
+
+        const size_t size = 3 * width * height;
+        pixel_buffer_index = (pixel_buffer_index + 1) % pixel_buffers.size();
+
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pixel_buffers[pixel_buffer_index]);
+        glBufferData(GL_PIXEL_UNPACK_BUFFER, size, nullptr, GL_STREAM_DRAW);
+
+        void* buffer = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, size, GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT);
+        if (buffer) {
+            std::memcpy(buffer, data, size);
+            glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER);
+
+            // Returns immediately, the transfer from the buffer into the texture runs asynchronously
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, width, height, GL_BGR, GL_UNSIGNED_BYTE, nullptr);
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
+
+        } else {
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, width, height, GL_BGR, GL_UNSIGNED_BYTE, data);
+        }
+
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 4);
+        glBindTexture(GL_TEXTURE_2D, 0);
+    }
+
+    GLuint get_gl_handle() const {
+        return gl_handle;
+    }
+};
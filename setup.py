@@ -101,5 +101,9 @@ setup(
         'scipy>=1.5',
         'Pillow',
     ],
-    python_requires='>=3.6',
+    extras_require={
+        'onnx': ['tf2onnx', 'onnxruntime', 'onnxconverter-common'],
+        'tflite': ['tflite-runtime'],
+    },
+    python_requires='>=3.7',
 )
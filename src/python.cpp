@@ -12,6 +12,160 @@ using namespace pybind11::literals; // to bring in the `_a` literal
 using Affine = affx::Affine;
 
 
+//! Wraps the (optional) output array without copying, or allocates a new one of the renderer size
+cv::Mat get_output_mat(std::optional<py::array>& out, int width, int height, bool draw_texture) {
+    if (!out) {
+        out = draw_texture ? py::array_t<uint16_t>({height, width, 4}) : py::array_t<uint16_t>({height, width});
+    }
+
+    if (!out->dtype().is(py::dtype::of<uint16_t>()) || !(out->flags() & py::array::c_style) || !out->writeable()) {
+        throw std::runtime_error("Output must be a writeable, C-contiguous uint16 array.");
+    }
+
+    cv::Mat mat;
+    NDArrayConverter::toMat(out->ptr(), mat);
+    return mat;
+}
+
+
+//! Checks that the buffer is C-contiguous, so that its memory can be referenced directly
+void check_contiguous(const py::buffer_info& info, const std::string& name) {
+    py::ssize_t stride = info.itemsize;
+    for (py::ssize_t i = info.ndim - 1; i >= 0; --i) {
+        if (info.shape[i] > 1 && info.strides[i] != stride) {
+            throw std::runtime_error("The " + name + " must be a C-contiguous buffer.");
+        }
+        stride *= info.shape[i];
+    }
+}
+
+
+//! Whether the buffer holds scalars (e.g. an (N, 3) float32 array) instead of whole points (e.g. structured arrays or bytes)
+bool is_scalar_format(const std::string& format, char type) {
+    return format.size() == 1 ? (format[0] == type) : (format.size() == 2 && std::string("@=<").find(format[0]) != std::string::npos && format[1] == type);
+}
+
+
+//! References the points of any C-contiguous buffer without copying. The point type is either given, or inferred
+//! from a float32 array of shape (N, 3) or (N, 6), or from the item size of a structured array.
+Pointcloud wrap_points(const py::buffer& points, std::optional<PointType> type) {
+    const py::buffer_info info = points.request();
+    check_contiguous(info, "points");
+
+    const bool is_float = is_scalar_format(info.format, 'f');
+    const bool is_byte = is_scalar_format(info.format, 'B') || is_scalar_format(info.format, 'b') || is_scalar_format(info.format, 'c');
+    const size_t byte_size = info.size * info.itemsize;
+
+    if (!is_float && !is_byte && info.format.size() <= 2) {
+        throw std::runtime_error("Points must be float32, bytes or a structured array, not of format '" + info.format + "'.");
+    }
+
+    // The size of a single point as given by the buffer layout, or zero if it's not determined (e.g. for bytes)
+    size_t layout_point_size {0};
+    if (is_float && info.ndim >= 2) {
+        layout_point_size = info.shape[info.ndim - 1] * info.itemsize;
+    } else if (!is_float && !is_byte) {
+        layout_point_size = info.itemsize;
+    }
+
+    if (!type) {
+        switch (layout_point_size) {
+            case sizeof(PointTypes::XYZ): type = PointType::XYZ; break;
+            case sizeof(PointTypes::XYZRGB): type = PointType::XYZRGB; break;
+            case sizeof(PointTypes::XYZWRGBA): type = is_float ? std::nullopt : std::optional<PointType>(PointType::XYZWRGBA); break;
+        }
+
+        if (!type) {
+            throw std::runtime_error("Could not infer the point type from the buffer, please pass the type explicitly.");
+        }
+    }
+
+    const size_t point_size = Pointcloud::point_size(*type);
+    if ((layout_point_size && layout_point_size != point_size) || byte_size % point_size != 0) {
+        throw std::runtime_error("The buffer layout does not match the point type, expected " + std::to_string(point_size) + " bytes per point.");
+    }
+
+    return Pointcloud(byte_size / point_size, *type, info.ptr);
+}
+
+
+//! A read-only array that references the memory of (and keeps alive) the given owner
+template<class T>
+py::array readonly_view(const std::vector<size_t>& shape, const std::vector<size_t>& strides, const void* data, py::handle owner) {
+    static const T empty {};
+    py::array_t<T> result {shape, strides, data ? (const T *)data : &empty, owner};
+    result.attr("setflags")("write"_a=false);
+    return result;
+}
+
+
+template<class R, bool draw_texture>
+py::array render_pointcloud_mat(R& renderer, const Pointcloud& cloud, double pixel_size, double min_depth, double max_depth, const std::array<double, 3>& camera_position, const std::optional<Affine>& camera_pose, std::optional<py::array> out) {
+    cv::Mat mat = get_output_mat(out, renderer.width, renderer.height, draw_texture);
+    {
+        py::gil_scoped_release release;
+        renderer.template render_pointcloud_into<draw_texture>(cloud, mat, pixel_size, min_depth, max_depth, camera_position, camera_pose);
+    }
+    return *out;
+}
+
+
+template<class R, bool draw_texture>
+OrthographicImage render_pointcloud(R& renderer, const Pointcloud& cloud, double pixel_size, double min_depth, double max_depth, const std::optional<Affine>& camera_pose, std::optional<py::array> out) {
+    cv::Mat mat = get_output_mat(out, renderer.width, renderer.height, draw_texture);
+    {
+        py::gil_scoped_release release;
+        renderer.template render_pointcloud_into<draw_texture>(cloud, mat, pixel_size, min_depth, max_depth, renderer.camera_position, camera_pose);
+    }
+    return OrthographicImage(mat, pixel_size, min_depth, max_depth);
+}
+
+
+template<class R, bool draw_texture>
+OrthographicImage render_pointclouds(R& renderer, const std::vector<Pointcloud>& clouds, const std::vector<Affine>& camera_poses, std::optional<py::array> out) {
+    const double min_depth = renderer.typical_camera_distance - renderer.depth_diff;
+    const double max_depth = renderer.typical_camera_distance;
+
+    cv::Mat mat = get_output_mat(out, renderer.width, renderer.height, draw_texture);
+    {
+        py::gil_scoped_release release;
+        renderer.template render_pointclouds_into<draw_texture>(clouds, camera_poses, mat, renderer.pixel_size, min_depth, max_depth, renderer.camera_position);
+    }
+    return OrthographicImage(mat, renderer.pixel_size, min_depth, max_depth);
+}
+
+
+template<bool draw_texture>
+OrthographicImage reproject_image(SoftwareRenderer& renderer, const cv::Mat& depth, const CameraIntrinsics& intrinsics, const std::optional<cv::Mat>& color, const std::optional<Affine>& camera_pose, std::optional<py::array> out) {
+    const double min_depth = renderer.typical_camera_distance - renderer.depth_diff;
+    const double max_depth = renderer.typical_camera_distance;
+
+    cv::Mat mat = get_output_mat(out, renderer.width, renderer.height, draw_texture);
+    {
+        py::gil_scoped_release release;
+        renderer.reproject_image_into<draw_texture>(depth, color, intrinsics, mat, renderer.pixel_size, min_depth, max_depth, renderer.camera_position, camera_pose);
+    }
+    return OrthographicImage(mat, renderer.pixel_size, min_depth, max_depth);
+}
+
+
+template<class R>
+void def_render_pointcloud(py::class_<R>& c) {
+    c.def("render_pointcloud", [](R& self, const Pointcloud& cloud, const std::optional<Affine>& camera_pose, std::optional<py::array> out) {
+            return render_pointcloud<R, true>(self, cloud, self.pixel_size, self.typical_camera_distance - self.depth_diff, self.typical_camera_distance, camera_pose, out);
+        }, "pointcloud"_a, "camera_pose"_a = std::nullopt, "out"_a = py::none())
+        .def("render_pointcloud", &render_pointcloud<R, true>, "pointcloud"_a, "pixel_size"_a, "min_depth"_a, "max_depth"_a, "camera_pose"_a = std::nullopt, "out"_a = py::none())
+        .def("render_depth_pointcloud", [](R& self, const Pointcloud& cloud, const std::optional<Affine>& camera_pose, std::optional<py::array> out) {
+            return render_pointcloud<R, false>(self, cloud, self.pixel_size, self.typical_camera_distance - self.depth_diff, self.typical_camera_distance, camera_pose, out);
+        }, "pointcloud"_a, "camera_pose"_a = std::nullopt, "out"_a = py::none())
+        .def("render_depth_pointcloud", &render_pointcloud<R, false>, "pointcloud"_a, "pixel_size"_a, "min_depth"_a, "max_depth"_a, "camera_pose"_a = std::nullopt, "out"_a = py::none())
+        .def("render_pointclouds", &render_pointclouds<R, true>, "pointclouds"_a, "camera_poses"_a, "out"_a = py::none())
+        .def("render_depth_pointclouds", &render_pointclouds<R, false>, "pointclouds"_a, "camera_poses"_a, "out"_a = py::none())
+        .def("render_pointcloud_mat", &render_pointcloud_mat<R, true>, "pointcloud"_a, "pixel_size"_a, "min_depth"_a, "max_depth"_a, "camera_position"_a = (std::array<double, 3>){0.0, 0.0, 0.0}, "camera_pose"_a = std::nullopt, "out"_a = py::none())
+        .def("render_depth_pointcloud_mat", &render_pointcloud_mat<R, false>, "pointcloud"_a, "pixel_size"_a, "min_depth"_a, "max_depth"_a, "camera_position"_a = (std::array<double, 3>){0.0, 0.0, 0.0}, "camera_pose"_a = std::nullopt, "out"_a = py::none());
+}
+
+
 PYBIND11_MODULE(_griffig, m) {
     NDArrayConverter::init_numpy();
 
@@ -98,29 +252,137 @@ PYBIND11_MODULE(_griffig, m) {
             const void* tex_coords = tex_coords_buf.request().ptr;
 
             auto result = std::make_unique<Pointcloud>(size, width, height, vertices, texture, tex_coords);
-            result->pc = std::move(pc);
+            result->pc = py::make_tuple(pc, points, color);  // Keeps the frames of the referenced buffers alive
             return result;
         }), py::kw_only(), "realsense_frames"_a=py::none())
         .def(py::init([](py::object ros_message) {
-            py::object data = ros_message.attr("data");
-            const size_t point_size = sizeof(PointTypes::XYZWRGBA);
-	        py::buffer_info info(py::buffer((py::bytes)data).request());
-            return std::make_unique<Pointcloud>(static_cast<size_t>(info.size) / point_size, PointType::XYZWRGBA, info.ptr);
+            py::buffer data = ros_message.attr("data");
+
+            // Messages without a layout are packed XYZWRGBA points
+            if (!py::hasattr(ros_message, "fields")) {
+                auto result = std::make_unique<Pointcloud>(wrap_points(data, PointType::XYZWRGBA));
+                result->pc = std::move(data);
+                return result;
+            }
+
+            Pointcloud2Layout layout;
+            layout.width = ros_message.attr("width").cast<size_t>();
+            layout.height = ros_message.attr("height").cast<size_t>();
+            layout.point_step = ros_message.attr("point_step").cast<size_t>();
+            layout.row_step = ros_message.attr("row_step").cast<size_t>();
+            layout.is_bigendian = ros_message.attr("is_bigendian").cast<bool>();
+
+            for (py::handle field: ros_message.attr("fields")) {
+                const auto name = field.attr("name").cast<std::string>();
+                const Pointcloud2Layout::Field layout_field {field.attr("offset").cast<size_t>(), field.attr("datatype").cast<uint8_t>()};
+
+                if (name == "x") {
+                    layout.x = layout_field;
+                } else if (name == "y") {
+                    layout.y = layout_field;
+                } else if (name == "z") {
+                    layout.z = layout_field;
+                } else if (name == "rgb" || name == "rgba") {
+                    layout.rgb = layout_field;
+                }
+            }
+
+            const py::buffer_info info = data.request();
+            auto result = std::make_unique<Pointcloud>();
+            {
+                py::gil_scoped_release release;
+                *result = layout.to_pointcloud(info.ptr, info.size * info.itemsize);
+            }
+            result->pc = std::move(data);  // Keeps referenced points alive
+            return result;
         }), py::kw_only(), "ros_message"_a=py::none())
-        .def(py::init([](PointType type, py::object data) {
-            size_t point_size;
-	        switch (type) {
-		        default:
-		        case PointType::XYZWRGBA: { point_size = sizeof(PointTypes::XYZWRGBA); } break;
-		        case PointType::XYZ: { point_size = sizeof(PointTypes::XYZ); } break;
-		        case PointType::XYZRGB: { point_size = sizeof(PointTypes::XYZRGB); } break;
-	        }
-
-	        py::buffer_info info(py::buffer((py::bytes)data).request());
-            return std::make_unique<Pointcloud>(static_cast<size_t>(info.size) / point_size, type, info.ptr);
+        .def(py::init([](PointType type, py::buffer data) {
+            auto result = std::make_unique<Pointcloud>(wrap_points(data, type));
+            result->pc = std::move(data);
+            return result;
         }), py::kw_only(), "type"_a=PointType::XYZWRGBA, "data"_a=py::none())
+        .def(py::init([](py::buffer points, std::optional<PointType> type, std::optional<py::buffer> texture, std::optional<py::buffer> tex_coords) {
+            auto result = std::make_unique<Pointcloud>(wrap_points(points, type));
+
+            if (texture.has_value() != tex_coords.has_value()) {
+                throw std::runtime_error("A texture needs texture coordinates and vice versa.");
+            }
+
+            if (texture) {
+                if (result->point_type != PointType::XYZ) {
+                    throw std::runtime_error("Only XYZ points can be textured.");
+                }
+
+                const py::buffer_info texture_info = texture->request();
+                check_contiguous(texture_info, "texture");
+                if (texture_info.ndim != 3 || texture_info.shape[2] != 3 || !is_scalar_format(texture_info.format, 'B')) {
+                    throw std::runtime_error("The texture must be an uint8 RGB image of shape (height, width, 3).");
+                }
+
+                const Pointcloud uv = wrap_points(*tex_coords, PointType::UV);
+                if (uv.size != result->size) {
+                    throw std::runtime_error("Each point needs its own texture coordinates.");
+                }
+
+                *result = Pointcloud(result->size, texture_info.shape[1], texture_info.shape[0], result->vertices, texture_info.ptr, uv.vertices);
+            }
+
+            // Keep all referenced buffers alive as long as the point cloud
+            result->pc = py::make_tuple(points, texture, tex_coords);
+            return result;
+        }), py::kw_only(), "points"_a, "type"_a=std::nullopt, "texture"_a=std::nullopt, "tex_coords"_a=std::nullopt)
         .def_readonly("size", &Pointcloud::size)
-        .def_readonly("point_type", &Pointcloud::point_type);
+        .def_readonly("point_type", &Pointcloud::point_type)
+        .def_readonly("width", &Pointcloud::width)
+        .def_readonly("height", &Pointcloud::height)
+        .def_property_readonly("vertices", [](py::object self) {
+            const auto& cloud = self.cast<const Pointcloud&>();
+            const size_t point_size = Pointcloud::point_size(cloud.point_type);
+            return readonly_view<uint8_t>({cloud.size, point_size}, {cloud.stride(), sizeof(uint8_t)}, cloud.vertices, self);
+        })
+        .def_property_readonly("texture", [](py::object self) -> std::optional<py::array> {
+            const auto& cloud = self.cast<const Pointcloud&>();
+            if (!cloud.has_texture()) {
+                return std::nullopt;
+            }
+            return readonly_view<uint8_t>({(size_t)cloud.height, (size_t)cloud.width, (size_t)3}, {3 * (size_t)cloud.width, (size_t)3, sizeof(uint8_t)}, cloud.texture, self);
+        })
+        .def_property_readonly("tex_coords", [](py::object self) -> std::optional<py::array> {
+            const auto& cloud = self.cast<const Pointcloud&>();
+            if (!cloud.has_texture()) {
+                return std::nullopt;
+            }
+            return readonly_view<float>({cloud.size, (size_t)2}, {sizeof(PointTypes::UV), sizeof(float)}, cloud.tex_coords, self);
+        });
+
+    py::class_<CameraIntrinsics>(m, "CameraIntrinsics")
+        .def(py::init<double, double, double, double, double>(), "fx"_a, "fy"_a, "cx"_a, "cy"_a, "depth_scale"_a = 0.001)
+        .def_readwrite("fx", &CameraIntrinsics::fx)
+        .def_readwrite("fy", &CameraIntrinsics::fy)
+        .def_readwrite("cx", &CameraIntrinsics::cx)
+        .def_readwrite("cy", &CameraIntrinsics::cy)
+        .def_readwrite("depth_scale", &CameraIntrinsics::depth_scale);
+
+    py::class_<PointcloudFilter>(m, "PointcloudFilter")
+        .def(py::init<const std::optional<BoxData>&, double, double, double, const std::array<int, 2>&, const std::array<double, 3>&, const std::optional<Affine>&, bool, double>(), "box_data"_a = std::nullopt, "min_depth"_a = 0.0, "max_depth"_a = std::numeric_limits<double>::infinity(), "pixel_size"_a = 0.0, "size"_a = (std::array<int, 2>){0, 0}, "camera_position"_a = (std::array<double, 3>){0.0, 0.0, 0.0}, "camera_pose"_a = std::nullopt, "remove_outliers"_a = false, "outlier_std_ratio"_a = 2.0)
+        .def_readwrite("box_data", &PointcloudFilter::box_data)
+        .def_readwrite("min_depth", &PointcloudFilter::min_depth)
+        .def_readwrite("max_depth", &PointcloudFilter::max_depth)
+        .def_readwrite("pixel_size", &PointcloudFilter::pixel_size)
+        .def_readwrite("size", &PointcloudFilter::size)
+        .def_readwrite("camera_position", &PointcloudFilter::camera_position)
+        .def_readwrite("camera_pose", &PointcloudFilter::camera_pose)
+        .def_readwrite("remove_outliers", &PointcloudFilter::remove_outliers)
+        .def_readwrite("outlier_std_ratio", &PointcloudFilter::outlier_std_ratio)
+        .def("apply", [](const PointcloudFilter& self, const Pointcloud& cloud) {
+            Pointcloud result;
+            {
+                py::gil_scoped_release release;
+                result = self.apply(cloud);
+            }
+            result.pc = cloud.pc;  // Keeps the texture alive
+            return result;
+        }, "pointcloud"_a);
 
     py::class_<RobotPose, Affine>(m, "RobotPose")
         .def(py::init<const Affine&, double>(), "affine"_a, "d"_a)
@@ -155,21 +417,61 @@ PYBIND11_MODULE(_griffig, m) {
             return d;
         });
 
-    py::class_<Renderer>(m, "Renderer")
+    py::enum_<RenderMode>(m, "RenderMode")
+        .value("Immediate", RenderMode::Immediate)
+        .value("VertexBuffer", RenderMode::VertexBuffer)
+        .export_values();
+
+    py::class_<Renderer> renderer(m, "Renderer");
+    renderer
         .def(py::init<const std::array<int, 2>&, double, double, double>(), "size"_a, "typical_camera_distance"_a, "pixel_size"_a, "depth_diff"_a)
         .def(py::init<const BoxData&, double, double, double>(), "box_data"_a, "typical_camera_distance"_a, "pixel_size"_a, "depth_diff"_a)
-        .def("draw_gripper_on_image", &Renderer::draw_gripper_on_image, "image"_a, "gripper"_a, "pose"_a)
-        .def("draw_box_on_image", &Renderer::draw_box_on_image, "image"_a)
-        .def("check_gripper_collision", &Renderer::check_gripper_collision, "image"_a, "gripper"_a, "pose"_a)
-        .def("render_pointcloud", static_cast<OrthographicImage (Renderer::*)(const Pointcloud&)>(&Renderer::render_pointcloud<true>))
-        .def("render_pointcloud", static_cast<OrthographicImage (Renderer::*)(const Pointcloud&, double, double, double)>(&Renderer::render_pointcloud<true>))
-        .def("render_pointcloud_mat", &Renderer::render_pointcloud_mat<true>, "pointcloud"_a, "pixel_size"_a, "min_depth"_a, "max_depth"_a, "camera_position"_a = (std::array<double, 3>){0.0, 0.0, 0.0})
-        .def("render_depth_pointcloud_mat", &Renderer::render_pointcloud_mat<false>)
+        .def("draw_gripper_on_image", &Renderer::draw_gripper_on_image, "image"_a, "gripper"_a, "pose"_a, py::call_guard<py::gil_scoped_release>())
+        .def("draw_box_on_image", &Renderer::draw_box_on_image, "image"_a, py::call_guard<py::gil_scoped_release>())
+        .def("check_gripper_collision", &Renderer::check_gripper_collision, "image"_a, "gripper"_a, "pose"_a, py::call_guard<py::gil_scoped_release>())
+        .def("check_gripper_collisions", &Renderer::check_gripper_collisions, "image"_a, "gripper"_a, "poses"_a, py::call_guard<py::gil_scoped_release>())
+        .def("calculate_gripper_penetrations", [](Renderer& self, const OrthographicImage& image, const Gripper& gripper, const std::vector<RobotPose>& poses) {
+            std::vector<double> penetrations;
+            {
+                py::gil_scoped_release release;
+                penetrations = self.calculate_gripper_penetrations(image, gripper, poses);
+            }
+            return py::array_t<double>(penetrations.size(), penetrations.data());
+        }, "image"_a, "gripper"_a, "poses"_a)
+        .def("render_pointcloud_async", [](Renderer& self, const Pointcloud& cloud, const std::optional<Affine>& camera_pose, std::optional<py::array> out) {
+            cv::Mat mat = get_output_mat(out, self.width, self.height, true);
+            py::gil_scoped_release release;
+            return self.render_pointcloud_async<true>(cloud, mat, self.pixel_size, self.typical_camera_distance - self.depth_diff, self.typical_camera_distance, self.camera_position, camera_pose);
+        }, "pointcloud"_a, "camera_pose"_a = std::nullopt, "out"_a = py::none())
+        .def("finish_pointcloud_async", [](Renderer& self, std::optional<py::array> out) {
+            cv::Mat mat = get_output_mat(out, self.width, self.height, true);
+            py::gil_scoped_release release;
+            return self.finish_pointcloud_async(mat);
+        }, "out"_a = py::none())
 	    .def_readwrite("camera_position", &Renderer::camera_position)
+        .def_readwrite("render_mode", &Renderer::render_mode)
         .def_readwrite("box_data", &Renderer::box_contour)
         .def_readwrite("pixel_size", &Renderer::pixel_size)
         .def_readwrite("typical_camera_distance", &Renderer::typical_camera_distance)
         .def_readwrite("depth_diff", &Renderer::depth_diff)
         .def_readwrite("width", &Renderer::width)
         .def_readwrite("height", &Renderer::height);
+    def_render_pointcloud(renderer);
+
+    py::class_<SoftwareRenderer> software_renderer(m, "SoftwareRenderer");
+    software_renderer
+        .def(py::init<const std::array<int, 2>&, double, double, double>(), "size"_a, "typical_camera_distance"_a, "pixel_size"_a, "depth_diff"_a)
+        .def(py::init<const BoxData&, double, double, double>(), "box_data"_a, "typical_camera_distance"_a, "pixel_size"_a, "depth_diff"_a)
+        .def("reproject_image", &reproject_image<true>, "depth"_a, "intrinsics"_a, "color"_a = std::nullopt, "camera_pose"_a = std::nullopt, "out"_a = py::none())
+        .def("reproject_depth_image", [](SoftwareRenderer& self, const cv::Mat& depth, const CameraIntrinsics& intrinsics, const std::optional<Affine>& camera_pose, std::optional<py::array> out) {
+            return reproject_image<false>(self, depth, intrinsics, std::nullopt, camera_pose, out);
+        }, "depth"_a, "intrinsics"_a, "camera_pose"_a = std::nullopt, "out"_a = py::none())
+        .def_readwrite("camera_position", &SoftwareRenderer::camera_position)
+        .def_readwrite("box_data", &SoftwareRenderer::box_contour)
+        .def_readwrite("pixel_size", &SoftwareRenderer::pixel_size)
+        .def_readwrite("typical_camera_distance", &SoftwareRenderer::typical_camera_distance)
+        .def_readwrite("depth_diff", &SoftwareRenderer::depth_diff)
+        .def_readwrite("width", &SoftwareRenderer::width)
+        .def_readwrite("height", &SoftwareRenderer::height);
+    def_render_pointcloud(software_renderer);
 }
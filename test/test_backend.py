@@ -0,0 +1,51 @@
+from importlib.util import find_spec
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+import numpy as np
+
+from griffig import Backend, Precision
+from griffig.infer.backend import export_onnx, export_tflite, get_converted_path, load_onnx, load_tflite
+
+
+def create_keras_model(number_channels: int):
+    """A tiny fully convolutional model, with the image size left open like the grasp models"""
+    import tensorflow.keras as tk
+
+    inputs = tk.Input((None, None, number_channels))
+    x = tk.layers.Conv2D(8, 5, strides=2, activation='relu')(inputs)
+    x = tk.layers.Conv2D(3, 3, activation='sigmoid')(x)
+    return tk.Model(inputs, x)
+
+
+@unittest.skipIf(find_spec('tensorflow') is None, 'TensorFlow is not installed')
+class BackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def check_round_trip(self, backend: Backend, export, load):
+        with TemporaryDirectory() as directory:
+            for number_channels in [1, 4]:
+                model = create_keras_model(number_channels)
+                converted_path = get_converted_path(Path(directory), backend, Precision.FP32, f'grasp-{number_channels}')
+
+                export(model, converted_path, Precision.FP32)
+                predict, detected_number_channels = load(converted_path)
+                self.assertEqual(detected_number_channels, number_channels)
+
+                # Different crop sizes, as for different boxes
+                for size in [40, 56]:
+                    x = self.rng.random((20, size, size, number_channels), dtype=np.float32)
+                    np.testing.assert_allclose(predict(x), model(x, training=False).numpy(), rtol=1e-4, atol=1e-5)
+
+    @unittest.skipIf(find_spec('tf2onnx') is None or find_spec('onnxruntime') is None, 'tf2onnx or ONNX Runtime is not installed')
+    def test_onnx(self):
+        self.check_round_trip(Backend.ONNX, export_onnx, load_onnx)
+
+    def test_tflite(self):
+        self.check_round_trip(Backend.TFLite, export_tflite, load_tflite)
+
+
+if __name__ == '__main__':
+    unittest.main()
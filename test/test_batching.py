@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+import unittest
+
+import numpy as np
+
+from griffig import BatchedModel
+
+
+class BatchingTestCase(unittest.TestCase):
+    def test_batched_model(self):
+        def model(x):
+            return [x.sum(axis=(1, 2, 3)), x[:, ::2, ::2] * 2.0]
+
+        # All requests are queued before the batched model starts, so that they are collected in a single batch
+        batched_model = BatchedModel(model, max_wait=0.0, start=False)
+        rng = np.random.default_rng(0)
+        inputs = [rng.random((20, s, s, 1), dtype=np.float32) for s in (32, 32, 32, 40)]
+
+        def call(x):
+            return batched_model(x), batched_model.last_metrics
+
+        with ThreadPoolExecutor(max_workers=len(inputs)) as executor:
+            futures = [executor.submit(call, x) for x in inputs]
+            while batched_model.queue.qsize() < len(inputs):
+                sleep(0.001)
+
+            batched_model.start()
+            results = [future.result() for future in futures]
+
+        for x, (output, metrics) in zip(inputs, results):
+            expected = model(x)
+            np.testing.assert_allclose(output[0], expected[0], rtol=1e-5)
+            np.testing.assert_array_equal(output[1], expected[1])
+
+        # Calls with the same input shape share a forward pass
+        self.assertEqual([m['batch_size'] for _, m in results], [60, 60, 60, 20])
+        self.assertEqual([m['requests'] for _, m in results], [3, 3, 3, 1])
+        self.assertEqual(len(batched_model.metrics), len(inputs))
+        batched_model.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
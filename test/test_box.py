@@ -2,8 +2,11 @@ from pathlib import Path
 import unittest
 
 import cv2
+import numpy as np
 
 from griffig import BoxData, Grasp, Griffig, RobotPose
+from griffig.utility.image import _get_inference_maps, draw_around_box2, fill_around_box, get_box_geometry, get_inference_image, get_inference_maps, get_roi_geometry
+from pyaffx import Affine
 
 from loader import Loader
 
@@ -29,6 +32,62 @@ class BoxTestCase(unittest.TestCase):
         # print(self.box_data.is_pose_inside(RobotPose(grasp.pose, d=grasp.stroke)))
         # cv2.imwrite(str(self.output_path / 'image-box-check-d.jpg'), image.mat[:, :, 3] / 255)
 
+    def test_fill_around_box(self):
+        image = Loader.get_image('1')
+        image_drawn = image.clone()
+        draw_around_box2(image_drawn, self.box_data)
+
+        mat = fill_around_box(image, self.box_data)
+        np.testing.assert_array_equal(mat, image_drawn.mat)
+        self.assertFalse(np.shares_memory(mat, image.mat))
+
+        # The geometry is computed only once per box, image size and pixel size
+        self.assertIs(get_box_geometry(image, self.box_data)[1], get_box_geometry(image_drawn, self.box_data)[1])
+
+    def test_inference_maps(self):
+        image = Loader.get_image('1')
+        size_cropped, size_area_cropped, size_result = (110, 110), (200, 200), (32, 32)
+        a_space = np.linspace(-np.pi/2 + 0.1, np.pi/2 - 0.1, 20)
+
+        maps = get_inference_maps(image, size_cropped, size_area_cropped, size_result, a_space)
+        self.assertIs(maps, get_inference_maps(image, size_cropped, size_area_cropped, size_result, list(a_space)))
+
+        # Both interpolate linearly at 1/32 pixel, but round the (differently computed) source positions differently. On
+        # these smooth images, values differ by a few of the 65535 levels, far below one step of the 8-bit source (255).
+        for i, a in enumerate(a_space):
+            expected = get_inference_image(image, Affine(a=a), size_cropped, size_area_cropped, size_result, return_mat=True)
+            mat = cv2.remap(image.mat, maps[i, 0], maps[i, 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            self.assertLessEqual(np.max(np.abs(mat.astype(np.int32) - expected)), 6)
+
+        # An offset translates the cached maps, so that a moving region of interest doesn't miss the cache
+        misses = _get_inference_maps.cache_info().misses
+        for offset in [(12.0, -7.0), (-30.0, 25.0)]:
+            maps_offset = get_inference_maps(image, size_cropped, size_area_cropped, size_result, a_space, offset)
+            np.testing.assert_allclose(maps_offset[:, 0], maps[:, 0] - offset[0], atol=1e-3)
+            np.testing.assert_allclose(maps_offset[:, 1], maps[:, 1] - offset[1], atol=1e-3)
+        self.assertEqual(_get_inference_maps.cache_info().misses, misses)
+
+    def test_roi_geometry(self):
+        image = Loader.get_image('1')
+        roi = [[0.02, 0.04], [0.02, 0.10], [-0.03, 0.10], [-0.03, 0.04]]  # [m]
+
+        mask, center, radius = get_roi_geometry(image, roi)
+        self.assertTrue(mask[center[1], center[0]])
+        self.assertAlmostEqual(radius, np.hypot(0.05, 0.06) / 2 * image.pixel_size + 1.0, delta=2.0)
+
+        # The same region given as mask
+        mask_from_mask, center_from_mask, _ = get_roi_geometry(image, mask)
+        np.testing.assert_array_equal(mask_from_mask, mask)
+        self.assertLessEqual(np.max(np.abs(np.array(center_from_mask) - center)), 1)
+
+        # The crop around the region is the same as of the inference image centered at the region
+        offset = (image.mat.shape[1] / 2 - center[0], image.mat.shape[0] / 2 - center[1])
+        pose = Affine(x=offset[1] / image.pixel_size, y=offset[0] / image.pixel_size, a=0.3)
+        maps = get_inference_maps(image, (60, 60), (200, 200), (32, 32), [pose.a], offset)
+        expected = get_inference_image(image, pose, (60, 60), (200, 200), (32, 32), return_mat=True)
+        mat = cv2.remap(image.mat, maps[0, 0], maps[0, 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        self.assertLessEqual(np.max(np.abs(mat.astype(np.int32) - expected)), 6)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -13,9 +13,15 @@ class DrawTestCase(unittest.TestCase):
 
     def setUp(self):
         self.box_data = BoxData([-0.002, -0.0065, 0.0], [0.174, 0.282, 0.0])
-        self.renderer = Renderer((752, 480), 0.41, 2000.0, 0.19)
         self.gripper = Gripper(min_stroke=0.0, max_stroke=0.086, finger_width=0.024, finger_extent=0.008)
 
+    def create_renderer(self):
+        """The OpenGL renderer, or skip the test on machines without EGL"""
+        try:
+            return Renderer((752, 480), 0.41, 2000.0, 0.19)
+        except RuntimeError as e:
+            self.skipTest(f'OpenGL renderer is not available: {e}')
+
     def test_draw_box_on_image(self):
         image = Loader.get_image('1')
         Griffig.draw_box_on_image(image, self.box_data)
@@ -28,7 +34,7 @@ class DrawTestCase(unittest.TestCase):
         image = Loader.get_image('1')
         pose = RobotPose(x=0.04, y=-0.01, z=-0.34, a=0.0, b=-0.3, d=0.05)
 
-        self.renderer.draw_gripper_on_image(image, self.gripper, pose)
+        self.create_renderer().draw_gripper_on_image(image, self.gripper, pose)
         img_c = Griffig.convert_to_pillow_image(image, channels='RGB')
         img_c.save(self.output_path / 'image-gripper-c.png')
         img_d = Griffig.convert_to_pillow_image(image, channels='D')
@@ -46,12 +52,25 @@ class DrawTestCase(unittest.TestCase):
         img_c.save(self.output_path / 'image-pose-d.png')
 
     def test_check_collision(self):
+        renderer = self.create_renderer()
         image = Loader.get_image('1')
         pose1 = RobotPose(x=0.04, y=-0.01, z=-0.34, a=0.0, b=-0.3, d=0.05)
-        self.assertFalse(self.renderer.check_gripper_collision(image, self.gripper, pose1))
+        self.assertFalse(renderer.check_gripper_collision(image, self.gripper, pose1))
 
         pose2 = RobotPose(x=0.04, y=0.0, z=-0.34, a=0.0, b=-0.2, d=0.05)
-        self.assertTrue(self.renderer.check_gripper_collision(image, self.gripper, pose2))
+        self.assertTrue(renderer.check_gripper_collision(image, self.gripper, pose2))
+
+    def test_check_collisions(self):
+        renderer = self.create_renderer()
+        image = Loader.get_image('1')
+        poses = [RobotPose(x=0.04, y=0.01 * i - 0.01, z=-0.34, a=0.0, b=-0.3 + 0.05 * i, d=0.05) for i in range(6)]
+
+        collisions = renderer.check_gripper_collisions(image, self.gripper, poses)
+        self.assertEqual(collisions, [renderer.check_gripper_collision(image, self.gripper, p) for p in poses])
+
+        penetrations = renderer.calculate_gripper_penetrations(image, self.gripper, poses)
+        self.assertEqual(len(penetrations), len(poses))
+        self.assertEqual(collisions, [bool(p > 0.0) for p in penetrations])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,19 @@
+import subprocess
+import sys
+import unittest
+
+
+class ImportTestCase(unittest.TestCase):
+    def test_lazy_import(self):
+        # Run in a fresh interpreter, as the other tests already import everything
+        code = 'import sys, griffig; griffig.BoxData; print(" ".join(m for m in ("tensorflow", "scipy", "cv2", "PIL", "requests") if m in sys.modules))'
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '')
+
+        code = 'import sys, griffig; griffig.Griffig; print("tensorflow" in sys.modules, sorted(griffig.startup_profile))'
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "False ['import Griffig', 'import griffig']")
+
+
+if __name__ == '__main__':
+    unittest.main()
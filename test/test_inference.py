@@ -0,0 +1,236 @@
+from importlib.util import find_spec
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import unittest
+
+import numpy as np
+
+from pyaffx import Affine
+from griffig import BoxData, ModelArchitecture, ModelData
+from griffig.infer.inference_planar import InferencePlanar
+from griffig.utility.image import draw_around_box2, get_inference_image
+from griffig.utility.model_data import get_channels
+
+from loader import Loader
+
+
+def create_model_data(path=None, channels=None):
+    return ModelData(architecture=ModelArchitecture.Planar, path=path, pixel_size=2000.0, depth_diff=0.19, size_area_cropped=(200, 200), size_result=(32, 32), channels=channels)
+
+
+def save_keras_model(path: Path, number_channels: int):
+    """A tiny fully convolutional model with the grasp submodel of the model library"""
+    import tensorflow.keras as tk
+
+    inputs = tk.Input((None, None, number_channels))
+    grasp = tk.Model(inputs, tk.layers.Conv2D(3, 5, strides=3)(inputs), name='grasp')
+    tk.Model(inputs, grasp(inputs)).save(str(path))
+
+
+class RotationModel:
+    """Rewards of each stroke peaked at a known rotation, which is encoded in the (constant) value of the input image"""
+
+    def __init__(self, number_rotations, peaks, heights):
+        self.number_rotations = number_rotations
+        self.peaks = np.array(peaks, dtype=np.float32)  # Per stroke
+        self.heights = np.array(heights, dtype=np.float32)  # Per stroke
+        self.number_evaluations = 0
+
+    def input_images(self):
+        return np.broadcast_to(np.arange(self.number_rotations, dtype=np.float32)[:, None, None, None] / self.number_rotations, (self.number_rotations, 24, 24, 1))
+
+    def __call__(self, x):
+        self.number_evaluations += len(x)
+        rotations = np.round(x[:, 0, 0, 0] * self.number_rotations)
+        spatial = np.outer(np.hanning(6), np.hanning(6)).astype(np.float32)
+        reward = self.heights * np.exp(-(rotations[:, None] - self.peaks) ** 2 / 8.0)
+        return (reward[:, None, None, :] * spatial[None, :, :, None]).astype(np.float32)
+
+
+class ConvolutionModel:
+    """A fully convolutional model without padding: the mean of each input window (moved by the stride) per stroke"""
+
+    def __init__(self, window, stride):
+        self.window = window
+        self.stride = stride
+        self.number_evaluations = 0  # [pixels]
+
+    def __call__(self, x):
+        self.number_evaluations += x[..., 0].size
+        windows = np.lib.stride_tricks.sliding_window_view(x[..., 0], self.window, axis=(1, 2))[:, ::self.stride, ::self.stride]
+        return windows.mean(axis=(-2, -1), dtype=np.float64)[..., np.newaxis] * np.array([1.0, 0.8, 0.6])
+
+
+class InferenceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.box_data = BoxData([-0.002, -0.0065, 0.0], [0.174, 0.282, 0.0])
+
+    def test_channels(self):
+        self.assertEqual(get_channels(1), 'D')
+        self.assertEqual(get_channels(4), 'RGBD')
+        self.assertRaises(Exception, get_channels, 3)
+
+        # Channels given explicitly by the model data or by the shared model are kept
+        model = lambda x: x
+        self.assertEqual(InferencePlanar(create_model_data(), shared_model=model).channels, 'RGBD')
+        self.assertEqual(InferencePlanar(create_model_data(channels='D'), shared_model=model).channels, 'D')
+
+        inference = InferencePlanar(create_model_data(channels='D'), shared_model=model)
+        inference._set_channels(4)
+        self.assertEqual(inference.channels, 'D')
+
+        inference = InferencePlanar(create_model_data(), shared_model=model)
+        inference._set_channels(1)
+        self.assertEqual(inference.channels, 'D')
+
+    @unittest.skipIf(find_spec('tensorflow') is None, 'TensorFlow is not installed')
+    def test_channels_from_model(self):
+        with TemporaryDirectory() as directory:
+            for number_channels, channels in [(1, 'D'), (4, 'RGBD')]:
+                path = Path(directory) / f'model-{number_channels}'
+                save_keras_model(path, number_channels)
+
+                inference = InferencePlanar(create_model_data(path))
+                self.assertEqual(inference.channels, channels)
+
+                # The depth-only model runs on the input images of the depth channel only
+                input_images = inference.get_input_images(Loader.get_image('1'), self.box_data)
+                self.assertEqual(input_images.shape[-1], number_channels)
+                self.assertEqual(inference.model(input_images).shape[-1], 3)
+
+    @unittest.skipIf(find_spec('tensorflow') is None, 'TensorFlow is not installed')
+    def test_warmup_without_retracing(self):
+        image = Loader.get_image('1')
+
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / 'model'
+            save_keras_model(path, 4)
+
+            inference = InferencePlanar(create_model_data(path))
+            inference.warmup(image, self.box_data)
+            self.assertEqual(inference.model.compiled_model.experimental_get_tracing_count(), 1)
+
+            # Neither the next call nor another box (and so another crop size) traces the model again
+            inference.model(inference.get_input_images(image, self.box_data))
+            inference.model(inference.get_input_images(image, BoxData([-0.05, -0.05, 0.0], [0.05, 0.05, 0.0])))
+            self.assertEqual(inference.model.compiled_model.experimental_get_tracing_count(), 1)
+
+    def test_depth_only_input_images(self):
+        image = Loader.get_image('1')
+        model = lambda x: x
+
+        inference_rgbd = InferencePlanar(create_model_data(channels='RGBD'), shared_model=model)
+        inference_depth = InferencePlanar(create_model_data(channels='D'), shared_model=model)
+
+        input_images_rgbd = inference_rgbd.get_input_images(image, self.box_data)
+        input_images_depth = inference_depth.get_input_images(image, self.box_data)
+        self.assertEqual(input_images_depth.shape, input_images_rgbd.shape[:3] + (1,))
+        np.testing.assert_array_equal(input_images_depth[..., 0], input_images_rgbd[..., 3])
+
+    def test_input_images(self):
+        image = Loader.get_image('1')
+        inference = InferencePlanar(create_model_data(channels='RGBD'), shared_model=lambda x: x)
+        input_images = inference.get_input_images(image, self.box_data)
+
+        # Same as drawing around the box, and then rotating the image per angle
+        image_drawn = image.clone()
+        draw_around_box2(image_drawn, self.box_data)
+        size_cropped = inference._get_size_cropped(image, self.box_data)
+        expected = [get_inference_image(image_drawn, Affine(a=a), size_cropped, inference.size_area_cropped, inference.size_result, return_mat=True) for a in inference.a_space]
+        np.testing.assert_allclose(input_images, np.array(expected, dtype=np.float32) / np.iinfo(np.uint16).max, rtol=0.0, atol=1e-4)
+
+        # The input images are owned by the caller, and are not overwritten by the next call
+        input_images_copy = input_images.copy()
+        input_images_next = inference.get_input_images(image.clone(), self.box_data)
+        self.assertFalse(np.shares_memory(input_images, input_images_next))
+        np.testing.assert_array_equal(input_images, input_images_copy)
+
+    def test_search_rotations(self):
+        def best_index(reward):
+            return np.unravel_index(np.argmax(reward), reward.shape)
+
+        inference = InferencePlanar(create_model_data(channels='D'), shared_model=lambda x: x)
+
+        # The argmax is the same as of the exhaustive search, also if the number of rotations is not divisible by the
+        # step, and for peaks at both ends
+        for number_rotations in [20, 21]:
+            for coarse_step in [1, 3, 4, 6, 7, 50]:
+                for peak in [0, 7, number_rotations - 1]:
+                    model = RotationModel(number_rotations, [peak] * 3, [1.0, 0.8, 0.6])
+                    inference.model, inference.coarse_step, inference.fine_candidates = model, coarse_step, 1
+
+                    reward = inference.search_rotations(model.input_images())
+                    self.assertLessEqual(model.number_evaluations, number_rotations)
+                    self.assertEqual(reward.shape, (number_rotations, 6, 6, 3))
+                    self.assertEqual(best_index(reward), best_index(model(model.input_images())))
+
+        # More fine candidates than coarse rotations evaluate all rotations
+        model = RotationModel(20, [5, 5, 5], [1.0, 0.8, 0.6])
+        inference.model, inference.coarse_step, inference.fine_candidates = model, 4, 10
+        reward = inference.search_rotations(model.input_images())
+        self.assertEqual(model.number_evaluations, 20)
+        np.testing.assert_array_equal(reward, model(model.input_images()))
+
+        # The first stroke peaks at another rotation than the others, but is not possible for the gripper or not kept
+        for possible_indices, keep_indixes in [([False, True, True], None), (None, [1, 2]), ([True, True, False], [0, 1])]:
+            model = RotationModel(20, [3, 16, 16], [1.0, 0.5, 0.5])
+            inference.model, inference.coarse_step, inference.fine_candidates = model, 4, 1
+            inference.keep_indixes = keep_indixes
+
+            considered = inference.get_considered_indices(3, possible_indices)
+            reward = inference.search_rotations(model.input_images(), possible_indices)
+            expected = model(model.input_images())
+            reward[..., ~considered] = 0.0
+            expected[..., ~considered] = 0.0
+            self.assertEqual(best_index(reward), best_index(expected))
+        inference.keep_indixes = None
+
+    def test_search_pyramid(self):
+        def best_index(reward):
+            return np.unravel_index(np.argmax(reward), reward.shape)
+
+        inference = InferencePlanar(create_model_data(channels='D'), shared_model=lambda x: x)
+        model = ConvolutionModel(inference.window, inference.stride)
+        inference.model, inference.pyramid_candidates = model, 4
+
+        # Objects (bright blobs) in the middle of the second rotation, and in the corners of the third and last rotation
+        rng = np.random.default_rng(0)
+        input_images = rng.random((4, 300, 300, 1)) * 0.1
+        rows, cols = np.indices((300, 300))
+        for r, (row, col), height, sigma in [(1, (140, 160), 0.05, 16.0), (2, (4, 295), 1.0, 24.0), (3, (298, 2), 0.8, 24.0)]:
+            input_images[r, :, :, 0] += height * np.exp(-((rows - row) ** 2 + (cols - col) ** 2) / (2 * sigma ** 2))
+
+        full_reward = model(input_images)
+        self.assertEqual(full_reward.shape, (4, 135, 135, 3))
+
+        # The coarse level evaluated sparsely by the model itself (for factors larger than window / stride = 16), or by
+        # a model at the coarse pixel size. Both evaluate fewer input pixels than the full inference.
+        for factor, region, pyramid_model in [(32, 16, None), (48, 24, None), (2, 6, ConvolutionModel(inference.window, inference.stride))]:
+            inference.pyramid_factor, inference.pyramid_region, inference.pyramid_model = factor, region, pyramid_model
+            model.number_evaluations = 0
+
+            reward = inference.search_pyramid(input_images)
+            self.assertEqual(reward.shape, full_reward.shape)
+            self.assertLess(model.number_evaluations, input_images[..., 0].size)
+
+            # Inside the refined regions, the stitched rewards are the ones of the full resolution
+            refined = np.any(reward != 0.0, axis=-1)
+            self.assertGreaterEqual(np.count_nonzero(refined), inference.pyramid_candidates * (2 * region + 1) ** 2 // 2)
+            np.testing.assert_allclose(reward[refined], full_reward[refined], rtol=1e-6)
+
+            # The regions at the borders are mapped to the right crops, so that the best reward is found also there
+            self.assertEqual(best_index(reward), best_index(full_reward))
+            for r, i, j in [(2, 0, 134), (3, 134, 0)]:
+                self.assertTrue(refined[r, i, j])
+
+        # Without a pyramid model, smaller factors wouldn't save computation and fall back to the full inference
+        inference.pyramid_factor, inference.pyramid_model = 16, None
+        np.testing.assert_array_equal(inference.search_pyramid(input_images), full_reward)
+
+        # A model output that doesn't match the window and stride falls back to the full inference
+        inference.pyramid_factor, inference.stride = 48, 1
+        np.testing.assert_array_equal(inference.search_pyramid(input_images), full_reward)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,321 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+import unittest
+
+import numpy as np
+
+from pyaffx import Affine
+from griffig import BoxData, CameraIntrinsics, CaptureReader, CaptureWriter, Pointcloud, PointcloudFilter, PointType, Renderer, RendererPool, RenderMode, SoftwareRenderer
+
+
+def create_pointcloud_data():
+    """Random colored points within the rendered depth range, as raw XYZWRGBA buffer"""
+    rng = np.random.default_rng(seed=42)
+    number_points = 200000
+    points = np.zeros(number_points, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('w', 'f4'), ('rgba', 'u1', 4)])
+    points['x'] = rng.uniform(-0.18, 0.18, number_points)
+    points['y'] = rng.uniform(-0.12, 0.12, number_points)
+    points['z'] = rng.uniform(0.25, 0.40, number_points)
+    points['rgba'] = rng.integers(0, 255, (number_points, 4))
+    return points.tobytes()
+
+
+def transform_pointcloud(data, camera_pose: Affine):
+    """The same points, transformed into the render frame beforehand"""
+    points = np.frombuffer(data, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('w', 'f4'), ('rgba', 'u1', 4)]).copy()
+    matrix = camera_pose.matrix()
+    xyz = np.stack([points['x'], points['y'], points['z']], axis=-1).astype(np.float64) @ matrix[:3, :3].T + matrix[:3, 3]
+    points['x'], points['y'], points['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    return Pointcloud(type=PointType.XYZWRGBA, data=points.tobytes())
+
+
+class PointcloudTestCase(unittest.TestCase):
+    """Tests of the point clouds and the CPU (software) renderer, which run on any machine"""
+
+    output_path = Path(__file__).parent.absolute() / 'data'
+
+    def setUp(self):
+        self.data = create_pointcloud_data()
+        self.pointcloud = Pointcloud(type=PointType.XYZWRGBA, data=self.data)
+
+    def test_pointcloud_from_buffer(self):
+        renderer = SoftwareRenderer((752, 480), 0.41, 2000.0, 0.19)
+        image = renderer.render_pointcloud(self.pointcloud)
+
+        # The structured array is only referenced, but kept alive by the point cloud
+        pointcloud = Pointcloud(points=np.frombuffer(self.data, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('w', 'f4'), ('rgba', 'u1', 4)]).copy())
+        self.assertEqual(pointcloud.point_type, PointType.XYZWRGBA)
+        self.assertEqual(pointcloud.size, self.pointcloud.size)
+        np.testing.assert_array_equal(image.mat, renderer.render_pointcloud(pointcloud).mat)
+
+        xyz = np.zeros((100, 3), dtype=np.float32)
+        self.assertEqual(Pointcloud(points=xyz).point_type, PointType.XYZ)
+
+        with self.assertRaises(RuntimeError):
+            Pointcloud(points=np.zeros((100, 3), dtype=np.float32)[::2])
+
+        with self.assertRaises(RuntimeError):
+            Pointcloud(points=xyz, type=PointType.XYZRGB)
+
+        with self.assertRaises(RuntimeError):
+            Pointcloud(points=xyz, texture=np.zeros((10, 10, 3), dtype=np.uint8), tex_coords=np.zeros((99, 2), dtype=np.float32))
+
+        pointcloud_textured = Pointcloud(points=xyz, texture=np.zeros((10, 10, 3), dtype=np.uint8), tex_coords=np.zeros((100, 2), dtype=np.float32))
+        self.assertEqual(pointcloud_textured.size, 100)
+
+    def test_pointcloud_from_ros_message(self):
+        renderer = SoftwareRenderer((752, 480), 0.41, 2000.0, 0.19)
+        source = np.frombuffer(self.data, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('w', 'f4'), ('rgba', 'u1', 4)])
+
+        def create_message(points, fields, height=1, is_bigendian=False):
+            return SimpleNamespace(
+                width=len(points) // height,
+                height=height,
+                point_step=points.dtype.itemsize,
+                row_step=points.dtype.itemsize * (len(points) // height),
+                is_bigendian=is_bigendian,
+                fields=[SimpleNamespace(name=name, offset=points.dtype.fields[name][1], datatype=datatype) for name, datatype in fields],
+                data=points.tobytes(),
+            )
+
+        # Organized XYZ points with padding are referenced without copying
+        points = np.zeros(len(source), dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('padding', 'f4')])
+        for name in ['x', 'y', 'z']:
+            points[name] = source[name]
+        pointcloud = Pointcloud(ros_message=create_message(points, [('x', 7), ('y', 7), ('z', 7)], height=400))
+        self.assertEqual(pointcloud.point_type, PointType.XYZ)
+        self.assertEqual(pointcloud.size, len(source))
+
+        xyz = np.ascontiguousarray(np.stack([source['x'], source['y'], source['z']], axis=-1))
+        np.testing.assert_array_equal(renderer.render_depth_pointcloud(pointcloud).mat, renderer.render_depth_pointcloud(Pointcloud(points=xyz)).mat)
+
+        # Colored points in the layout of griffig itself are referenced without copying, with the same channel order
+        # as messages without a layout
+        message = create_message(source, [('x', 7), ('y', 7), ('z', 7), ('rgba', 6)])
+        pointcloud = Pointcloud(ros_message=message)
+        self.assertEqual(pointcloud.point_type, PointType.XYZWRGBA)
+        self.assertTrue(np.shares_memory(pointcloud.vertices, np.frombuffer(message.data, dtype=np.uint8)))
+        np.testing.assert_array_equal(pointcloud.vertices[:, 16:20], source['rgba'])
+
+        pointcloud_legacy = Pointcloud(ros_message=SimpleNamespace(data=message.data))
+        np.testing.assert_array_equal(renderer.render_pointcloud(pointcloud).mat, renderer.render_pointcloud(pointcloud_legacy).mat)
+
+        # Other colored layouts are repacked byte-wise in the same channel order, skipping invalid points
+        points = np.zeros(len(source), dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('rgb', 'u1', 4), ('padding', 'f4')])
+        for name in ['x', 'y', 'z']:
+            points[name] = source[name]
+        points['rgb'] = source['rgba']
+        points['x'][:10] = np.nan
+
+        fields = [('x', 7), ('y', 7), ('z', 7), ('rgb', 7)]
+        pointcloud = Pointcloud(ros_message=create_message(points, fields))
+        self.assertEqual(pointcloud.point_type, PointType.XYZWRGBA)
+        self.assertEqual(pointcloud.size, len(source) - 10)
+        np.testing.assert_array_equal(pointcloud.vertices[:, 16:20], source['rgba'][10:])
+
+        # Same result from big-endian data, whose color bytes are not swapped
+        pointcloud_bigendian = Pointcloud(ros_message=create_message(points.astype(points.dtype.newbyteorder('>')), fields, is_bigendian=True))
+        np.testing.assert_array_equal(pointcloud_bigendian.vertices[:, 16:20], source['rgba'][10:])
+        np.testing.assert_array_equal(renderer.render_pointcloud(pointcloud).mat, renderer.render_pointcloud(pointcloud_bigendian).mat)
+        np.testing.assert_array_equal(renderer.render_pointcloud(pointcloud).mat, renderer.render_pointcloud(Pointcloud(points=source[10:].copy())).mat)
+
+    def test_capture_replay(self):
+        renderer = SoftwareRenderer((752, 480), 0.41, 2000.0, 0.19)
+        camera_pose = Affine(0.01, 0.0, 0.02, 0.1, 0.0, 0.0)
+
+        with TemporaryDirectory() as path:
+            with CaptureWriter(path) as capture:
+                capture.write(self.pointcloud, camera_pose=camera_pose)
+                capture.write(Pointcloud(type=PointType.XYZWRGBA, data=b''))
+
+            reader = CaptureReader(path)
+            self.assertEqual(len(reader), 2)
+
+            pointcloud, pose = reader[0]
+            self.assertEqual(pointcloud.size, self.pointcloud.size)
+            self.assertAlmostEqual(pose.x, camera_pose.x)
+            np.testing.assert_array_equal(pointcloud.vertices, self.pointcloud.vertices)
+            np.testing.assert_array_equal(renderer.render_pointcloud(pointcloud).mat, renderer.render_pointcloud(self.pointcloud).mat)
+
+            pointcloud, pose = reader[1]
+            self.assertEqual(pointcloud.size, 0)
+            self.assertIsNone(pose)
+            del pointcloud, reader
+
+    def test_reproject_depth_image(self):
+        renderer = SoftwareRenderer((752, 480), 0.41, 2000.0, 0.19)
+        intrinsics = CameraIntrinsics(fx=600.0, fy=600.0, cx=320.0, cy=240.0, depth_scale=0.001)
+
+        rng = np.random.default_rng(seed=42)
+        depth = rng.integers(250, 400, (480, 640), dtype=np.uint16)
+        depth[:10] = 0  # Invalid pixels
+        color = rng.integers(0, 255, (480, 640, 3), dtype=np.uint8)
+
+        # Same points as a textured point cloud
+        v, u = np.indices(depth.shape)
+        z = (depth * intrinsics.depth_scale).astype(np.float32).astype(np.float64)
+        xyz = np.stack([(u - intrinsics.cx) * z / intrinsics.fx, (v - intrinsics.cy) * z / intrinsics.fy, z], axis=-1).reshape(-1, 3).astype(np.float32)
+        uv = np.stack([(u + 0.5) / depth.shape[1], (v + 0.5) / depth.shape[0]], axis=-1).reshape(-1, 2).astype(np.float32)
+        valid = depth.reshape(-1) > 0
+        pointcloud = Pointcloud(points=np.ascontiguousarray(xyz[valid]), texture=color, tex_coords=np.ascontiguousarray(uv[valid]))
+
+        camera_pose = Affine(0.01, 0.0, 0.0, 0.1, 0.0, 0.0)
+        image = renderer.reproject_image(depth, intrinsics, color=color, camera_pose=camera_pose)
+        image_pointcloud = renderer.render_pointcloud(pointcloud, camera_pose=camera_pose)
+        np.testing.assert_array_equal(image.mat, image_pointcloud.mat)
+
+        image_depth = renderer.reproject_depth_image(depth, intrinsics, camera_pose=camera_pose)
+        np.testing.assert_array_equal(image_depth.mat, image.mat[:, :, 3])
+
+    def test_render_fused_pointclouds(self):
+        half = len(self.data) // 2
+        pointclouds = [Pointcloud(type=PointType.XYZWRGBA, data=self.data[:half]), Pointcloud(type=PointType.XYZWRGBA, data=self.data[half:])]
+
+        renderer = SoftwareRenderer((752, 480), 0.41, 2000.0, 0.19)
+        image = renderer.render_pointcloud(self.pointcloud)
+        image_fused = renderer.render_pointclouds(pointclouds, [Affine(), Affine()])
+        np.testing.assert_array_equal(image.mat, image_fused.mat)
+
+        # Moving one camera away shifts its points out of the depth range
+        image_moved = renderer.render_pointclouds(pointclouds, [Affine(), Affine(z=1.0)])
+        self.assertLess(np.count_nonzero(image_moved.mat[:, :, 3]), np.count_nonzero(image.mat[:, :, 3]))
+
+        with self.assertRaises(RuntimeError):
+            renderer.render_pointclouds(pointclouds, [Affine()])
+
+    def test_render_camera_pose(self):
+        camera_pose = Affine(0.02, -0.01, 0.03, 0.3, 0.0, 0.0)
+        pointcloud_transformed = transform_pointcloud(self.data, camera_pose)
+
+        renderer = SoftwareRenderer((752, 480), 0.41, 2000.0, 0.19)
+        image = renderer.render_pointcloud(self.pointcloud, camera_pose=camera_pose)
+        image_transformed = renderer.render_pointcloud(pointcloud_transformed)
+
+        # Allow for a few pixels of different rounding at the pixel borders
+        depth_difference = np.abs(image.mat[:, :, 3].astype(np.int32) - image_transformed.mat[:, :, 3].astype(np.int32))
+        self.assertGreater(np.mean(depth_difference <= 2), 0.98)
+
+    def test_pointcloud_filter(self):
+        renderer = SoftwareRenderer((752, 480), 0.41, 2000.0, 0.19)
+        pointcloud_filter = PointcloudFilter(min_depth=0.22, max_depth=0.41, pixel_size=2000.0, size=(752, 480))
+
+        filtered = pointcloud_filter.apply(self.pointcloud)
+        self.assertLessEqual(filtered.size, 752 * 480)
+        np.testing.assert_array_equal(renderer.render_pointcloud(self.pointcloud).mat, renderer.render_pointcloud(filtered).mat)
+
+        pointcloud_filter.box_data = BoxData([0.0, 0.0, 0.0], [0.1, 0.1, 0.0])
+        self.assertLess(pointcloud_filter.apply(self.pointcloud).size, filtered.size)
+
+        pointcloud_filter.remove_outliers = True
+        self.assertLessEqual(pointcloud_filter.apply(self.pointcloud).size, filtered.size)
+
+
+class RenderTestCase(unittest.TestCase):
+    """Tests of the OpenGL renderer, skipped on machines without EGL (e.g. CPU-only or headless)"""
+
+    def setUp(self):
+        self.data = create_pointcloud_data()
+        self.pointcloud = Pointcloud(type=PointType.XYZWRGBA, data=self.data)
+
+        try:
+            self.renderer = Renderer((752, 480), 0.41, 2000.0, 0.19)
+        except RuntimeError as e:
+            self.skipTest(f'OpenGL renderer is not available: {e}')
+
+    def test_vertex_buffer_matches_immediate(self):
+        self.renderer.render_mode = RenderMode.Immediate
+        image_immediate = self.renderer.render_pointcloud(self.pointcloud)
+
+        self.renderer.render_mode = RenderMode.VertexBuffer
+        image_vertex_buffer = self.renderer.render_pointcloud(self.pointcloud)
+        image_vertex_buffer_second = self.renderer.render_pointcloud(self.pointcloud)
+
+        self.assertGreater(np.count_nonzero(image_immediate.mat[:, :, 3]), 0)
+        np.testing.assert_array_equal(image_immediate.mat, image_vertex_buffer.mat)
+        np.testing.assert_array_equal(image_vertex_buffer.mat, image_vertex_buffer_second.mat)
+
+    def test_render_into_output(self):
+        image = self.renderer.render_pointcloud(self.pointcloud)
+
+        out = np.zeros((self.renderer.height, self.renderer.width, 4), dtype=np.uint16)
+        image_out = self.renderer.render_pointcloud(self.pointcloud, out=out)
+        self.assertTrue(np.shares_memory(image_out.mat, out))
+        np.testing.assert_array_equal(image.mat, out)
+
+        mat = self.renderer.render_pointcloud_mat(self.pointcloud, 2000.0, 0.22, 0.41, out=out)
+        self.assertIs(mat, out)
+
+        with self.assertRaises(RuntimeError):
+            self.renderer.render_pointcloud(self.pointcloud, out=np.zeros((10, 10, 4), dtype=np.uint16))
+
+    def test_render_depth_only(self):
+        image = self.renderer.render_pointcloud(self.pointcloud)
+        image_depth = self.renderer.render_depth_pointcloud(self.pointcloud)
+        self.assertEqual(image_depth.mat.shape, (self.renderer.height, self.renderer.width))
+        np.testing.assert_array_equal(image_depth.mat, image.mat[:, :, 3])
+
+    def test_render_async(self):
+        image = self.renderer.render_pointcloud(self.pointcloud)
+
+        self.assertIsNone(self.renderer.render_pointcloud_async(self.pointcloud))
+        image_previous = self.renderer.render_pointcloud_async(Pointcloud(type=PointType.XYZWRGBA, data=b''))
+        np.testing.assert_array_equal(image.mat, image_previous.mat)
+
+        image_last = self.renderer.finish_pointcloud_async()
+        self.assertEqual(np.count_nonzero(image_last.mat), 0)
+        self.assertIsNone(self.renderer.finish_pointcloud_async())
+
+    def test_render_fused_pointclouds_opengl(self):
+        half = len(self.data) // 2
+        pointclouds = [Pointcloud(type=PointType.XYZWRGBA, data=self.data[:half]), Pointcloud(type=PointType.XYZWRGBA, data=self.data[half:])]
+
+        image = self.renderer.render_pointcloud(self.pointcloud)
+        image_fused = self.renderer.render_pointclouds(pointclouds, [Affine(), Affine()])
+        np.testing.assert_array_equal(image.mat, image_fused.mat)
+
+        with self.assertRaises(RuntimeError):
+            self.renderer.render_pointclouds(pointclouds, [Affine()])
+
+    def test_render_camera_pose_opengl(self):
+        camera_pose = Affine(0.02, -0.01, 0.03, 0.3, 0.0, 0.0)
+        pointcloud_transformed = transform_pointcloud(self.data, camera_pose)
+
+        image_gl = self.renderer.render_pointcloud(self.pointcloud, camera_pose=camera_pose)
+        image_gl_transformed = self.renderer.render_pointcloud(pointcloud_transformed)
+
+        # Allow for a few pixels of different rounding at the pixel borders
+        depth_difference = np.abs(image_gl.mat[:, :, 3].astype(np.int32) - image_gl_transformed.mat[:, :, 3].astype(np.int32))
+        self.assertGreater(np.mean(depth_difference <= 2), 0.98)
+
+    def test_renderer_pool(self):
+        image = self.renderer.render_pointcloud(self.pointcloud)
+        pool = RendererPool(2, (752, 480), 0.41, 2000.0, 0.19)
+
+        def render(_):
+            with pool.acquire() as renderer:
+                return renderer.render_pointcloud(self.pointcloud).mat
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for mat in executor.map(render, range(8)):
+                np.testing.assert_array_equal(image.mat, mat)
+
+        self.assertEqual(len(pool), 2)
+
+    def test_software_renderer_matches_opengl(self):
+        software_renderer = SoftwareRenderer((752, 480), 0.41, 2000.0, 0.19)
+
+        image = self.renderer.render_pointcloud(self.pointcloud)
+        image_software = software_renderer.render_pointcloud(self.pointcloud)
+
+        self.assertEqual(image.mat.shape, image_software.mat.shape)
+        self.assertEqual(image.mat.dtype, image_software.mat.dtype)
+
+        # Allow for a few pixels of different rounding at the pixel borders
+        depth_difference = np.abs(image.mat[:, :, 3].astype(np.int32) - image_software.mat[:, :, 3].astype(np.int32))
+        self.assertGreater(np.mean(depth_difference <= 2), 0.98)
+
+
+if __name__ == '__main__':
+    unittest.main()